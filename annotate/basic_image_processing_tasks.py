@@ -1,46 +1,114 @@
 # -*- coding: utf-8 -*-
-import napari
-from skimage import data
-import skimage.filters as skfil
-from skimage.measure import label
-from tifffile import imread, imsave
-from skimage.transform import resize
+# headless compute core: keep napari/Qt (and anything else that is slow to import) out of this module
+import itertools
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
-from skimage.morphology import remove_small_objects
+from skimage.segmentation import relabel_sequential
+import scipy.ndimage as ndi
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import cv2
+import warnings
 
+from annotate.profiling import profile_stage
+from annotate.histogram_thresholds import thresholds_from_image, threshold_from_histogram
 
-def gen_background_mask(image, threshold_method = "Otsu", user_thresh = None):
+# skimage.filters.gaussian truncates the kernel at 4 standard deviations
+GAUSSIAN_TRUNCATE = 4.0
+
+# number of pixels converted at a time when copying an image into the smoothing buffer
+SMOOTHING_CHUNK_PIXELS = 2**22
+
+# number of pixels compared at a time when looking for objects that touch diagonally
+LABELLING_CHUNK_PIXELS = 2**22
+
+# segmentation of stacks (ZYX images):
+#   3d     - smooth, threshold and label the whole stack at once (objects are connected across planes)
+#   planes - segment each plane on its own (see plane_intensity_based_segmentation)
+STACK_MODES = ("3d", "planes")
+
+# pools the planes of a stack can be segmented in
+PLANE_POOLS = ("thread", "process")
+
+def smoothing_dtype(precision = "float32"):
+    """Selects the float dtype used to smooth images
+    
+    Args:
+        precision : float32 or float64
+    Returns:
+        The numpy dtype
+    """
+    if (precision == "float32"):
+        return np.float32
+    elif (precision == "float64"):
+        return np.float64
+    else:
+        raise Exception('Invalid input for precision: should be among {float32, float64}')
+
+def smooth_image(image, gaussian_sigma = 1, precision = "float32", out = None):
+    """Gaussian filter an image in place in a float buffer
+    
+    The image is copied (a strip at a time) into the buffer, which is then filtered in place, so the only full size array
+    is the output. float64 gives exactly skimage.filters.gaussian(image, sigma=gaussian_sigma, preserve_range = True).
+    float32 uses half the memory and, for 2D images, the much faster cv2.GaussianBlur (same kernel and borders,
+    the result differs from float64 by float32 rounding).
+    
+    Args:
+        image          : image to smooth (numpy, memory-mapped or zarr array)
+        gaussian_sigma : sigma to use for the gaussian filter
+        precision      : float32 or float64
+        out            : buffer to write the smoothed image to (e.g. a memory-mapped array), allocated if None
+    Returns:
+        The smoothed image
+    """
+    
+    dtype = smoothing_dtype(precision)
+    if out is None:
+        out = np.empty(image.shape, dtype = dtype)
+    elif (out.shape != image.shape or out.dtype != dtype):
+        raise Exception("The output buffer should be a " + precision + " array of the shape of the image")
+    
+    rows_per_chunk = max(SMOOTHING_CHUNK_PIXELS // max(int(np.prod(image.shape[1:])), 1), 1)
+    for row_start in range(0, image.shape[0], rows_per_chunk):
+        out[row_start:row_start + rows_per_chunk] = image[row_start:row_start + rows_per_chunk]
+    
+    if (precision == "float32" and out.ndim == 2 and out.size > 0):
+        # kernel of the same size as scipy.ndimage (and skimage), replicated borders are ndimage's 'nearest' mode
+        ksize = 2 * int(GAUSSIAN_TRUNCATE * gaussian_sigma + 0.5) + 1
+        cv2.GaussianBlur(out, (ksize, ksize), gaussian_sigma, dst = out, sigmaY = gaussian_sigma, borderType = cv2.BORDER_REPLICATE)
+    else:
+        ndi.gaussian_filter(out, sigma = gaussian_sigma, output = out, mode = 'nearest', truncate = GAUSSIAN_TRUNCATE)
+    
+    return out
+
+
+def gen_background_mask(image, threshold_method = "Otsu", user_thresh = None, sample_fraction = None, sample_method = "strided",
+                        li_histogram = False):
     """Performs intensity based thresholding to generate a background mask
     
+    The threshold is computed from a histogram of the image built a strip at a time (see annotate.histogram_thresholds),
+    Li is computed on the pixels for non-integer images (from a fine histogram with li_histogram).
+    
     Args:
         image : image to be thresholded (this is expected to a gray scale image)
         thresolding method : method to use for identifying lower threshold (default is Otsu)
         lower_thresh : user-defined lower threshold
+        sample_fraction : estimate the threshold from this fraction of the pixels (None uses all of them)
+        sample_method : strided- every n-th row and column, random- pixels drawn at random
+        li_histogram : compute Li from a fine histogram instead of the pixels (see thresholds_from_image)
     Returns:
         A binary image where the background is set to 0
     """
     
     # extract threshold
-    if (threshold_method == "Li"):
-        thresh = skfil.threshold_li(image)
-    elif (threshold_method == "Otsu"):
-        thresh = skfil.threshold_otsu(image)
-    elif (threshold_method == "Isodata"):
-        thresh = skfil.threshold_isodata(image)
-    elif (threshold_method == "Mean"):
-        thresh = skfil.threshold_mean(image)
-    elif (threshold_method == "Minimum"):
-        thresh = skfil.threshold_minimum(image)
-    elif (threshold_method == "Triangle"):
-        thresh = skfil.threshold_triangle(image)
-    elif (threshold_method == "Yen"):
-        thresh = skfil.threshold_yen(image)
-    elif (threshold_method == "Manual"):
+    if (threshold_method == "Manual"):
         if user_thresh is None:
             raise Exception("Manual threshold requires a user-defined threshold value")
         else:
             thresh = user_thresh
+    elif threshold_method in ("Li","Otsu","Isodata","Mean","Minimum","Triangle","Yen"):
+        thresh = thresholds_from_image(image, [threshold_method], sample_fraction, sample_method, li_histogram = li_histogram)[threshold_method]
     else:
         raise Exception('Invalid threshold_method: should be among {"Li","Otsu","Isodata","Mean","Minimum","Triangle","Yen", "Manual"}')
         
@@ -49,7 +117,160 @@ def gen_background_mask(image, threshold_method = "Otsu", user_thresh = None):
     
     return bw
 
-def simple_intensity_based_segmentation(image, gaussian_sigma=1, thresh_method="Otsu", smallest_area_of_object=5,label_img_depth = "8bit"):
+def label_image_dtype(max_label, label_img_depth = "8bit", promote = True):
+    """Selects the integer dtype of a label image
+    
+    Args:
+        max_label       : largest label in the image
+        label_img_depth : requested label depth (8bit or 16bit)
+        promote         : promote to a deeper dtype (uint16 or uint32) if the labels do not fit, otherwise raise an exception
+    Returns:
+        The numpy dtype to store the labels in
+    """
+    
+    if (label_img_depth == "8bit"):
+        dtype = np.uint8
+    elif (label_img_depth == "16bit"):
+        dtype = np.uint16
+    else:
+        raise Exception('Invalid input: should be among {8bit, 16bit}')
+    
+    if (max_label > np.iinfo(dtype).max):
+        if not promote:
+            raise Exception("The largest label (" + str(max_label) + ") does not fit in " + label_img_depth)
+        for promoted_dtype in (np.uint16, np.uint32, np.uint64):
+            if (max_label <= np.iinfo(promoted_dtype).max):
+                break
+        warnings.warn("The largest label (" + str(max_label) + ") does not fit in " + label_img_depth + 
+                      ", the labels are stored as " + np.dtype(promoted_dtype).name)
+        dtype = promoted_dtype
+    
+    return dtype
+
+def cast_label_image(label_image, label_img_depth = "8bit", relabel = False, promote = True):
+    """Casts a label image to the requested depth without changing any of its labels
+    
+    Args:
+        label_image     : label image (non negative integers)
+        label_img_depth : requested label depth (8bit or 16bit)
+        relabel         : relabel the objects sequentially (1, 2, 3...) before casting
+        promote         : promote to a deeper dtype (uint16 or uint32) if the labels do not fit, otherwise raise an exception
+    Returns:
+        The label image (not copied if it already has the right dtype)
+    """
+    
+    if (label_image.size == 0):
+        return label_image.astype(label_image_dtype(0, label_img_depth), copy = False)
+    
+    if (np.min(label_image) < 0):
+        raise Exception("The label image has negative labels")
+    
+    if relabel:
+        label_image = relabel_sequential(label_image)[0]
+    
+    dtype = label_image_dtype(int(np.max(label_image)), label_img_depth, promote)
+    
+    return label_image.astype(dtype, copy = False)
+
+def face_connected_components(bw):
+    """Label the face connected components of a binary image, count their areas and find the ones that touch diagonally
+    
+    Args:
+        bw : binary image
+    Returns:
+        components     : labels of the face connected components (numbered in raster order)
+        areas          : area in pixels of each component (areas[0] is the background)
+        diagonal_pairs : (2, n) array of pairs of components that touch diagonally
+    """
+    
+    bw = np.asarray(bw, dtype = bool)
+    components, n_components = ndi.label(bw, ndi.generate_binary_structure(bw.ndim, 1))
+    
+    # count by chunk, bincount makes an int64 copy of its input
+    rows_per_chunk = max(LABELLING_CHUNK_PIXELS // max(int(np.prod(bw.shape[1:])), 1), 1)
+    areas = np.zeros(n_components + 1, dtype = np.int64)
+    for row_start in range(0, components.shape[0], rows_per_chunk):
+        areas += np.bincount(components[row_start:row_start + rows_per_chunk].ravel(), minlength = n_components + 1)
+    
+    # orthogonal neighbours are always in the same component, only half of the diagonal offsets are needed
+    # as the other half gives the same pairs
+    pairs = [np.zeros((2, 0), dtype = components.dtype)]
+    for offset in itertools.product((-1, 0, 1), repeat = bw.ndim):
+        nonzero = np.flatnonzero(offset)
+        if (nonzero.size < 2 or offset[nonzero[0]] < 0):
+            continue
+        source = components[tuple(slice(0, -1) if o == 1 else slice(1, None) if o == -1 else slice(None) for o in offset)]
+        target = components[tuple(slice(1, None) if o == 1 else slice(0, -1) if o == -1 else slice(None) for o in offset)]
+        for row_start in range(0, source.shape[0], rows_per_chunk):
+            source_chunk = source[row_start:row_start + rows_per_chunk]
+            target_chunk = target[row_start:row_start + rows_per_chunk]
+            touching = (source_chunk != target_chunk) & (source_chunk > 0) & (target_chunk > 0)
+            if touching.any():
+                pairs.append(np.stack([source_chunk[touching], target_chunk[touching]]))
+    
+    return components, areas, np.concatenate(pairs, axis = 1)
+
+def label_components(components, areas, diagonal_pairs, smallest_area_of_object = 5, label_img_depth = "8bit"):
+    """Label the objects made of the components returned by face_connected_components, dropping the small components
+    
+    Components smaller than smallest_area_of_object are removed, the remaining ones that touch diagonally are merged into
+    objects and the objects are numbered in raster order, all through a lookup table in the label dtype.
+    Several areas can be tried on the same components without labelling the image again.
+    
+    Args:
+        components              : labels of the face connected components
+        areas                   : area of each component
+        diagonal_pairs          : pairs of components that touch diagonally
+        smallest_area_of_object : smallest area of objects in pixels
+        label_img_depth         : label depth
+    Returns:
+        A labelled image
+    """
+    
+    n_components = areas.size - 1
+    keep = areas >= smallest_area_of_object
+    keep[0] = False
+    pairs = diagonal_pairs[:, keep[diagonal_pairs[0]] & keep[diagonal_pairs[1]]]
+    
+    # merge the touching components into objects
+    graph = coo_matrix((np.ones(pairs.shape[1], dtype = np.int8), (pairs[0], pairs[1])), shape = (n_components + 1, n_components + 1))
+    objects = connected_components(graph, directed = False)[1]
+    
+    # number the objects in raster order (components are numbered in raster order, so by their first kept component)
+    kept_components = np.flatnonzero(keep)
+    object_ids, first_component, component_object = np.unique(objects[kept_components], return_index = True, return_inverse = True)
+    object_labels = np.empty(object_ids.size, dtype = np.int64)
+    object_labels[np.argsort(first_component)] = np.arange(1, object_ids.size + 1)
+    
+    # correct image depth
+    label_lut = np.zeros(n_components + 1, dtype = label_image_dtype(object_ids.size, label_img_depth))
+    label_lut[kept_components] = object_labels[component_object]
+    
+    return label_lut[components]
+
+def label_size_filtered_objects(bw, smallest_area_of_object = 5, label_img_depth = "8bit"):
+    """Remove small objects and label the remaining ones with a single labelling pass
+    
+    Gives the same labels as cast_label_image(label(remove_small_objects(bw, smallest_area_of_object)), label_img_depth):
+    areas are measured on face connected components (as in remove_small_objects) while objects are fully connected
+    (as in label) and numbered in raster order. The face connected components are labelled once, their areas counted
+    with bincount, and a lookup table drops the small ones, merges the ones that touch diagonally and numbers the objects
+    in the label dtype, so the labels are written once without any intermediate full size image.
+    
+    Args:
+        bw                      : binary image
+        smallest_area_of_object : smallest area of objects in pixels
+        label_img_depth         : label depth
+    Returns:
+        A labelled image
+    """
+    
+    components, areas, diagonal_pairs = face_connected_components(bw)
+    
+    return label_components(components, areas, diagonal_pairs, smallest_area_of_object, label_img_depth)
+
+def simple_intensity_based_segmentation(image, gaussian_sigma=1, thresh_method="Otsu", smallest_area_of_object=5,label_img_depth = "8bit",
+                                        thresh_sample_fraction = None, precision = "float32", li_histogram = False):
     """Perform intensity based thresholding and detect objects
     
     Args:
@@ -58,30 +279,131 @@ def simple_intensity_based_segmentation(image, gaussian_sigma=1, thresh_method="
         thresh_method           : threshold method
         smallest_area_of_object : smallest area of objects in pixels
         label_img_depth         : label depth
+        thresh_sample_fraction  : estimate the threshold from this fraction of the pixels (None uses all of them)
+        precision               : precision of the smoothed image (float32 or float64, see smooth_image)
+        li_histogram            : compute Li from a fine histogram of the smoothed image instead of its pixels (see thresholds_from_image)
 
     Returns:
         A labelled image
     """
     
     # apply a gaussian filter
-    image_smooth = skfil.gaussian(image, sigma=gaussian_sigma, preserve_range = True)
+    with profile_stage("gaussian"):
+        image_smooth = smooth_image(image, gaussian_sigma, precision)
     
     # apply threshold
-    bw = gen_background_mask(image_smooth, threshold_method = thresh_method)
+    with profile_stage("threshold"):
+        bw = gen_background_mask(image_smooth, threshold_method = thresh_method, sample_fraction = thresh_sample_fraction,
+                                 li_histogram = li_histogram)
     
-    #remove small objects
-    bw_size_filtered = remove_small_objects(bw,smallest_area_of_object )
+    #remove small objects and label connected components (in a single labelling pass)
+    with profile_stage("label"):
+        label_image_cor = label_size_filtered_objects(bw, smallest_area_of_object, label_img_depth)
     
-    #Label connected components
-    label_image = label(bw_size_filtered)
+    return label_image_cor
     
-    # add an empty image to the image 
-    if (label_img_depth == "8bit"):
-        label_image_cor = cv2.normalize(label_image, None, 0, np.max(label_image), cv2.NORM_MINMAX, cv2.CV_8U)
-    elif (label_img_depth == "16bit"):
-        label_image_cor = cv2.normalize(label_image, None, 0, np.max(label_image), cv2.NORM_MINMAX, cv2.CV_16U)
+
+def plane_intensity_based_segmentation(stack, gaussian_sigma=1, thresh_method="Otsu", smallest_area_of_object=5, label_img_depth = "8bit",
+                                       thresh_sample_fraction = None, precision = "float32", plane_workers = 1, plane_pool = "thread",
+                                       li_histogram = False):
+    """Segment each plane of a stack on its own, several planes at a time
+    
+    Each plane gets the labels of simple_intensity_based_segmentation (with its own threshold), offset by the number of objects
+    in the previous planes so that every object of the stack has its own label.
+    
+    Args:
+        stack                   : stack to segment, every axis before the last two (rows, cols) is a plane axis
+        gaussian_sigma          : sigma to use for the gaussian filter
+        thresh_method           : threshold method
+        smallest_area_of_object : smallest area of objects in pixels
+        label_img_depth         : label depth
+        thresh_sample_fraction  : estimate the thresholds from this fraction of the pixels of each plane (None uses all of them)
+        precision               : precision of the smoothed planes (float32 or float64, see smooth_image)
+        plane_workers           : number of planes segmented at a time
+        plane_pool              : thread- the planes are read from the stack in place (the smoothing and the thresholding release the GIL),
+                                  process- each plane is sent to a worker process (labelling runs fully in parallel)
+        li_histogram            : compute Li from a fine histogram of each smoothed plane instead of its pixels (see thresholds_from_image)
+
+    Returns:
+        A labelled stack
+    """
+    
+    if plane_pool not in PLANE_POOLS:
+        raise Exception('Invalid input for plane_pool: should be among {"thread","process"}')
+    if plane_workers < 1:
+        raise Exception('Invalid input for plane_workers: should be a positive integer')
+    
+    planes = stack.reshape((-1,) + stack.shape[-2:])
+    segment_plane = partial(simple_intensity_based_segmentation, gaussian_sigma = gaussian_sigma, thresh_method = thresh_method,
+                            smallest_area_of_object = smallest_area_of_object, label_img_depth = "16bit",
+                            thresh_sample_fraction = thresh_sample_fraction, precision = precision, li_histogram = li_histogram)
+    
+    if (plane_workers == 1):
+        plane_labels = [segment_plane(plane) for plane in planes]
     else:
-        raise Exception('Invalid input: should be among {8bit, 16bit}')
+        pool = ThreadPoolExecutor if plane_pool == "thread" else ProcessPoolExecutor
+        with pool(max_workers = plane_workers) as executor:
+            plane_labels = list(executor.map(segment_plane, planes))
     
-    return label_image_cor
-    
\ No newline at end of file
+    # the labels of a plane start after those of the previous planes
+    n_objects = np.array([int(np.max(labels, initial = 0)) for labels in plane_labels], dtype = np.int64)
+    offsets = np.concatenate([[0], np.cumsum(n_objects)[:-1]])
+    label_stack = np.empty(planes.shape, dtype = label_image_dtype(int(n_objects.sum()), label_img_depth))
+    for plane_index, labels in enumerate(plane_labels):
+        plane = label_stack[plane_index]
+        plane[...] = labels
+        plane[labels > 0] += int(offsets[plane_index])
+        plane_labels[plane_index] = None
+    
+    return label_stack.reshape(stack.shape)
+
+def sweep_intensity_based_segmentation(image, gaussian_sigmas = (1,), thresh_methods = ("Otsu",), smallest_areas_of_object = (5,),
+                                       label_img_depth = "8bit", thresh_sample_fraction = None, precision = "float32", li_histogram = False):
+    """Perform intensity based segmentation with every combination of parameters, reusing the intermediate results
+    
+    The image is smoothed once per sigma, all the thresholds of a smoothed image are computed from a single histogram and
+    each threshold labels the image once for all the areas (see label_components). Each combination gives the same labels
+    as simple_intensity_based_segmentation.
+    
+    Args:
+        image                    : image to segment
+        gaussian_sigmas          : sigmas to use for the gaussian filter
+        thresh_methods           : threshold methods
+        smallest_areas_of_object : smallest areas of objects in pixels
+        label_img_depth          : label depth
+        thresh_sample_fraction   : estimate the thresholds from this fraction of the pixels (None uses all of them)
+        precision                : precision of the smoothed image (float32 or float64, see smooth_image)
+        li_histogram             : compute Li from a fine histogram of the smoothed image instead of its pixels (see thresholds_from_image)
+
+    Returns:
+        A generator of (sigma, threshold method, smallest area, threshold, labelled image), the threshold and the labelled image
+        are None if the threshold could not be computed (e.g. Minimum on a unimodal histogram)
+    """
+    
+    for gaussian_sigma in gaussian_sigmas:
+        # apply a gaussian filter
+        with profile_stage("gaussian"):
+            image_smooth = smooth_image(image, gaussian_sigma, precision)
+        
+        # compute all the thresholds from one histogram
+        with profile_stage("threshold"):
+            thresholds = thresholds_from_image(image_smooth, thresh_methods, thresh_sample_fraction, skip_failed = True,
+                                               li_histogram = li_histogram)
+        
+        for thresh_method in thresh_methods:
+            thresh = thresholds[thresh_method]
+            if thresh is None:
+                for smallest_area_of_object in smallest_areas_of_object:
+                    yield gaussian_sigma, thresh_method, smallest_area_of_object, None, None
+                continue
+            
+            #label the components once and filter them for each area
+            with profile_stage("label"):
+                components, areas, diagonal_pairs = face_connected_components(image_smooth > thresh)
+            for smallest_area_of_object in smallest_areas_of_object:
+                with profile_stage("label"):
+                    label_image = label_components(components, areas, diagonal_pairs, smallest_area_of_object, label_img_depth)
+                yield gaussian_sigma, thresh_method, smallest_area_of_object, thresh, label_image
+            del components
+        
+        del image_smooth
@@ -1,51 +1,210 @@
 # -*- coding: utf-8 -*-
 from pathlib import Path
 import os
+import csv
 from glob import glob
-from tifffile import imread, imsave
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from src.basic_image_processing_tasks import simple_intensity_based_segmentation
-from src.interactive_segmentation import correcting_annotation_large_image,correcting_annotation,generate_labels_large_image,generate_labels
+from annotate.basic_image_processing_tasks import simple_intensity_based_segmentation, sweep_intensity_based_segmentation, plane_intensity_based_segmentation
+from annotate.basic_image_processing_tasks import STACK_MODES
+from annotate.tiled_segmentation import tiled_intensity_based_segmentation
+from annotate.image_io import read_image_channel, read_image_axes, drop_channel_axis
+from annotate.label_output import output_extension, check_output_format, write_label_image, write_label_tiles
+from annotate.pipeline import run_pipeline
+from annotate.interactive_segmentation import load_annotation_session, run_annotation_session, close_annotation_viewer
+from annotate.interactive_segmentation import load_region_overview, run_region_session, run_correction_session, write_region_corrections
+from annotate.display_cache import DEFAULT_MAX_CACHE_SIZE
+from annotate.profiling import profile_file, profile_stage, is_profiling, run_profiled, add_records
+from annotate.manifest import load_manifest, save_manifest, is_up_to_date, record_output
+from annotate.scheduler import build_image_index, plan_jobs, run_scheduled
+from annotate.measurements import (check_measurement_format, measurements_path, new_measurements, measure_objects, measure_tiles, measurement_table,
+                                   write_measurements, read_measurements, summarize_measurements, write_measurement_summary)
+
+def _output_path(path_to_output_dir:str, raw_image_path:str, output_format:str = "tif"):
+    """Path of the output image of a raw image (same file name in the output directory, see output_extension)"""
+    img_name = os.path.splitext(os.path.basename(raw_image_path))[0]
+    return path_to_output_dir+"/"+img_name+output_extension(output_format)
+
+def _tile_writer(output_path:str, tile_size:int = None, output_format:str = "tif", compression:str = None):
+    """Function writing the labels of a tiled segmentation tile by tile (None if the labels have to be assembled in memory first)"""
+    if (tile_size is None or output_format == "tif"):
+        return None
+    return lambda shape, dtype, tiles: write_label_tiles(output_path, shape, dtype, tiles, tile_size, output_format, compression)
+
+def _profiled_call(stage:str, raw_image_path:str, func, *args, **kwargs):
+    """Call a function, recording it as a stage of an image when profiling is on (see annotate.profiling)"""
+    with profile_file(raw_image_path), profile_stage(stage):
+        return func(*args, **kwargs)
+
+def _label_axes(raw_image_path:str, labels):
+    """Axes of the label stack of a raw image (None for 2D labels, see write_label_image)"""
+    if (labels.ndim == 2):
+        return None
+    return drop_channel_axis(read_image_axes(raw_image_path))
+
+def _max_label_ndim(path_to_raw_images:list):
+    """Largest number of dimensions of the labels of a batch, read from the image headers (2 for a batch of 2D images)"""
+    label_ndim = 2
+    for raw_image_path in path_to_raw_images:
+        try:
+            label_ndim = max(label_ndim, len(drop_channel_axis(read_image_axes(raw_image_path))))
+        except Exception:
+            # unreadable images are reported with the failures of the batch
+            pass
+    return label_ndim
+
+def _check_segmentation_outputs(path_to_raw_images:list, output_format:str = "tif", tile_size:int = None, compression:str = None,
+                                measurements:str = None):
+    """Check that the labels (and measurements) of a batch can be written before segmenting anything"""
+    label_ndim = _max_label_ndim(path_to_raw_images)
+    check_output_format(output_format, tile_size, compression, label_ndim)
+    if measurements is not None:
+        check_measurement_format(measurements)
+        if (label_ndim > 2):
+            raise Exception('Objects of stacks are not measured, segment them without measurements')
+
+def _annotation_path(path_to_annotations:str, raw_image_path:str):
+    """Path of the annotations of a raw image: a TIFF, or sparse labels if there is no TIFF (see annotate.sparse_labels)"""
+    tif_path = _output_path(path_to_annotations, raw_image_path)
+    sparse_path = _output_path(path_to_annotations, raw_image_path, "sparse")
+    if (not os.path.exists(tif_path) and os.path.exists(sparse_path)):
+        return sparse_path
+    return tif_path
+
+def _check_annotation_format(output_format:str, path_to_raw_images:list = []):
+    """Annotations and corrections are written as TIFFs or sparse labels (the formats they can be read back from)"""
+    if output_format not in ("tif", "sparse"):
+        raise Exception('Invalid input for output_format: should be among {"tif","sparse"}')
+    # checked before the sessions so that stacks are not annotated for nothing
+    check_output_format(output_format, label_ndim = _max_label_ndim(path_to_raw_images))
+
+def _input_paths(raw_image_path:str, path_to_uncorrected_annotations:str = None):
+    """Paths to the files the output of a raw image is computed from (the raw image and its uncorrected annotations if any)"""
+    if path_to_uncorrected_annotations is None:
+        return [raw_image_path]
+    return [raw_image_path, _annotation_path(path_to_uncorrected_annotations, raw_image_path)]
+
+def _extra_outputs(raw_image_path:str, path_to_output_dir:str, measurements:str = None):
+    """Paths to the files written along with the labels of a raw image (its measurement table if the objects are measured)"""
+    if measurements is None:
+        return []
+    return [measurements_path(path_to_output_dir, raw_image_path, measurements)]
+
+def _pending_images(path_to_raw_images:list, path_to_output_dir:str, manifest:dict, params:dict, resume:bool = True,
+                    path_to_uncorrected_annotations:str = None, output_format:str = "tif", measurements:str = None):
+    """Images of a batch whose output (or measurement table) is missing or out of date according to the manifest
+    (all of them if resume is False)"""
+    if not resume:
+        return list(path_to_raw_images)
+    
+    pending_images = [raw_image_path for raw_image_path in path_to_raw_images
+                      if not is_up_to_date(manifest, _output_path(path_to_output_dir, raw_image_path, output_format),
+                                           _input_paths(raw_image_path, path_to_uncorrected_annotations), params,
+                                           _extra_outputs(raw_image_path, path_to_output_dir, measurements))]
+    
+    # keep the modification times of inputs that were touched but not changed
+    if manifest:
+        save_manifest(path_to_output_dir, manifest)
+    
+    return pending_images
+
+def _write_output(raw_image_path:str, labels, path_to_output_dir:str, manifest:dict, params:dict,
+                  path_to_uncorrected_annotations:str = None, output_format:str = "tif", compression:str = None,
+                  measurements:str = None):
+    """Write the labels of a raw image to the output directory and record them in the manifest (with their measurement table)
+    
+    labels is None if they were already written tile by tile (see _tile_writer)
+    """
+    output_path = _output_path(path_to_output_dir, raw_image_path, output_format)
+    if labels is not None:
+        _profiled_call("write", raw_image_path, write_label_image, output_path, labels, output_format, compression,
+                       _label_axes(raw_image_path, labels))
+    record_output(manifest, path_to_output_dir, output_path, _input_paths(raw_image_path, path_to_uncorrected_annotations), params,
+                  _extra_outputs(raw_image_path, path_to_output_dir, measurements))
+
+def _region_labels_path(raw_image_path:str, path_to_uncorrected_annotations:str, path_to_output_dir:str, output_format:str = "tif"):
+    """Labels whose regions are corrected: the output of a previous session if there is one, the uncorrected annotations otherwise"""
+    output_path = _output_path(path_to_output_dir, raw_image_path, output_format)
+    if os.path.exists(output_path):
+        return output_path
+    return _annotation_path(path_to_uncorrected_annotations, raw_image_path)
+
+def _write_region_output(raw_image_path:str, corrections:list, path_to_uncorrected_annotations:str, path_to_output_dir:str,
+                         manifest:dict, params:dict, label_img_depth:str = None, overwrite_output:bool = False, output_format:str = "tif"):
+    """Write the corrected regions of a raw image into its output labels and record them in the manifest"""
+    output_path = _output_path(path_to_output_dir, raw_image_path, output_format)
+    _profiled_call("write", raw_image_path, write_region_corrections, _annotation_path(path_to_uncorrected_annotations, raw_image_path),
+                   output_path, corrections, label_img_depth, overwrite_output)
+    record_output(manifest, path_to_output_dir, output_path, _input_paths(raw_image_path, path_to_uncorrected_annotations), params)
+
+def _report_failures(failed_images:dict, n_images:int, task:str):
+    """Raise a single exception listing all the images of a batch that failed"""
+    if failed_images:
+        error_summary = "\n".join(path + ": " + repr(err) for path, err in sorted(failed_images.items()))
+        raise Exception(task + " failed for " + str(len(failed_images)) + " of " + str(n_images) + " images:\n" + error_summary)
 
 def generate_annotation_labels_batch(path_to_input_dir:str,
                                      path_to_output_dir:str,
                                      large_image:str = "no",
                                      anno_img_depth:str = "8bit",
-                                     scale_factor:int = 10):
+                                     scale_factor:int = 10,
+                                     cache_dir:str = None,
+                                     max_cache_size:int = DEFAULT_MAX_CACHE_SIZE,
+                                     prefetch:int = 1,
+                                     resume:bool = True,
+                                     output_format:str = "tif"):
     
     """Generate annotation of all images in folder
     
     Args:
         path_to_raw_images              : path to raw images to use as guide
         path_to_output_dir              : path to the output directory 
-        large_image                     : is the image large? (yes/no- performs resizing)
+        large_image                     : is the image large? (yes/no- performs resizing, pyramid- annotates at full resolution)
         anno_img_depth                  : depth of the output image 
         scale_factor                    : resizing factor
+        cache_dir                       : directory to cache downsized images in for large images (None disables the cache)
+        max_cache_size                  : size limit of the cache directory in bytes
+        prefetch                        : number of images to load in the background while the current one is being annotated
+        resume                          : skip the images that were already annotated with the same parameters (see annotate.manifest)
+        output_format                   : write the labels as TIFFs (tif) or sparse labels (sparse, see annotate.sparse_labels)
+    
+    All the images are annotated in the same napari window, press Shift-N (or close the window) to move on to the next image.
+    The annotated images are recorded in the manifest of the output directory as soon as they are written, so a session that
+    was stopped halfway carries on from the first image that was not annotated.
     """
     
-    # Make sure that the output directory exists-if not create it. 
-    Path(path_to_output_dir).mkdir(parents=True, exist_ok=True)
-
+    if large_image not in ("yes", "pyramid", "no"):
+        raise Exception('Invalid inpur for large_image: should be among {"yes","pyramid","no"}')
     # Extract the paths to images (assumed here to be TIF)
     path_to_raw_images = sorted(glob(path_to_input_dir + "*.tif"))
+    _check_annotation_format(output_format, path_to_raw_images)
     
-    for i in range(len(path_to_raw_images)):
-        #Extract the file name
-        img_name = os.path.splitext(os.path.basename(path_to_raw_images[i]))[0]
-        
-        #correct annotation
-        if(large_image == "yes"):
-            corrected_labels =  generate_labels_large_image(path_to_raw_images[i],
-                                              label_img_depth = anno_img_depth,
-                                              resize_factor = scale_factor)
-        elif(large_image == "no"):
-            corrected_labels =  generate_labels(path_to_raw_images[i],
-                                              label_img_depth = anno_img_depth)
-        else:
-            raise Exception('Invalid inpur for large_image: should be among {"yes","no"}')
-                                              
-        #Write the image to the user defined output directory
-        imsave(path_to_output_dir+"/"+img_name+".tif", corrected_labels) 
+    # Make sure that the output directory exists-if not create it. 
+    Path(path_to_output_dir).mkdir(parents=True, exist_ok=True)
+    
+    # skip the images annotated by a previous session
+    manifest = load_manifest(path_to_output_dir)
+    annotation_params = dict(task = "annotation", large_image = large_image, anno_img_depth = anno_img_depth, scale_factor = scale_factor)
+    pending_images = _pending_images(path_to_raw_images, path_to_output_dir, manifest, annotation_params, resume,
+                                     output_format = output_format)
+    
+    # load the next images while the current one is annotated and write the labels in the background
+    failed_images = run_pipeline(pending_images,
+                                 read_item = lambda raw_image_path: _profiled_call("read", raw_image_path, load_annotation_session,
+                                                                                   raw_image_path,
+                                                                                   large_image = large_image,
+                                                                                   resize_factor = scale_factor,
+                                                                                   cache_dir = cache_dir,
+                                                                                   max_cache_size = max_cache_size),
+                                 process_item = lambda raw_image_path, session: _profiled_call("annotate", raw_image_path, run_annotation_session,
+                                                                                               session, anno_img_depth, reuse_viewer = True),
+                                 write_item = lambda raw_image_path, labels: _write_output(raw_image_path, labels, path_to_output_dir,
+                                                                                           manifest, annotation_params,
+                                                                                           output_format = output_format),
+                                 prefetch = prefetch)
+    close_annotation_viewer()
+    
+    _report_failures(failed_images, len(path_to_raw_images), "Annotation")
         
 
 
@@ -54,54 +213,344 @@ def correct_annotation_labels_batch(path_to_input_dir:str,
                                     path_to_output_dir:str,
                                     large_image:str = "no", 
                                     anno_img_depth:str = "8bit",
-                                    scale_factor:int = 10):
+                                    scale_factor:int = 10,
+                                    cache_dir:str = None,
+                                    max_cache_size:int = DEFAULT_MAX_CACHE_SIZE,
+                                    prefetch:int = 1,
+                                    resume:bool = True,
+                                    output_format:str = "tif"):
     
     """Correct annotation of all images in folder
     
     Args:
         path_to_raw_images              : path to raw images to use as guide
-        path_to_uncorrected_annotations : path to uncorrected annotated images
+        path_to_uncorrected_annotations : path to uncorrected annotated images (TIFFs or sparse labels)
         path_to_output_dir              : path to the output directory 
-        large_image                     : is the image large? (yes- performs resizing)
-        anno_img_depth                  : depth of the output image 
+        large_image                     : is the image large? (yes- performs resizing, pyramid- corrects at full resolution,
+                                          roi- corrects regions picked on an overview at full resolution)
+        anno_img_depth                  : depth of the output image (roi keeps the depth of the uncorrected annotations)
         scale_factor                    : resizing factor
+        cache_dir                       : directory to cache downsized images in for large images (None disables the cache)
+        max_cache_size                  : size limit of the cache directory in bytes
+        prefetch                        : number of images to load in the background while the current one is being corrected
+        resume                          : skip the images that were already corrected from the same annotations with the same parameters
+        output_format                   : write the corrected labels as TIFFs (tif) or sparse labels (sparse, see annotate.sparse_labels)
+    
+    All the images are corrected in the same napari window, press Shift-N (or close the window) to move on to the next image.
+    The corrected images are recorded in the manifest of the output directory as soon as they are written (see annotate.manifest),
+    an image is corrected again if its raw image or its uncorrected annotations change.
+    
+    With large_image = "yes", only the tiles that were edited are upsampled and written into a copy of the uncorrected
+    annotations (see run_correction_session), the labels that were not edited keep their full resolution.
+    
+    With large_image = "roi", draw rectangles around the regions to correct on the overview of each image, each region is then
+    corrected at full resolution and only its window is written back (see run_region_session). Rerunning with resume = False
+    corrects more regions on top of the existing corrections.
     """
     
+    if large_image not in ("yes", "pyramid", "roi", "no"):
+        raise Exception('Invalid inpur for large_image: should be among {"yes","pyramid","roi","no"}')
+    # Extract the paths to images (assumed here to be TIF)
+    path_to_raw_images = sorted(glob(path_to_input_dir + "*.tif"))
+    _check_annotation_format(output_format, path_to_raw_images)
+    
     # Make sure that the output directory exists-if not create it. 
     Path(path_to_output_dir).mkdir(parents=True, exist_ok=True)
+    
+    # skip the images corrected by a previous session
+    manifest = load_manifest(path_to_output_dir)
+    correction_params = dict(task = "correction", large_image = large_image, anno_img_depth = anno_img_depth, scale_factor = scale_factor)
+    pending_images = _pending_images(path_to_raw_images, path_to_output_dir, manifest, correction_params, resume,
+                                     path_to_uncorrected_annotations, output_format)
+    
+    if (large_image == "roi"):
+        # load the next overviews while the regions of the current image are corrected and write the regions in the background
+        failed_images = run_pipeline(pending_images,
+                                     read_item = lambda raw_image_path: _profiled_call("read", raw_image_path, load_region_overview,
+                                                                                       raw_image_path,
+                                                                                       _region_labels_path(raw_image_path, path_to_uncorrected_annotations,
+                                                                                                           path_to_output_dir, output_format),
+                                                                                       resize_factor = scale_factor,
+                                                                                       cache_dir = cache_dir,
+                                                                                       max_cache_size = max_cache_size),
+                                     process_item = lambda raw_image_path, overview: _profiled_call("annotate", raw_image_path, run_region_session,
+                                                                                                    overview, raw_image_path,
+                                                                                                    _region_labels_path(raw_image_path, path_to_uncorrected_annotations,
+                                                                                                                        path_to_output_dir, output_format),
+                                                                                                    reuse_viewer = True),
+                                     write_item = lambda raw_image_path, corrections: _write_region_output(raw_image_path, corrections,
+                                                                                                           path_to_uncorrected_annotations,
+                                                                                                           path_to_output_dir,
+                                                                                                           manifest, correction_params,
+                                                                                                           output_format = output_format),
+                                     prefetch = prefetch)
+    elif (large_image == "yes"):
+        # load the next downsized images while the current one is corrected and write the edited tiles in the background
+        failed_images = run_pipeline(pending_images,
+                                     read_item = lambda raw_image_path: _profiled_call("read", raw_image_path, load_annotation_session,
+                                                                                       raw_image_path,
+                                                                                       _annotation_path(path_to_uncorrected_annotations, raw_image_path),
+                                                                                       large_image = large_image,
+                                                                                       resize_factor = scale_factor,
+                                                                                       cache_dir = cache_dir,
+                                                                                       max_cache_size = max_cache_size),
+                                     process_item = lambda raw_image_path, session: _profiled_call("annotate", raw_image_path, run_correction_session,
+                                                                                                   session, reuse_viewer = True),
+                                     write_item = lambda raw_image_path, corrections: _write_region_output(raw_image_path, corrections,
+                                                                                                           path_to_uncorrected_annotations,
+                                                                                                           path_to_output_dir,
+                                                                                                           manifest, correction_params,
+                                                                                                           anno_img_depth, overwrite_output = True,
+                                                                                                           output_format = output_format),
+                                     prefetch = prefetch)
+    else:
+        # load the next images (and their uncorrected labels) while the current one is corrected and write the labels in the background
+        failed_images = run_pipeline(pending_images,
+                                     read_item = lambda raw_image_path: _profiled_call("read", raw_image_path, load_annotation_session,
+                                                                                       raw_image_path,
+                                                                                       _annotation_path(path_to_uncorrected_annotations, raw_image_path),
+                                                                                       large_image = large_image,
+                                                                                       resize_factor = scale_factor,
+                                                                                       cache_dir = cache_dir,
+                                                                                       max_cache_size = max_cache_size),
+                                     process_item = lambda raw_image_path, session: _profiled_call("annotate", raw_image_path, run_annotation_session,
+                                                                                                   session, anno_img_depth, reuse_viewer = True),
+                                     write_item = lambda raw_image_path, labels: _write_output(raw_image_path, labels, path_to_output_dir,
+                                                                                               manifest, correction_params,
+                                                                                               path_to_uncorrected_annotations, output_format),
+                                     prefetch = prefetch)
+    close_annotation_viewer()
+    
+    _report_failures(failed_images, len(path_to_raw_images), "Correction")
 
-    # Extract the paths to images (assumed here to be TIF)
-    path_to_raw_images = sorted(glob(path_to_input_dir + "*.tif"))
+
+
+def read_segmentation_input(raw_image_path:str, tile_size:int = None, channel:int = None):
+    """ Read an image to segment
     
-    for i in range(len(path_to_raw_images)):
-        #Extract the file name
-        img_name = os.path.splitext(os.path.basename(path_to_raw_images[i]))[0]
-        
-        #correct annotation
-        if(large_image == "yes"):
-            corrected_labels =  correcting_annotation_large_image(path_to_raw_images[i],
-                                              path_to_uncorrected_annotations+"/"+ img_name +".tif",
-                                              label_img_depth = anno_img_depth,
-                                              resize_factor = scale_factor)
-        elif(large_image == "no"):
-            corrected_labels =  correcting_annotation(path_to_raw_images[i],
-                                              path_to_uncorrected_annotations+"/"+ img_name +".tif",
-                                              label_img_depth = anno_img_depth)
-        else:
-            raise Exception('Invalid inpur for large_image: should be among {"yes","no"}')
-            
-                                              
-        #Write the image to the user defined output directory
-        imsave(path_to_output_dir+"/"+img_name+".tif", corrected_labels)                                      
+    Args:
+        raw_image_path : path to a raw image (2D, a stack or multichannel, e.g. YX, ZYX or CZYX)
+        tile_size      : size of the tiles if the image is segmented in tiles (the image is then opened lazily)
+        channel        : channel to segment in multichannel images (only that channel is read if the image can be memory-mapped)
+
+    Returns:
+        The image
+    """
+    #Read in the image (the tiled segmentation only reads the tiles it needs)
+    return read_image_channel(raw_image_path, channel, lazy = tile_size is not None)[0]
+
+def segment_image(raw_img,
+                  fil_sigma:float = 1,
+                  threshold_method:str ="Otsu",
+                  smallest_object_area:int = 5,
+                  label_img_depth:str = "8bit",
+                  tile_size:int = None,
+                  thresh_sample_fraction:float = None,
+                  precision:str = "float32",
+                  stack_mode:str = "3d",
+                  plane_workers:int = 1,
+                  plane_pool:str = "thread",
+                  li_histogram:bool = False,
+                  write_tiles = None):
+    """ Segment objects in an image
+     
+    Args:
+        raw_img            : raw image
+        fil_sigma          : sigma to use for the gaussian filter
+        threshold_method   : threshold method
+        smallest_object_area : smallest area of objects in pixels
+        label_img_depth         : label depth
+        tile_size          : segment the image in tiles of this size (None segments the whole image at once)
+        thresh_sample_fraction : estimate the threshold from this fraction of the pixels (None uses all of them)
+        precision          : precision of the smoothed image (float32 or float64)
+        stack_mode         : segmentation of stacks, 3d- the whole ZYX stack at once (sigma and areas are then in voxels),
+                             planes- each plane on its own (see plane_intensity_based_segmentation)
+        plane_workers      : number of planes segmented at a time in planes mode
+        plane_pool         : run the planes in threads (thread) or worker processes (process)
+        li_histogram       : compute Li from a fine histogram of the smoothed image instead of its pixels (see thresholds_from_image)
+        write_tiles        : write the labels of a tiled segmentation tile by tile with this function instead of returning them
+                             (see tiled_intensity_based_segmentation)
 
+    Returns:
+        A labelled image (None if it was written by write_tiles)
+    """
+    if (raw_img.ndim > 2):
+        if stack_mode not in STACK_MODES:
+            raise Exception('Invalid input for stack_mode: should be among {"3d","planes"}')
+        if tile_size is not None:
+            raise Exception('Stacks are not segmented in tiles, segment them without tile_size')
+        if (stack_mode == "3d" and raw_img.ndim > 3):
+            raise Exception('Only ZYX stacks can be segmented in 3d, segment the planes of ' + str(raw_img.ndim) + 'D stacks (stack_mode planes)')
+    
+    if (raw_img.ndim > 2 and stack_mode == "planes"):
+        return plane_intensity_based_segmentation(raw_img,
+                                                  gaussian_sigma=fil_sigma,
+                                                  thresh_method=threshold_method,
+                                                  smallest_area_of_object=smallest_object_area,
+                                                  label_img_depth=label_img_depth,
+                                                  thresh_sample_fraction=thresh_sample_fraction,
+                                                  precision=precision,
+                                                  plane_workers=plane_workers,
+                                                  plane_pool=plane_pool,
+                                                  li_histogram=li_histogram)
+    elif tile_size is None:
+        return simple_intensity_based_segmentation(raw_img, 
+                                                   gaussian_sigma=fil_sigma,
+                                                   thresh_method=threshold_method,
+                                                   smallest_area_of_object=smallest_object_area,
+                                                   label_img_depth=label_img_depth,
+                                                   thresh_sample_fraction=thresh_sample_fraction,
+                                                   precision=precision,
+                                                   li_histogram=li_histogram)
+    else:
+        return tiled_intensity_based_segmentation(raw_img, 
+                                                  gaussian_sigma=fil_sigma,
+                                                  thresh_method=threshold_method,
+                                                  smallest_area_of_object=smallest_object_area,
+                                                  label_img_depth=label_img_depth,
+                                                  tile_size=tile_size,
+                                                  thresh_sample_fraction=thresh_sample_fraction,
+                                                  precision=precision,
+                                                  write_tiles=write_tiles,
+                                                  li_histogram=li_histogram)
 
+def _segment_for_output(raw_image_path:str, raw_img, path_to_output_dir:str, output_format:str = "tif", compression:str = None,
+                        measurements:str = None, **segmentation_params):
+    """Segment a raw image for the output directory (see segment_image_file)
+    
+    Tiled segmentations in the tiled formats are written tile by tile (None is then returned instead of the labels),
+    and the objects are measured from the labels in memory (or from each tile as it is written) if measurements is csv or parquet.
+    """
+    output_path = _output_path(path_to_output_dir, raw_image_path, output_format)
+    write_tiles = _tile_writer(output_path, segmentation_params.get("tile_size"), output_format, compression)
+    
+    tile_measurements = None
+    if (measurements is not None and write_tiles is not None):
+        tile_measurements = new_measurements()
+        write_labels = write_tiles
+        write_tiles = lambda shape, dtype, tiles: write_labels(shape, dtype, measure_tiles(tiles, raw_img, tile_measurements))
+    
+    labelled_image = _profiled_call("segment", raw_image_path, segment_image, raw_img, write_tiles = write_tiles, **segmentation_params)
+    
+    if (measurements is not None and labelled_image is not None and labelled_image.ndim > 2):
+        raise Exception('Objects of stacks are not measured, segment them without measurements')
+    if measurements is not None:
+        with profile_file(raw_image_path), profile_stage("measure"):
+            table = measurement_table(tile_measurements) if tile_measurements is not None else measure_objects(labelled_image, raw_img)
+            write_measurements(measurements_path(path_to_output_dir, raw_image_path, measurements), table)
+    
+    return labelled_image
+
+def segment_image_file(raw_image_path:str,
+                       path_to_output_dir:str,
+                       fil_sigma:float = 1,
+                       threshold_method:str ="Otsu",
+                       smallest_object_area:int = 5,
+                       label_img_depth:str = "8bit",
+                       tile_size:int = None,
+                       thresh_sample_fraction:float = None,
+                       precision:str = "float32",
+                       stack_mode:str = "3d",
+                       plane_workers:int = 1,
+                       plane_pool:str = "thread",
+                       li_histogram:bool = False,
+                       channel:int = None,
+                       output_format:str = "tif",
+                       compression:str = None,
+                       measurements:str = None):
+    """ Segment objects in a single image and write the labels to the output directory
+     
+    Args:
+        raw_image_path     : path to a raw image (2D, a stack or multichannel, stacks are written as a single label stack)
+        path_to_output_dir : path to the output directory 
+        fil_sigma          : sigma to use for the gaussian filter
+        threshold_method   : threshold method
+        smallest_object_area : smallest area of objects in pixels
+        label_img_depth         : label depth
+        tile_size          : segment the image in tiles of this size (None segments the whole image at once)
+        thresh_sample_fraction : estimate the threshold from this fraction of the pixels (None uses all of them)
+        precision          : precision of the smoothed image (float32 or float64)
+        stack_mode         : segmentation of stacks (3d or planes, see segment_image)
+        plane_workers      : number of planes segmented at a time in planes mode
+        plane_pool         : run the planes in threads (thread) or worker processes (process)
+        li_histogram       : compute Li from a fine histogram of the smoothed image instead of its pixels (see thresholds_from_image)
+        channel            : channel to segment in multichannel images (None if the images have a single channel)
+        output_format      : tif, tiled_tif or ome_zarr (see annotate.label_output), tiled segmentations are written tile by tile
+                             in the tiled formats
+        compression        : compression of the output (none, zlib, zstd or lzma, None is zlib for the tiled formats)
+        measurements       : write the area, centroid, bounding box and mean/max intensity of each object to a csv or parquet
+                             table next to the labels (see annotate.measurements), None does not measure the objects
+
+    Returns:
+        Path to the written label image
+    """
+    raw_img = _profiled_call("read", raw_image_path, read_segmentation_input, raw_image_path, tile_size, channel)
+    output_path = _output_path(path_to_output_dir, raw_image_path, output_format)
+    
+    #segment_image (and measure the objects while the raw image is in memory)
+    labelled_image = _segment_for_output(raw_image_path, raw_img, path_to_output_dir, output_format, compression, measurements,
+                                         fil_sigma = fil_sigma,
+                                         threshold_method = threshold_method,
+                                         smallest_object_area = smallest_object_area,
+                                         label_img_depth = label_img_depth,
+                                         tile_size = tile_size,
+                                         thresh_sample_fraction = thresh_sample_fraction,
+                                         precision = precision,
+                                         stack_mode = stack_mode,
+                                         plane_workers = plane_workers,
+                                         plane_pool = plane_pool,
+                                         li_histogram = li_histogram)
+
+    #Write the image to the user defined output directory
+    if labelled_image is not None:
+        _profiled_call("write", raw_image_path, write_label_image, output_path, labelled_image, output_format, compression,
+                       _label_axes(raw_image_path, labelled_image))
+    
+    return output_path
+
+def _submit_segmentation(pool, raw_image_path:str, path_to_output_dir:str, profile_workers:bool = False, **kwargs):
+    """Submit segment_image_file to a process pool, recording its stages in the worker when profiling (see run_profiled)"""
+    if profile_workers:
+        return pool.submit(run_profiled, segment_image_file, raw_image_path, path_to_output_dir, **kwargs)
+    return pool.submit(segment_image_file, raw_image_path, path_to_output_dir, **kwargs)
+
+def _collect_segmentation(future, raw_image_path:str, path_to_output_dir:str, manifest:dict, params:dict, failed_images:dict,
+                          profile_workers:bool = False, measurements:str = None):
+    """Record the output of a segmentation submitted with _submit_segmentation in the manifest (or its error in failed_images)
+    and add the stages recorded in the worker to the profile"""
+    try:
+        result = future.result()
+        output_path = result[0] if profile_workers else result
+        record_output(manifest, path_to_output_dir, output_path, [raw_image_path], params,
+                      _extra_outputs(raw_image_path, path_to_output_dir, measurements))
+    except Exception as err:
+        failed_images[raw_image_path] = err
+        return
+    if profile_workers:
+        add_records(result[1])
 
 def perfrom_simple_intensity_based_segmentation(path_to_input_dir:str,
                                                 path_to_output_dir:str,
                                                 fil_sigma:float = 1,
                                                 threshold_method:str ="Otsu",
                                                 smallest_object_area:int = 5,
-                                                label_img_depth:str = "8bit"):
+                                                label_img_depth:str = "8bit",
+                                                workers:int = 1,
+                                                tile_size:int = None,
+                                                prefetch:int = 0,
+                                                thresh_sample_fraction:float = None,
+                                                precision:str = "float32",
+                                                stack_mode:str = "3d",
+                                                plane_workers:int = 1,
+                                                plane_pool:str = "thread",
+                                                li_histogram:bool = False,
+                                                channel:int = None,
+                                                resume:bool = True,
+                                                output_format:str = "tif",
+                                                compression:str = None,
+                                                measurements:str = None,
+                                                max_memory:int = None,
+                                                worker_memory:int = None):
     """ Segment objects in a given image for all images in a folder
      
     Args:
@@ -111,27 +560,247 @@ def perfrom_simple_intensity_based_segmentation(path_to_input_dir:str,
         threshold_method   : threshold method
         smallest_object_area : smallest area of objects in pixels
         label_img_depth         : label depth
-     
+        workers            : number of processes used to segment images in parallel (1 runs serially)
+        tile_size          : segment each image in tiles of this size to limit memory use (None segments whole images)
+        prefetch           : number of images to read ahead while segmenting (results are written in the background),
+                             0 reads, segments and writes one image after the other.
+                             Only used when workers is 1, parallel workers already overlap reading and writing.
+        thresh_sample_fraction : estimate the threshold of each image from this fraction of its pixels (None uses all of them)
+        precision          : precision of the smoothed images (float32 or float64)
+        stack_mode         : segmentation of stacks (ZYX, CZYX... images), 3d- each stack at once, planes- each plane on its own
+                             (see segment_image), the labels of a stack are written as a single label stack
+        plane_workers      : number of planes of a stack segmented at a time in planes mode
+        plane_pool         : run the planes in threads (thread) or worker processes (process)
+        li_histogram       : compute Li from a fine histogram of each smoothed image instead of its pixels, which needs less memory
+                             but can differ from skimage by a few pixels (see thresholds_from_image)
+        channel            : channel to segment in multichannel images (None if the images have a single channel)
+        resume             : skip the images that were already segmented with the same parameters
+        output_format      : tif, tiled_tif or ome_zarr (see annotate.label_output), tiled segmentations are written tile by tile
+                             in the tiled formats
+        compression        : compression of the outputs (none, zlib, zstd or lzma, None is zlib for the tiled formats)
+        measurements       : measure the objects of each image while it is in memory and write them to a csv or parquet table
+                             next to its labels, along with a summary of the batch in measurements_summary.csv (None does not measure)
+        max_memory         : memory budget of the batch in bytes (None does not schedule the images). The peak memory of each image
+                             is estimated from its TIFF header (see annotate.scheduler), the images that do not fit are segmented
+                             in tiles and the largest images are started first, as many at a time as fit in the budget (at most
+                             workers). Replaces prefetch.
+        worker_memory      : memory of a worker process before it reads an image in bytes, counted in the budget of each image
+                             (None measures it, see annotate.scheduler.measure_worker_memory)
+    
+    Each segmented image is recorded in the manifest of the output directory (see annotate.manifest) along with its measurement
+    table, a rerun only segments the new or changed images and those whose labels or table are missing (or all of them if the
+    parameters changed).
     """
+    
+    if workers < 1:
+        raise Exception('Invalid input for workers: should be a positive integer')
+    if stack_mode not in STACK_MODES:
+        raise Exception('Invalid input for stack_mode: should be among {"3d","planes"}')
+    if (max_memory is not None and max_memory <= 0):
+        raise Exception('Invalid input for max_memory: should be a positive number of bytes')
+
+    # Extract the paths to images (assumed here to be TIF)
+    path_to_raw_images = sorted(glob(path_to_input_dir + "*.tif"))
+
+    # check the output format before doing any work
+    _check_segmentation_outputs(path_to_raw_images, output_format, tile_size, compression, measurements)
 
     # Make sure that the output directory exists-if not create it. 
     Path(path_to_output_dir).mkdir(parents=True, exist_ok=True)
+    
+    segmentation_params = dict(fil_sigma = fil_sigma,
+                               threshold_method = threshold_method,
+                               smallest_object_area = smallest_object_area,
+                               label_img_depth = label_img_depth,
+                               tile_size = tile_size,
+                               thresh_sample_fraction = thresh_sample_fraction,
+                               precision = precision,
+                               stack_mode = stack_mode,
+                               plane_workers = plane_workers,
+                               plane_pool = plane_pool,
+                               li_histogram = li_histogram)
+    
+    # skip the images segmented by a previous run
+    manifest = load_manifest(path_to_output_dir)
+    output_params = dict(output_format = output_format, compression = compression)
+    manifest_params = dict(task = "segmentation", **segmentation_params, **output_params, measurements = measurements, channel = channel)
+    pending_images = _pending_images(path_to_raw_images, path_to_output_dir, manifest, manifest_params, resume,
+                                     output_format = output_format, measurements = measurements)
+    
+    # a failing image should not stop the rest of the batch, collect the errors and report them at the end
+    failed_images = {}
+    
+    if (max_memory is not None):
+        # the tile size of each image is picked from its header, the labels are the same whether it is tiled or not
+        index, failed_images = build_image_index(pending_images)
+        jobs = plan_jobs(index, max_memory, tile_size, streamed_output = output_format != "tif", worker_memory = worker_memory,
+                         fil_sigma = fil_sigma, threshold_method = threshold_method, thresh_sample_fraction = thresh_sample_fraction,
+                         li_histogram = li_histogram, label_img_depth = label_img_depth, precision = precision, stack_mode = stack_mode,
+                         plane_workers = plane_workers)
+        profile_workers = is_profiling()
+        submit_job = lambda pool, job: _submit_segmentation(pool, job["image"], path_to_output_dir, profile_workers,
+                                                            **dict(segmentation_params, tile_size = job["tile_size"]), **output_params,
+                                                            measurements = measurements, channel = channel)
+        for job, future in run_scheduled(jobs, submit_job, max_memory, workers):
+            _collect_segmentation(future, job["image"], path_to_output_dir, manifest, manifest_params, failed_images, profile_workers,
+                                  measurements)
+    elif (workers == 1 and prefetch > 0):
+        failed_images = run_pipeline(pending_images,
+                                     read_item = lambda raw_image_path: _profiled_call("read", raw_image_path, read_segmentation_input,
+                                                                                       raw_image_path, tile_size, channel),
+                                     process_item = lambda raw_image_path, raw_img: _segment_for_output(raw_image_path, raw_img, path_to_output_dir,
+                                                                                                        measurements = measurements,
+                                                                                                        **output_params, **segmentation_params),
+                                     write_item = lambda raw_image_path, labels: _write_output(raw_image_path, labels, path_to_output_dir,
+                                                                                               manifest, manifest_params, **output_params,
+                                                                                               measurements = measurements),
+                                     prefetch = prefetch)
+    elif (workers == 1):
+        for raw_image_path in pending_images:
+            try:
+                output_path = segment_image_file(raw_image_path, path_to_output_dir, **segmentation_params, **output_params,
+                                                 measurements = measurements, channel = channel)
+                record_output(manifest, path_to_output_dir, output_path, [raw_image_path], manifest_params,
+                              _extra_outputs(raw_image_path, path_to_output_dir, measurements))
+            except Exception as err:
+                failed_images[raw_image_path] = err
+    else:
+        # the stages run in the workers are recorded there and sent back with the result
+        profile_workers = is_profiling()
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            futures = {_submit_segmentation(pool, raw_image_path, path_to_output_dir, profile_workers, **segmentation_params, **output_params,
+                                            measurements = measurements, channel = channel): raw_image_path
+                       for raw_image_path in pending_images}
+            for future in as_completed(futures):
+                _collect_segmentation(future, futures[future], path_to_output_dir, manifest, manifest_params, failed_images, profile_workers,
+                                      measurements)
+    
+    # summary of the measurements of every segmented image (including those segmented by a previous run)
+    if measurements is not None:
+        image_summaries = {}
+        for raw_image_path in path_to_raw_images:
+            table_path = measurements_path(path_to_output_dir, raw_image_path, measurements)
+            if (raw_image_path not in failed_images and os.path.exists(table_path)):
+                image_summaries[os.path.basename(raw_image_path)] = summarize_measurements(read_measurements(table_path))
+        write_measurement_summary(path_to_output_dir + "/measurements_summary.csv", image_summaries)
+    
+    _report_failures(failed_images, len(path_to_raw_images), "Segmentation")
+
+def sweep_output_dir(path_to_output_dir:str, fil_sigma:float, threshold_method:str, smallest_object_area:int):
+    """Output directory of one combination of parameters of a sweep (e.g. <output>/sigma_5_Li_area_10000)"""
+    return path_to_output_dir + "/sigma_{:g}_{}_area_{}".format(fil_sigma, threshold_method, smallest_object_area)
 
+def _read_sweep_summary(summary_path:str):
+    """Rows of the summary of a previous sweep (empty if there is none)"""
+    try:
+        with open(summary_path, newline = "") as f:
+            return list(csv.DictReader(f))
+    except FileNotFoundError:
+        return []
+
+def sweep_simple_intensity_based_segmentation(path_to_input_dir:str,
+                                              path_to_output_dir:str,
+                                              fil_sigmas:list = [1],
+                                              threshold_methods:list = ["Otsu"],
+                                              smallest_object_areas:list = [5],
+                                              label_img_depth:str = "8bit",
+                                              thresh_sample_fraction:float = None,
+                                              precision:str = "float32",
+                                              li_histogram:bool = False,
+                                              channel:int = None,
+                                              resume:bool = True,
+                                              output_format:str = "tif",
+                                              compression:str = None):
+    """ Segment all images in a folder with every combination of sigma, threshold method and smallest area
+    
+    Each image is read once, smoothed once per sigma and its thresholds are computed from a single histogram
+    (see sweep_intensity_based_segmentation). The labels of each combination are written to their own directory
+    (see sweep_output_dir) and the threshold and number of objects of each image and combination to sweep_summary.csv.
+     
+    Args:
+        path_to_input_dir     : path to a input directory
+        path_to_output_dir    : path to the output directory 
+        fil_sigmas            : sigmas to use for the gaussian filter
+        threshold_methods     : threshold methods
+        smallest_object_areas : smallest areas of objects in pixels
+        label_img_depth       : label depth
+        thresh_sample_fraction : estimate the thresholds of each image from this fraction of its pixels (None uses all of them)
+        precision             : precision of the smoothed images (float32 or float64)
+        li_histogram          : compute Li from a fine histogram of each smoothed image instead of its pixels (see thresholds_from_image)
+        channel               : channel to segment in multichannel images (None if the images have a single channel)
+        resume                : skip the images already segmented with every combination
+        output_format         : tif, tiled_tif, ome_zarr or sparse (see annotate.label_output)
+        compression           : compression of the outputs (none, zlib, zstd or lzma, None is zlib for the tiled formats)
+    
+    The directory of each combination has its own manifest, with the parameters perfrom_simple_intensity_based_segmentation
+    records, so it can be resumed by either function. Images whose threshold could not be computed for a combination have no
+    output there and are segmented again on the next run.
+    """
+    
     # Extract the paths to images (assumed here to be TIF)
     path_to_raw_images = sorted(glob(path_to_input_dir + "*.tif"))
-    
-    for i in range(len(path_to_raw_images)):
-        #Read in the image
-        raw_img = imread(path_to_raw_images[i])
 
-        #Extract the file name
-        img_name = os.path.splitext(os.path.basename(path_to_raw_images[i]))[0]
-        
-        #segment_image
-        labelled_image = simple_intensity_based_segmentation(raw_img, 
-                                                     gaussian_sigma=fil_sigma,
-                                                     thresh_method=threshold_method,
-                                                     smallest_area_of_object=smallest_object_area)
-
-        #Write the image to the user defined output directory
-        imsave(path_to_output_dir+"/"+img_name+".tif", labelled_image)
\ No newline at end of file
+    # check the output format before doing any work
+    _check_segmentation_outputs(path_to_raw_images, output_format, None, compression)
+
+    # Make sure that the output directory exists-if not create it. 
+    Path(path_to_output_dir).mkdir(parents=True, exist_ok=True)
+    output_params = dict(output_format = output_format, compression = compression)
+    combination_dirs, manifests, manifest_params, pending = {}, {}, {}, {}
+    for fil_sigma in fil_sigmas:
+        for threshold_method in threshold_methods:
+            for smallest_object_area in smallest_object_areas:
+                combination = (fil_sigma, threshold_method, smallest_object_area)
+                combination_dirs[combination] = sweep_output_dir(path_to_output_dir, *combination)
+                Path(combination_dirs[combination]).mkdir(exist_ok=True)
+                manifests[combination] = load_manifest(combination_dirs[combination])
+                manifest_params[combination] = dict(task = "segmentation", fil_sigma = fil_sigma, threshold_method = threshold_method,
+                                                    smallest_object_area = smallest_object_area, label_img_depth = label_img_depth,
+                                                    tile_size = None, thresh_sample_fraction = thresh_sample_fraction, precision = precision,
+                                                    stack_mode = "3d", plane_workers = 1, plane_pool = "thread", li_histogram = li_histogram,
+                                                    **output_params,
+                                                    measurements = None, channel = channel)
+                pending[combination] = set(_pending_images(path_to_raw_images, combination_dirs[combination], manifests[combination],
+                                                           manifest_params[combination], resume, output_format = output_format))
+    
+    # an image is segmented again if any of its combinations is missing or out of date
+    pending_images = [raw_image_path for raw_image_path in path_to_raw_images
+                      if any(raw_image_path in pending_combination for pending_combination in pending.values())]
+    
+    # keep the summary of the images that are not segmented again
+    summary_path = path_to_output_dir + "/sweep_summary.csv"
+    pending_names = {os.path.basename(raw_image_path) for raw_image_path in pending_images}
+    summary = [row for row in (_read_sweep_summary(summary_path) if resume else []) if row["image"] not in pending_names]
+    failed_images = {}
+    for raw_image_path in pending_images:
+        try:
+            raw_img = _profiled_call("read", raw_image_path, read_segmentation_input, raw_image_path, None, channel)
+            if (raw_img.ndim > 3):
+                raise Exception('Only ZYX stacks can be segmented in 3d, sweep the parameters on 2D images or ZYX stacks')
+            with profile_file(raw_image_path):
+                for fil_sigma, threshold_method, smallest_object_area, thresh, labelled_image in sweep_intensity_based_segmentation(
+                        raw_img, fil_sigmas, threshold_methods, smallest_object_areas, label_img_depth, thresh_sample_fraction, precision,
+                        li_histogram):
+                    combination = (fil_sigma, threshold_method, smallest_object_area)
+                    output_path = None
+                    if labelled_image is not None:
+                        output_path = _output_path(combination_dirs[combination], raw_image_path, output_format)
+                        if raw_image_path in pending[combination]:
+                            _write_output(raw_image_path, labelled_image, combination_dirs[combination], manifests[combination],
+                                          manifest_params[combination], **output_params)
+                    summary.append({"image": os.path.basename(raw_image_path), "sigma": fil_sigma, "threshold_method": threshold_method,
+                                    "smallest_area": smallest_object_area, "threshold": thresh,
+                                    "n_objects": None if labelled_image is None else int(labelled_image.max(initial = 0)),
+                                    "output": output_path})
+                    del labelled_image
+        except Exception as err:
+            failed_images[raw_image_path] = err
+    
+    # summary table of the number of objects found by each combination
+    summary.sort(key = lambda row: row["image"])
+    with open(summary_path, "w", newline = "") as f:
+        writer = csv.DictWriter(f, fieldnames = ["image", "sigma", "threshold_method", "smallest_area", "threshold", "n_objects", "output"])
+        writer.writeheader()
+        writer.writerows(summary)
+    
+    _report_failures(failed_images, len(path_to_raw_images), "Parameter sweep")
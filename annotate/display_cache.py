@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+from pathlib import Path
+import numpy as np
+
+from annotate.image_io import open_image, make_display_image, build_pyramid
+
+# default limit on the size of the cache directory (in bytes)
+DEFAULT_MAX_CACHE_SIZE = 2 * 1024**3
+
+# part of the keys of the downsized images, changed when they are computed differently so that older entries are not reused
+# (edge_blocks: the partial blocks along the edges are kept, see annotate.image_io.downsized_shape)
+DOWNSIZING_VERSION = "edge_blocks"
+
+def _cache_key(image_path:str, *params):
+    """Key of a cached image, changes whenever the image file (path, modification time or size) or the parameters change"""
+    stat = os.stat(image_path)
+    key = "|".join([os.path.abspath(image_path), str(stat.st_mtime_ns), str(stat.st_size)] + [str(p) for p in params])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def load_cached_array(cache_dir:str, key:str, mmap_mode:str = None):
+    """Load an array from the cache
+
+    Args:
+        cache_dir : path to the cache directory
+        key       : key of the array
+        mmap_mode : memory-map the array instead of reading it (see np.load)
+    Returns:
+        The cached array or None if it is not in the cache
+    """
+    cache_path = os.path.join(cache_dir, key + ".npy")
+    try:
+        array = np.load(cache_path, mmap_mode = mmap_mode)
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+
+    # mark as recently used (the modification time is used for LRU eviction)
+    os.utime(cache_path)
+    return array
+
+def save_cached_array(cache_dir:str, key:str, array, max_cache_size:int = DEFAULT_MAX_CACHE_SIZE):
+    """Save an array to the cache and evict the least recently used arrays if the cache grows over its size limit
+
+    Args:
+        cache_dir      : path to the cache directory
+        key            : key of the array
+        array          : array to cache
+        max_cache_size : size limit of the cache directory in bytes
+    """
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+    # write to a temporary file first so that an interrupted write never leaves a broken entry
+    cache_path = os.path.join(cache_dir, key + ".npy")
+    tmp_path = os.path.join(cache_dir, key + ".tmp.npy")
+    np.save(tmp_path, array)
+    os.replace(tmp_path, cache_path)
+
+    evict_cache(cache_dir, max_cache_size)
+
+def evict_cache(cache_dir:str, max_cache_size:int = DEFAULT_MAX_CACHE_SIZE):
+    """Remove the least recently used arrays until the cache directory is under its size limit
+
+    Args:
+        cache_dir      : path to the cache directory
+        max_cache_size : size limit of the cache directory in bytes
+    """
+    entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in os.scandir(cache_dir)
+               if entry.is_file() and entry.name.endswith(".npy") and not entry.name.endswith(".tmp.npy")]
+    cache_size = sum(size for _, size, _ in entries)
+
+    for _, size, path in sorted(entries):
+        if cache_size <= max_cache_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+
+def cached_display_image(raw_image_path:str, resize_factor:int = 10, cache_dir:str = None,
+                         max_cache_size:int = DEFAULT_MAX_CACHE_SIZE):
+    """Downsized 8 bit display image of a raw image, read from the cache when possible
+
+    Args:
+        raw_image_path : path to a raw image
+        resize_factor  : resizing factor
+        cache_dir      : path to the cache directory (None disables the cache)
+        max_cache_size : size limit of the cache directory in bytes
+    Returns:
+        The downsized 8 bit image
+    """
+    if cache_dir is None:
+        return make_display_image(open_image(raw_image_path), resize_factor)
+
+    key = _cache_key(raw_image_path, "display", resize_factor, "mean", DOWNSIZING_VERSION)
+    image_resized = load_cached_array(cache_dir, key)
+    if image_resized is None:
+        image_resized = make_display_image(open_image(raw_image_path), resize_factor)
+        save_cached_array(cache_dir, key, image_resized, max_cache_size)
+
+    return image_resized
+
+def cached_pyramid(raw_image_path:str, cache_dir:str = None, max_cache_size:int = DEFAULT_MAX_CACHE_SIZE):
+    """Multiscale pyramid of a raw image (see build_pyramid), with the downsized levels read from the cache when possible
+
+    Args:
+        raw_image_path : path to a raw image
+        cache_dir      : path to the cache directory (None disables the cache)
+        max_cache_size : size limit of the cache directory in bytes
+    Returns:
+        A list of images from the full resolution (opened lazily) to the smallest level
+    """
+    raw_img = open_image(raw_image_path)
+    if cache_dir is None:
+        return build_pyramid(raw_img)
+
+    # the number of levels is stored with the levels so that a partially evicted pyramid is rebuilt
+    key = _cache_key(raw_image_path, "pyramid", DOWNSIZING_VERSION)
+    n_levels = load_cached_array(cache_dir, key + "_levels")
+    if n_levels is not None:
+        levels = [load_cached_array(cache_dir, key + "_" + str(level), mmap_mode = 'r') for level in range(1, int(n_levels) + 1)]
+        if all(level is not None for level in levels):
+            return [raw_img] + levels
+
+    image_pyramid = build_pyramid(raw_img)
+    for level in range(1, len(image_pyramid)):
+        save_cached_array(cache_dir, key + "_" + str(level), image_pyramid[level], max_cache_size)
+    save_cached_array(cache_dir, key + "_levels", np.array(len(image_pyramid) - 1), max_cache_size)
+
+    return image_pyramid
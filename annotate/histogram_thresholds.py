@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+import warnings
+import numpy as np
+import skimage.filters as skfil
+
+THRESHOLD_METHODS = ["Li", "Otsu", "Isodata", "Mean", "Minimum", "Triangle", "Yen"]
+
+# number of bins skimage uses for the histogram based thresholds of float images
+HISTOGRAM_BINS = 256
+
+# Li is not histogram based in skimage, when it is computed from a histogram (li_histogram) use a fine one so that the threshold
+# stays close to the one computed on the pixels
+LI_HISTOGRAM_BINS = 65536
+
+# number of pixels read at a time while building histograms
+HISTOGRAM_CHUNK_PIXELS = 2**22
+
+def threshold_from_histogram(counts, bin_centers, threshold_method = "Otsu", image_mean = None, user_thresh = None, exact_values = False):
+    """Computes a threshold from an intensity histogram instead of the full image
+    
+    The histogram is expected to span the intensity range of the image (as in np.histogram(image, nbins, range=(min, max))),
+    which gives the same thresholds as gen_background_mask for all histogram based methods.
+    
+    Args:
+        counts           : number of pixels in each bin of the histogram
+        bin_centers      : intensity at the center of each bin
+        threshold_method : method to use for identifying lower threshold (default is Otsu)
+        image_mean       : mean intensity of the image (used by Mean and as the initial guess for Li)
+        user_thresh      : user-defined lower threshold
+        exact_values     : does each bin hold a single intensity? (histogram of an integer image, see image_histograms)
+    Returns:
+        The threshold
+    """
+    
+    if (image_mean is None):
+        image_mean = np.average(bin_centers, weights = counts)
+    
+    # extract threshold
+    if (threshold_method == "Li"):
+        thresh = _threshold_li_from_histogram(counts, bin_centers, image_mean, exact_values)
+    elif (threshold_method == "Otsu"):
+        thresh = skfil.threshold_otsu(hist = (counts, bin_centers))
+    elif (threshold_method == "Isodata"):
+        thresh = skfil.threshold_isodata(hist = (counts, bin_centers))
+    elif (threshold_method == "Mean"):
+        thresh = image_mean
+    elif (threshold_method == "Minimum"):
+        thresh = skfil.threshold_minimum(hist = (counts, bin_centers))
+    elif (threshold_method == "Triangle"):
+        thresh = _threshold_triangle_from_histogram(counts, bin_centers)
+    elif (threshold_method == "Yen"):
+        thresh = skfil.threshold_yen(hist = (counts, bin_centers))
+    elif (threshold_method == "Manual"):
+        if user_thresh is None:
+            raise Exception("Manual threshold requires a user-defined threshold value")
+        else:
+            thresh = user_thresh
+    else:
+        raise Exception('Invalid threshold_method: should be among {"Li","Otsu","Isodata","Mean","Minimum","Triangle","Yen", "Manual"}')
+    
+    return thresh
+
+def _threshold_triangle_from_histogram(counts, bin_centers):
+    """Triangle threshold computed from a histogram (follows skimage.filters.threshold_triangle)"""
+    
+    nbins = len(counts)
+    
+    # find peak, lowest and highest gray levels
+    arg_peak_height = np.argmax(counts)
+    peak_height = counts[arg_peak_height]
+    arg_low_level, arg_high_level = np.flatnonzero(counts)[[0, -1]]
+    
+    if (arg_low_level == arg_high_level):
+        return bin_centers[arg_low_level]
+    
+    # flip the histogram if the left tail is shorter
+    flip = arg_peak_height - arg_low_level < arg_high_level - arg_peak_height
+    if flip:
+        counts = counts[::-1]
+        arg_low_level = nbins - arg_high_level - 1
+        arg_peak_height = nbins - arg_peak_height - 1
+    
+    # maximize the distance between the histogram and the line from the peak to the lowest level
+    width = arg_peak_height - arg_low_level
+    x1 = np.arange(width)
+    y1 = counts[x1 + arg_low_level]
+    norm = np.sqrt(peak_height**2 + width**2)
+    peak_height = peak_height / norm
+    width = width / norm
+    length = peak_height * x1 - width * y1
+    arg_level = np.argmax(length) + arg_low_level
+    
+    if flip:
+        arg_level = nbins - arg_level - 1
+    
+    return bin_centers[arg_level]
+
+def _threshold_li_from_histogram(counts, bin_centers, image_mean, exact_values = False):
+    """Li's minimum cross entropy threshold computed from a histogram (follows skimage.filters.threshold_li)
+    
+    If each bin holds a single intensity the iteration is the same as in skimage, otherwise it stops once the threshold
+    moves by less than half a bin.
+    """
+    
+    occupied = counts > 0
+    if (np.count_nonzero(occupied) == 1):
+        return bin_centers[occupied][0]
+    
+    # Li's algorithm requires a positive image, shift the intensities so that the lowest intensity (bin edge) is at 0
+    if exact_values:
+        image_min = bin_centers[occupied][0]
+        tolerance = np.min(np.diff(bin_centers[occupied])) / 2
+    else:
+        bin_width = bin_centers[1] - bin_centers[0]
+        image_min = bin_centers[0] - bin_width / 2
+        tolerance = bin_width / 2
+    
+    counts = counts[occupied].astype(np.float64)
+    intensities = bin_centers[occupied] - image_min
+    
+    t_next = image_mean - image_min
+    t_curr = -2 * tolerance
+    while abs(t_next - t_curr) > tolerance:
+        t_curr = t_next
+        foreground = intensities > t_curr
+        mean_fore = np.average(intensities[foreground], weights = counts[foreground])
+        mean_back = np.average(intensities[~foreground], weights = counts[~foreground])
+        
+        if (mean_back == 0):
+            break
+        
+        t_next = (mean_back - mean_fore) / (np.log(mean_back) - np.log(mean_fore))
+    
+    return t_next + image_min
+
+def iter_pixel_chunks(image, sample_fraction = None, sample_method = "strided", seed = 0, rows_per_chunk = None):
+    """Iterate over the pixels of an image (or a subsample of them) a strip of rows at a time
+    
+    Only one strip is read at a time, so this works on memory-mapped and zarr images without loading them.
+    The same arguments always give the same subsample.
+    
+    Args:
+        image           : image (numpy, memory-mapped or zarr array)
+        sample_fraction : fraction of the pixels to use (None uses all of them)
+        sample_method   : strided- every n-th row and column, random- pixels drawn at random
+        seed            : seed of the random subsample
+        rows_per_chunk  : number of rows read at a time (default is about HISTOGRAM_CHUNK_PIXELS pixels)
+    Returns:
+        A generator of 1D arrays of pixels
+    """
+    
+    if (sample_fraction is not None and not 0 < sample_fraction <= 1):
+        raise Exception('Invalid input for sample_fraction: should be in (0, 1]')
+    if sample_method not in ("strided", "random"):
+        raise Exception('Invalid input for sample_method: should be among {"strided","random"}')
+    
+    pixels_per_row = int(np.prod(image.shape[1:]))
+    if rows_per_chunk is None:
+        rows_per_chunk = max(HISTOGRAM_CHUNK_PIXELS // max(pixels_per_row, 1), 1)
+    
+    if (sample_fraction is None or sample_fraction == 1):
+        for row_start in range(0, image.shape[0], rows_per_chunk):
+            yield np.asarray(image[row_start:row_start + rows_per_chunk]).ravel()
+    elif (sample_method == "strided"):
+        # keep one pixel out of step along each of the two first axes
+        step = max(int(round((1 / sample_fraction) ** 0.5)), 1)
+        rows_per_chunk = max(rows_per_chunk // step, 1) * step
+        for row_start in range(0, image.shape[0], rows_per_chunk):
+            yield np.asarray(image[row_start:row_start + rows_per_chunk:step, ::step]).ravel()
+    else:
+        rng = np.random.default_rng(seed)
+        for row_start in range(0, image.shape[0], rows_per_chunk):
+            chunk = np.asarray(image[row_start:row_start + rows_per_chunk]).ravel()
+            yield chunk[rng.random(chunk.size) < sample_fraction]
+
+def pixel_sample(image, sample_fraction = None, sample_method = "strided", seed = 0, rows_per_chunk = None):
+    """Pixels of an image (or the same subsample of them as iter_pixel_chunks) in memory
+    
+    Returns:
+        The image as an array, or a 1D array of the subsampled pixels
+    """
+    if (sample_fraction is None or sample_fraction == 1):
+        return np.asarray(image)
+    return np.concatenate(list(iter_pixel_chunks(image, sample_fraction, sample_method, seed, rows_per_chunk)))
+
+def _has_exact_histogram(image):
+    """Does the histogram of the image hold one bin per intensity (8 and 16 bit integer images, see image_histograms)?"""
+    return (np.issubdtype(image.dtype, np.integer) and image.dtype.itemsize <= 2)
+
+def image_histograms(image, bin_counts = (HISTOGRAM_BINS,), value_range = None, sample_fraction = None, sample_method = "strided",
+                     seed = 0, rows_per_chunk = None):
+    """Build intensity histograms of an image in a streaming pass
+    
+    8 and 16 bit integer images get a single histogram with one bin per intensity (as skimage does for integer images)
+    in one pass. Other images are binned over their intensity range, which takes a pass to find the range
+    (skipped if value_range is given) and a pass to fill all the requested histograms. NaNs are ignored.
+    
+    Args:
+        image           : image (numpy, memory-mapped or zarr array)
+        bin_counts      : number of bins of each histogram (ignored for 8 and 16 bit integer images)
+        value_range     : (min, max) intensity of the image if it is already known
+        sample_fraction : fraction of the pixels to use (None uses all of them)
+        sample_method   : strided- every n-th row and column, random- pixels drawn at random
+        seed            : seed of the random subsample
+        rows_per_chunk  : number of rows read at a time
+    Returns:
+        A dictionary of (counts, bin_centers) by number of bins (a single entry under None for integer images),
+        the mean intensity and whether the bins hold single intensities (exact_values)
+    """
+    
+    def chunks():
+        return iter_pixel_chunks(image, sample_fraction, sample_method, seed, rows_per_chunk)
+    
+    if _has_exact_histogram(image):
+        # one bin per intensity, offset so that negative intensities can be counted
+        offset = int(np.iinfo(image.dtype).min)
+        counts = np.zeros(2**(8 * image.dtype.itemsize), dtype = np.int64)
+        for chunk in chunks():
+            counts += np.bincount((chunk.astype(np.int64) - offset), minlength = counts.size)
+        
+        occupied = np.flatnonzero(counts)
+        if (occupied.size == 0):
+            raise Exception("Cannot compute a threshold: the image (or its subsample) has no pixels")
+        counts = counts[occupied[0]:occupied[-1] + 1]
+        bin_centers = np.arange(occupied[0], occupied[-1] + 1, dtype = np.int64) + offset
+        image_mean = np.dot(counts, bin_centers.astype(np.float64)) / counts.sum()
+        
+        return {None: (counts, bin_centers)}, image_mean, True
+    
+    # find the intensity range (unless it is known)
+    if value_range is None:
+        image_min, image_max = np.inf, -np.inf
+        for chunk in chunks():
+            chunk = chunk[~np.isnan(chunk)] if np.issubdtype(chunk.dtype, np.floating) else chunk
+            if (chunk.size > 0):
+                image_min, image_max = min(image_min, chunk.min()), max(image_max, chunk.max())
+    else:
+        image_min, image_max = value_range
+    
+    # fill the histograms and find the mean
+    histograms = {}
+    for nbins in bin_counts:
+        bin_edges = np.linspace(image_min, image_max, nbins + 1)
+        histograms[nbins] = (np.zeros(nbins, dtype = np.int64), (bin_edges[:-1] + bin_edges[1:]) / 2)
+    image_sum, n_pixels = 0.0, 0
+    for chunk in chunks():
+        chunk = chunk[~np.isnan(chunk)] if np.issubdtype(chunk.dtype, np.floating) else chunk
+        image_sum += chunk.sum(dtype = np.float64)
+        n_pixels += chunk.size
+        if (image_min < image_max):
+            for nbins in bin_counts:
+                histograms[nbins][0][:] += np.histogram(chunk, bins = nbins, range = (image_min, image_max))[0]
+    if (n_pixels == 0):
+        raise Exception("Cannot compute a threshold: the image (or its subsample) has no pixels")
+    image_mean = image_sum / n_pixels
+    
+    if (image_min == image_max):
+        # constant image: a single bin
+        return {nbins: (np.array([n_pixels]), np.array([image_min])) for nbins in bin_counts}, image_mean, True
+    
+    return histograms, image_mean, False
+
+def thresholds_from_image(image, threshold_methods = THRESHOLD_METHODS, sample_fraction = None, sample_method = "strided", seed = 0,
+                          value_range = None, image_mean = None, rows_per_chunk = None, skip_failed = False, li_histogram = False):
+    """Compute one or several thresholds of an image from its histogram
+    
+    The histogram is built once in a streaming pass (see image_histograms) and every method is computed from it,
+    so computing all the methods costs about as much as computing one. On the full image the thresholds are the same as
+    skimage.filters. Li is not histogram based: on non-integer images it is computed with skimage.filters.threshold_li on the
+    pixels (or the subsample), which have to fit in memory, unless li_histogram is set.
+    
+    Args:
+        image             : image (numpy, memory-mapped or zarr array)
+        threshold_methods : methods to compute (among THRESHOLD_METHODS)
+        sample_fraction   : estimate the thresholds from this fraction of the pixels (None uses all of them)
+        sample_method     : strided- every n-th row and column, random- pixels drawn at random
+        seed              : seed of the random subsample
+        value_range       : (min, max) intensity of the image if it is already known
+        image_mean        : mean intensity of the image if it is already known
+        rows_per_chunk    : number of rows read at a time
+        skip_failed       : set the thresholds that cannot be computed (e.g. Minimum on a unimodal histogram) to None instead of raising
+        li_histogram      : compute Li on non-integer images from a LI_HISTOGRAM_BINS bins histogram (streamed, but can differ from
+                            skimage by a few pixels)
+    Returns:
+        A dictionary of thresholds by method
+    """
+    
+    for threshold_method in threshold_methods:
+        if threshold_method not in THRESHOLD_METHODS:
+            raise Exception('Invalid threshold_method: should be among {"Li","Otsu","Isodata","Mean","Minimum","Triangle","Yen"}')
+    
+    thresholds = {}
+    if ("Li" in threshold_methods and not li_histogram and not _has_exact_histogram(image)):
+        thresholds["Li"] = skfil.threshold_li(pixel_sample(image, sample_fraction, sample_method, seed, rows_per_chunk))
+        threshold_methods = [threshold_method for threshold_method in threshold_methods if threshold_method != "Li"]
+        if not threshold_methods:
+            return thresholds
+    
+    bin_counts = set()
+    for threshold_method in threshold_methods:
+        if (threshold_method == "Li"):
+            bin_counts.add(LI_HISTOGRAM_BINS)
+        elif (threshold_method != "Mean"):
+            bin_counts.add(HISTOGRAM_BINS)
+    
+    histograms, sample_mean, exact_values = image_histograms(image, sorted(bin_counts), value_range, sample_fraction, sample_method,
+                                                             seed, rows_per_chunk)
+    if (image_mean is None):
+        image_mean = sample_mean
+    
+    for threshold_method in threshold_methods:
+        if (threshold_method == "Mean"):
+            thresholds[threshold_method] = image_mean
+            continue
+        
+        if None in histograms:
+            counts, bin_centers = histograms[None]
+        else:
+            counts, bin_centers = histograms[LI_HISTOGRAM_BINS if threshold_method == "Li" else HISTOGRAM_BINS]
+        
+        if (len(counts) == 1):
+            # constant image
+            thresholds[threshold_method] = bin_centers[0]
+            continue
+        
+        try:
+            thresholds[threshold_method] = threshold_from_histogram(counts, bin_centers, threshold_method, image_mean,
+                                                                    exact_values = exact_values)
+        except Exception as err:
+            if not skip_failed:
+                raise
+            warnings.warn("Could not compute the " + threshold_method + " threshold: " + str(err))
+            thresholds[threshold_method] = None
+    
+    return thresholds
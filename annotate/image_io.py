@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+import io
+import numpy as np
+import cv2
+from tifffile import imread, imwrite, memmap, TiffFile
+
+from annotate.sparse_labels import is_sparse_path, read_sparse_labels, decode_labels, encode_labels, write_sparse_labels
+from annotate.sparse_labels import sparse_shape, sparse_dtype
+
+# zarr is optional, it is only used to read tiled/compressed TIFFs lazily
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+# axes of the TIFF metadata holding channels (C) or the samples of RGB images (S)
+CHANNEL_AXES = "CS"
+
+def open_image(image_path:str):
+    """Open a TIFF image without reading its pixels into memory
+
+    Uncompressed, contiguous TIFFs are memory-mapped, tiled or compressed TIFFs are opened as a zarr array (if zarr is installed)
+    and anything else is read into memory. The returned image can be sliced like a numpy array so that only the
+    requested strips/tiles are read from disk. Sparse label files (see annotate.sparse_labels) are decoded into memory.
+
+    Args:
+        image_path : path to a TIFF image (or sparse labels)
+    Returns:
+        A memory-mapped array, a zarr array or a numpy array
+    """
+
+    if is_sparse_path(image_path):
+        return decode_labels(read_sparse_labels(image_path))
+
+    try:
+        return memmap(image_path, mode = 'r')
+    except ValueError:
+        # the image data are not memory-mappable (compressed, tiled or not contiguous)
+        pass
+
+    if zarr is not None:
+        image = zarr.open(imread(image_path, aszarr = True), mode = 'r')
+
+        # pyramidal TIFFs are opened as a group of levels, use the full resolution level
+        if not hasattr(image, 'shape'):
+            image = image['0']
+        return image
+
+    return imread(image_path)
+
+def read_image_shape(image_path:str):
+    """Read the shape of a TIFF image from its header (no pixels are read)
+
+    Args:
+        image_path : path to a TIFF image (or sparse labels)
+    Returns:
+        Shape of the image
+    """
+    if is_sparse_path(image_path):
+        return sparse_shape(read_sparse_labels(image_path))
+    with TiffFile(image_path) as tif:
+        return tif.series[0].shape
+
+def read_image_dtype(image_path:str):
+    """Read the dtype of a TIFF image from its header (no pixels are read)"""
+    if is_sparse_path(image_path):
+        return sparse_dtype(read_sparse_labels(image_path))
+    with TiffFile(image_path) as tif:
+        return tif.series[0].dtype
+
+def read_image_axes(image_path:str):
+    """Read the axes of a TIFF image from its header, e.g. YX, ZYX, CZYX or YXS for RGB (no pixels are read)"""
+    if is_sparse_path(image_path):
+        return "YX"
+    with TiffFile(image_path) as tif:
+        return tif.series[0].axes
+
+def channel_axis(axes:str):
+    """Index of the channel axis (C, or S for the samples of an RGB image) in the axes of an image (None if there is none)"""
+    for index, axis in enumerate(axes):
+        if axis in CHANNEL_AXES:
+            return index
+    return None
+
+def drop_channel_axis(axes:str):
+    """Axes of an image without its channel axis (e.g. the axes of its labels)"""
+    axis = channel_axis(axes)
+    return axes if axis is None else axes[:axis] + axes[axis + 1:]
+
+def select_channel(image, axes:str, channel:int = None):
+    """Select a channel of a multichannel image
+
+    Args:
+        image   : image (numpy, memory-mapped or zarr array, only the channel is read when it is sliced)
+        axes    : axes of the image (see read_image_axes)
+        channel : index of the channel (None if the image has a single channel)
+    Returns:
+        The channel and its axes (the axes of the image without the channel axis)
+    """
+    axis = channel_axis(axes)
+    if axis is None:
+        if channel not in (None, 0):
+            raise Exception('Invalid input for channel: the image has a single channel')
+        return image, axes
+    if channel is None:
+        if (image.shape[axis] > 1):
+            raise Exception('The image has ' + str(image.shape[axis]) + ' channels (' + axes + '), select the one to segment')
+        channel = 0
+    if not (0 <= channel < image.shape[axis]):
+        raise Exception('Invalid input for channel: the image has ' + str(image.shape[axis]) + ' channels')
+
+    return image[(slice(None),) * axis + (channel,)], drop_channel_axis(axes)
+
+def read_image_channel(image_path:str, channel:int = None, lazy:bool = False):
+    """Read a channel of a (multichannel) TIFF image, without reading the other channels when the image can be opened lazily
+
+    Args:
+        image_path : path to a TIFF image
+        channel    : index of the channel (None if the image has a single channel, see select_channel)
+        lazy       : return the channel opened with open_image instead of reading it into memory
+    Returns:
+        The channel and its axes
+    """
+    axes = read_image_axes(image_path)
+    # single channel images are read in one go, the channel index is still checked
+    image = imread(image_path) if (channel_axis(axes) is None and not lazy) else open_image(image_path)
+    image, axes = select_channel(image, axes, channel)
+    return (image if lazy else np.asarray(image)), axes
+
+def _segment_size(page):
+    """Rows and columns of the tiles (or strips) of a TIFF page"""
+    if page.is_tiled:
+        return page.tilelength, page.tilewidth
+    return min(page.rowsperstrip or page.imagelength, page.imagelength), page.imagewidth
+
+def _segment_window(page, index:int):
+    """(row_start, row_end, col_start, col_end) of a tile or strip of a TIFF page, clipped to the image"""
+    segment_rows, segment_cols = _segment_size(page)
+    segments_across = -(-page.imagewidth // segment_cols)
+    row_start, col_start = (index // segments_across) * segment_rows, (index % segments_across) * segment_cols
+    return row_start, min(row_start + segment_rows, page.imagelength), col_start, min(col_start + segment_cols, page.imagewidth)
+
+def _overlapped_segments(page, window):
+    """Indices of the tiles (or strips) of a TIFF page overlapped by a window (row_start, row_end, col_start, col_end)"""
+    segment_rows, segment_cols = _segment_size(page)
+    segments_across = -(-page.imagewidth // segment_cols)
+    row_start, row_end = max(window[0], 0), min(window[1], page.imagelength)
+    col_start, col_end = max(window[2], 0), min(window[3], page.imagewidth)
+    if (row_start >= row_end or col_start >= col_end):
+        return []
+    return [segment_row * segments_across + segment_col
+            for segment_row in range(row_start // segment_rows, (row_end - 1) // segment_rows + 1)
+            for segment_col in range(col_start // segment_cols, (col_end - 1) // segment_cols + 1)]
+
+def _encode_segment(page, segment):
+    """Encode a tile or strip with the compression and predictor of a TIFF page (written as the only segment of an
+    in-memory TIFF, the encoded bytes are then read back from it)"""
+    buffer = io.BytesIO()
+    layout = {"tile": (page.tilelength, page.tilewidth)} if page.is_tiled else {"rowsperstrip": segment.shape[0]}
+    imwrite(buffer, segment, compression = page.compression, predictor = page.predictor, **layout)
+    buffer.seek(0)
+    with TiffFile(buffer) as tif:
+        encoded_page = tif.pages[0]
+        offset, bytecount = encoded_page.dataoffsets[0], encoded_page.databytecounts[0]
+    return buffer.getvalue()[offset:offset + bytecount]
+
+def _patch_tiff_segments(image_path:str, windows:list):
+    """Overwrite windows of a tiled or compressed TIFF by encoding again only the tiles (or strips) they overlap
+
+    An encoded segment that is not larger than the previous one is written over it, a larger one is appended to the file,
+    and the offsets and byte counts of the page are updated in place.
+
+    Returns:
+        False if the TIFF cannot be patched (several pages or samples per pixel, or offsets over 4GB in a classic TIFF),
+        nothing is written then
+    """
+    with TiffFile(image_path, mode = 'r+b') as tif:
+        page = tif.pages[0]
+        if (len(tif.pages) > 1 or page.samplesperpixel > 1 or page.imagedepth > 1):
+            return False
+        fh = tif.filehandle
+
+        # decode the segments overlapped by the windows and write the windows into them
+        segments = {}
+        for (row_start, row_end, col_start, col_end), window in windows:
+            if (not np.can_cast(window.dtype, page.dtype) and np.max(window, initial = 0) > np.iinfo(page.dtype).max):
+                raise Exception('The labels of the window do not fit in the ' + page.dtype.name + ' image')
+            for index in _overlapped_segments(page, (row_start, row_end, col_start, col_end)):
+                segment_window = _segment_window(page, index)
+                top, bottom = max(row_start, segment_window[0]), min(row_end, segment_window[1])
+                left, right = max(col_start, segment_window[2]), min(col_end, segment_window[3])
+                if index not in segments:
+                    data = None
+                    if (page.databytecounts[index] > 0):
+                        fh.seek(page.dataoffsets[index])
+                        data = fh.read(page.databytecounts[index])
+                    segment, _, shape = page.decode(data, index, jpegtables = page.jpegtables)
+                    segments[index] = np.zeros(shape[1:3], dtype = page.dtype) if segment is None else segment.reshape(shape[1:3]).copy()
+                segments[index][top - segment_window[0]:bottom - segment_window[0], left - segment_window[2]:right - segment_window[2]] = \
+                    window[top - row_start:bottom - row_start, left - col_start:right - col_start]
+
+        encoded = {index: _encode_segment(page, segment) for index, segment in segments.items()}
+        offsets, bytecounts = list(page.dataoffsets), list(page.databytecounts)
+        fh.seek(0, 2)
+        end_of_file = fh.tell()
+        appended = sum(len(data) for index, data in encoded.items() if len(data) > bytecounts[index])
+        if (not tif.is_bigtiff and end_of_file + appended >= 2**32):
+            return False
+
+        for index, data in encoded.items():
+            if (len(data) > bytecounts[index]):
+                offsets[index] = end_of_file
+                end_of_file += len(data)
+            fh.seek(offsets[index])
+            fh.write(data)
+            bytecounts[index] = len(data)
+
+        offsets_tag, bytecounts_tag = ("TileOffsets", "TileByteCounts") if page.is_tiled else ("StripOffsets", "StripByteCounts")
+        page.tags[offsets_tag].overwrite(offsets)
+        page.tags[bytecounts_tag].overwrite(bytecounts)
+    return True
+
+def write_image_windows(image_path:str, windows:list):
+    """Overwrite windows of a TIFF image, leaving the pixels outside the windows untouched
+
+    Uncompressed, contiguous TIFFs are memory-mapped and only the rows of the windows are written back. In tiled or compressed
+    TIFFs only the tiles (or strips) overlapped by the windows are encoded again and written (see _patch_tiff_segments),
+    TIFFs that cannot be patched are rewritten as a whole (once, with the same tiling and compression). Either way the pixels
+    outside the windows keep their values. Sparse labels are decoded, updated and encoded again.
+
+    Args:
+        image_path : path to a TIFF image (or sparse labels)
+        windows    : list of ((row_start, row_end, col_start, col_end), new pixels of the window), written in order
+    """
+    if not windows:
+        return
+
+    sparse = is_sparse_path(image_path)
+    write_args = None
+    if sparse:
+        image = decode_labels(read_sparse_labels(image_path))
+    else:
+        try:
+            image = memmap(image_path, mode = 'r+')
+        except ValueError:
+            # the image data are not memory-mappable (compressed, tiled or not contiguous)
+            if _patch_tiff_segments(image_path, windows):
+                return
+            with TiffFile(image_path) as tif:
+                page = tif.pages[0]
+                image = page.asarray()
+                write_args = {"compression": page.compression, "predictor": page.predictor, "bigtiff": tif.is_bigtiff}
+                if page.is_tiled:
+                    write_args["tile"] = (page.tilelength, page.tilewidth)
+
+    for (row_start, row_end, col_start, col_end), window in windows:
+        # the image keeps its dtype so that nothing outside the windows changes
+        if (not np.can_cast(window.dtype, image.dtype) and np.max(window, initial = 0) > np.iinfo(image.dtype).max):
+            raise Exception('The labels of the window do not fit in the ' + image.dtype.name + ' image')
+        image[row_start:row_end, col_start:col_end] = window
+
+    if sparse:
+        write_sparse_labels(image_path, encode_labels(image))
+    elif write_args is None:
+        image.flush()
+    else:
+        imwrite(image_path, image, **write_args)
+    del image
+
+def iter_strips(image, rows_per_strip:int = 1024):
+    """Iterate over an image a strip of rows at a time
+
+    Args:
+        image          : image opened with open_image (or a numpy array)
+        rows_per_strip : number of rows in each strip
+    Returns:
+        A generator of (first row of the strip, strip)
+    """
+    for row_start in range(0, image.shape[0], rows_per_strip):
+        yield row_start, np.asarray(image[row_start:row_start + rows_per_strip])
+
+def downsized_shape(shape, resize_factor:int = 10):
+    """Shape of an image downsized by an integer factor (the partial blocks along the bottom and right edges are kept,
+    trailing sample axes, e.g. of RGB images, are not downsized)"""
+    return (-(-shape[0] // resize_factor), -(-shape[1] // resize_factor)) + tuple(shape[2:])
+
+def _block_parts(shape, resize_factor:int = 10):
+    """Split an image into parts of blocks of the same size: the full blocks, and the partial blocks along the bottom edge,
+    the right edge and in the bottom right corner when the image size is not a multiple of the resize factor
+
+    Returns:
+        A list of (rows, cols) slices of the image, (rows, cols) slices of the downsized image and (block rows, block cols)
+    """
+    parts = []
+    full_rows, full_cols = shape[0] // resize_factor, shape[1] // resize_factor
+    row_parts = [(slice(0, full_rows * resize_factor), slice(0, full_rows), resize_factor),
+                 (slice(full_rows * resize_factor, shape[0]), slice(full_rows, full_rows + 1), shape[0] - full_rows * resize_factor)]
+    col_parts = [(slice(0, full_cols * resize_factor), slice(0, full_cols), resize_factor),
+                 (slice(full_cols * resize_factor, shape[1]), slice(full_cols, full_cols + 1), shape[1] - full_cols * resize_factor)]
+    for rows, out_rows, block_rows in row_parts:
+        for cols, out_cols, block_cols in col_parts:
+            if (rows.stop > rows.start and cols.stop > cols.start):
+                parts.append(((rows, cols), (out_rows, out_cols), (block_rows, block_cols)))
+    return parts
+
+def _blocks(image, block_shape):
+    """View of an image as blocks of block_shape, with the trailing sample axes (e.g. RGB) kept after the block axes
+    (the image size has to be a multiple of the block shape)"""
+    return image.reshape((image.shape[0] // block_shape[0], block_shape[0], image.shape[1] // block_shape[1], block_shape[1]) +
+                         image.shape[2:])
+
+def block_reduce(image, resize_factor:int = 10, method:str = "mean"):
+    """Reduce each resize_factor x resize_factor block of an image to its mean (or max)
+
+    The image is reshaped into blocks (a view), which are reduced in one vectorized call. When the image size is not a
+    multiple of the resize factor, the partial blocks along the bottom and right edges are reduced over their own pixels
+    (see downsized_shape). The mean of the full blocks is that of skimage.transform.downscale_local_mean, which pads the
+    partial blocks with zeros instead.
+
+    Args:
+        image         : 2D numpy array (or 2D with trailing sample axes, e.g. RGB, each sample is reduced on its own)
+        resize_factor : size of the blocks
+        method        : mean (float64 result) or max (same dtype as the image)
+    Returns:
+        The reduced image
+    """
+    if method not in ("mean", "max"):
+        raise Exception('Invalid input for method: should be among {"mean","max"}')
+
+    image_reduced = np.zeros(downsized_shape(image.shape, resize_factor), dtype = np.float64 if method == "mean" else image.dtype)
+    for image_part, reduced_part, block_shape in _block_parts(image.shape, resize_factor):
+        blocks = _blocks(image[image_part], block_shape)
+        image_reduced[reduced_part] = blocks.mean(axis = (1, 3)) if method == "mean" else blocks.max(axis = (1, 3))
+    return image_reduced
+
+def downsize_image(image, resize_factor:int = 10, rows_per_strip:int = 1024, method:str = "mean", dtype = None):
+    """Downsize an image by an integer factor reading a strip of rows at a time
+
+    Each strip is reduced to the mean (or max) of its resize_factor x resize_factor blocks (see block_reduce), so only one
+    strip and the downsized image are ever in memory, and nothing is aliased as with an interpolating resize. The strips
+    hold a multiple of the resize factor rows so that every downsized pixel covers exactly one block, the partial blocks
+    along the edges cover the remaining rows and columns (see downsized_shape).
+
+    Args:
+        image          : image opened with open_image (or a numpy array)
+        resize_factor  : resizing factor
+        rows_per_strip : number of rows to read at a time
+        method         : mean or max of each block
+        dtype          : dtype of the downsized image (None is float64 for mean and the dtype of the image for max),
+                         the means are rounded for integer dtypes
+    Returns:
+        The downsized image
+    """
+
+    strip_rows = max(rows_per_strip // resize_factor, 1) * resize_factor
+    if dtype is None:
+        dtype = np.float64 if method == "mean" else image.dtype
+    round_means = (method == "mean" and np.dtype(dtype).kind in "ui")
+
+    image_resized = np.zeros(downsized_shape(image.shape, resize_factor), dtype = dtype)
+    for row_start, strip in iter_strips(image, strip_rows):
+        out_row_start = row_start // resize_factor
+        strip_resized = block_reduce(strip, resize_factor, method)
+        image_resized[out_row_start:out_row_start + strip_resized.shape[0]] = np.rint(strip_resized) if round_means else strip_resized
+
+    return image_resized
+
+def block_mode(label_image, resize_factor:int = 10):
+    """Reduce each resize_factor x resize_factor block of a label image to its most frequent label
+
+    Blocks holding a single label (most of them) are found with one comparison over a reshaped view, only the mixed blocks
+    along the object borders are copied and sorted, and their most frequent label is found from the lengths of the runs of
+    equal labels, without any loop over the blocks. Ties go to the smallest label (the background if it is among them).
+    The partial blocks along the bottom and right edges are reduced over their own pixels (see downsized_shape).
+
+    Args:
+        label_image   : 2D label image (numpy array)
+        resize_factor : size of the blocks
+    Returns:
+        The reduced label image (same dtype)
+    """
+    labels_resized = np.zeros(downsized_shape(label_image.shape, resize_factor), dtype = label_image.dtype)
+    for image_part, reduced_part, block_shape in _block_parts(label_image.shape, resize_factor):
+        labels_resized[reduced_part] = _blocks_mode(_blocks(label_image[image_part], block_shape))
+    return labels_resized
+
+def _blocks_mode(blocks):
+    """Most frequent label of each block of a label image viewed as blocks (see _blocks and block_mode)"""
+    # uniform blocks keep their label
+    labels_resized = np.array(blocks[:, 0, :, 0])
+    mixed = ~(blocks == blocks[:, :1, :, :1]).all(axis = (1, 3))
+    if not mixed.any():
+        return labels_resized
+
+    # sort the labels of each mixed block, each run of equal labels is then one label of the block
+    block_size = blocks.shape[1] * blocks.shape[3]
+    mixed_blocks = np.sort(blocks.transpose(0, 2, 1, 3)[mixed].reshape(-1, block_size), axis = 1).ravel()
+    run_starts = np.flatnonzero(np.concatenate([[True], mixed_blocks[1:] != mixed_blocks[:-1]]) | (np.arange(mixed_blocks.size) % block_size == 0))
+    run_lengths = np.diff(np.append(run_starts, mixed_blocks.size))
+    run_blocks = run_starts // block_size
+
+    # the first of the longest runs of each block
+    first_runs = np.flatnonzero(np.concatenate([[True], run_blocks[1:] != run_blocks[:-1]]))
+    longest = np.maximum.reduceat(run_lengths, first_runs)
+    is_longest = np.flatnonzero(run_lengths == longest[run_blocks])
+    mode_runs = is_longest[np.concatenate([[True], run_blocks[is_longest][1:] != run_blocks[is_longest][:-1]])]
+    labels_resized[mixed] = mixed_blocks[run_starts[mode_runs]]
+
+    return labels_resized
+
+def downsize_labels(label_image, resize_factor:int = 10, rows_per_strip:int = 1024, method:str = "mode"):
+    """Downsize a label image by an integer factor a strip of rows at a time (labels are never interpolated)
+
+    The output has the same shape as downsize_image. Labels keep their integer dtype throughout, so large label images are
+    never converted to float.
+
+    Args:
+        label_image    : label image opened with open_image (or a numpy array)
+        resize_factor  : resizing factor
+        rows_per_strip : number of rows to read at a time
+        method         : mode- the most frequent label of each resize_factor x resize_factor block (see block_mode),
+                         nearest- the label at (i*resize_factor, j*resize_factor)
+    Returns:
+        The downsized label image
+    """
+    if method not in ("mode", "nearest"):
+        raise Exception('Invalid input for method: should be among {"mode","nearest"}')
+
+    strip_rows = max(rows_per_strip // resize_factor, 1) * resize_factor
+
+    labels_resized = np.zeros(downsized_shape(label_image.shape, resize_factor), dtype = label_image.dtype)
+    for row_start, strip in iter_strips(label_image, strip_rows):
+        out_row_start = row_start // resize_factor
+        strip_resized = block_mode(strip, resize_factor) if method == "mode" else strip[::resize_factor, ::resize_factor]
+        labels_resized[out_row_start:out_row_start + strip_resized.shape[0]] = strip_resized
+
+    return labels_resized
+
+def upsize_labels(labels_resized, resize_factor:int, shape, rows_per_strip:int = 1024):
+    """Upsize downsized labels back to the full resolution shape (the inverse of downsize_labels)
+
+    Each downsized pixel is repeated over its resize_factor x resize_factor block and the partial blocks along the edges are
+    cropped to the shape, so every label is scaled by exactly the resize factor (an interpolating resize to the shape would
+    scale by a slightly different factor). The labels are upsized a strip of rows at a time.
+
+    Args:
+        labels_resized : downsized labels (see downsize_labels)
+        resize_factor  : resizing factor
+        shape          : full resolution shape (the downsized labels have to be downsized_shape(shape[:2], resize_factor), trailing
+                         sample axes of the raw image are ignored)
+        rows_per_strip : number of rows to write at a time
+    Returns:
+        The full resolution labels
+    """
+    if (tuple(labels_resized.shape) != downsized_shape(shape[:2], resize_factor)):
+        raise Exception('The downsized labels do not match the shape ' + str(tuple(shape)))
+
+    strip_rows = max(rows_per_strip // resize_factor, 1)
+    labels = np.empty(tuple(shape[:2]), dtype = labels_resized.dtype)
+    for out_row_start in range(0, labels_resized.shape[0], strip_rows):
+        strip = np.repeat(np.repeat(labels_resized[out_row_start:out_row_start + strip_rows], resize_factor, axis = 0), resize_factor, axis = 1)
+        row_start = out_row_start * resize_factor
+        labels[row_start:row_start + strip.shape[0]] = strip[:shape[0] - row_start, :shape[1]]
+    return labels
+
+def make_display_image(image, resize_factor:int = 10):
+    """Downsize an image (block mean, see downsize_image) and rescale it to 8 bit for display
+
+    Args:
+        image         : image opened with open_image (or a numpy array)
+        resize_factor : resizing factor
+    Returns:
+        The downsized 8 bit image
+    """
+    image_resized = downsize_image(image, resize_factor)
+    return cv2.normalize(image_resized, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+
+def build_pyramid(image, min_size:int = 512, rows_per_strip:int = 1024):
+    """Build a multiscale pyramid of an image for interactive viewing
+
+    Each level is half the size of the previous one (block mean) and the full resolution level is kept as it is
+    (e.g. memory-mapped) so that only the visible part of it is read.
+
+    Args:
+        image          : image opened with open_image (or a numpy array)
+        min_size       : stop adding levels once the smaller side of a level would drop below this size
+        rows_per_strip : number of rows to read at a time
+    Returns:
+        A list of images from the full resolution to the smallest level
+    """
+
+    pyramid = [image]
+    while (min(pyramid[-1].shape[0], pyramid[-1].shape[1]) // 2 >= min_size):
+        pyramid.append(downsize_image(pyramid[-1], 2, rows_per_strip, dtype = pyramid[-1].dtype))
+
+    return pyramid
@@ -1,30 +1,107 @@
 # -*- coding: utf-8 -*-
-import napari
-from skimage import data
-import skimage.filters as skfil
-from skimage.measure import label
-from tifffile import imread, imsave
-from skimage.transform import resize
+import os
+import shutil
 import numpy as np
-from skimage.morphology import remove_small_objects
-from skimage.util import img_as_ubyte
 import cv2
 
-from napari.utils.settings import SETTINGS
-SETTINGS.application.ipy_interactive = False
+from annotate.basic_image_processing_tasks import cast_label_image, label_image_dtype
+from annotate.image_io import open_image, downsize_labels, upsize_labels, read_image_shape, read_image_dtype, read_image_axes, write_image_windows
+from annotate.image_io import CHANNEL_AXES
+from annotate.profiling import profile_stage
+from annotate.label_output import write_label_image
+from annotate.sparse_labels import is_sparse_path
+from annotate.display_cache import cached_display_image, cached_pyramid, DEFAULT_MAX_CACHE_SIZE
 
-def napari_interactive_annotation(base_image, label_image):
+# viewer kept open between the images of a batch (see get_annotation_viewer)
+_annotation_viewer = None
+
+# size (in pixels of the downsized labels) of the tiles in which the edits of a downsized correction are tracked
+EDIT_TILE_SIZE = 64
+
+def _import_napari():
+    """Import napari when a viewer is first opened
+    
+    napari (and Qt) take seconds to import and need a display, so they are not imported with this module:
+    loading, downsizing and caching images for annotation stays headless.
+    """
+    import napari
+    
+    # do not block IPython when napari.run() is called
+    try:
+        from napari.settings import get_settings
+        get_settings().application.ipy_interactive = False
+    except ImportError:
+        # napari < 0.4.11
+        from napari.utils.settings import SETTINGS
+        SETTINGS.application.ipy_interactive = False
+    
+    return napari
+
+def _finish_image(viewer):
+    """Return from napari.run() without closing the viewer so that it can be reused for the next image"""
+    from qtpy.QtWidgets import QApplication
+    QApplication.instance().quit()
+
+def get_annotation_viewer():
+    """Return the napari viewer shared by the annotation sessions, creating it if it does not exist or was closed
+    
+    Press Shift-N in the viewer to move on to the next image without closing the window.
+    """
+    global _annotation_viewer
+    
+    if _annotation_viewer is not None:
+        try:
+            if _annotation_viewer.window._qt_window.isVisible():
+                return _annotation_viewer
+        except RuntimeError:
+            # the Qt window has already been deleted
+            pass
+    
+    napari = _import_napari()
+    _annotation_viewer = napari.Viewer()
+    _annotation_viewer.bind_key('Shift-N', _finish_image)
+    
+    return _annotation_viewer
+
+def close_annotation_viewer():
+    """Close the viewer shared by the annotation sessions (if it is open)"""
+    global _annotation_viewer
+    
+    if _annotation_viewer is not None:
+        try:
+            _annotation_viewer.close()
+        except RuntimeError:
+            pass
+        _annotation_viewer = None
+
+def napari_interactive_annotation(base_image, label_image, multiscale:bool = False, reuse_viewer:bool = False, channel_axis:int = None):
     """Perform interactive annotation of an image
     
+    Stacks are shown plane by plane with a slider for each plane axis (the labels are painted on the visible plane).
+    
     Args:
-        base_image    : fluroscent image to use as a guide
-        segmentation layer : label image
+        base_image    : fluroscent image to use as a guide (a list of levels from build_pyramid if multiscale)
+        segmentation layer : label image (at the full resolution of the base image, without its channel axis)
+        multiscale    : is the base image a multiscale pyramid?
+        reuse_viewer  : swap the layers of the shared viewer instead of creating a new one (finish the image with Shift-N)
+        channel_axis  : axis of the channels of the base image, each channel is shown as its own layer (None if there is none)
 
     """
     
-    # create the viewer and add image
-    viewer = napari.Viewer()
-    image_layer = viewer.add_image(base_image, name='base_image', multiscale=False)
+    napari = _import_napari()
+    
+    # create the viewer (or clear the shared one) and add image
+    if reuse_viewer:
+        viewer = get_annotation_viewer()
+        viewer.layers.clear()
+    else:
+        viewer = napari.Viewer()
+    if multiscale:
+        # use the smallest level for the contrast limits so that the full resolution image is never read as a whole
+        contrast_limits = [np.min(base_image[-1]), np.max(base_image[-1])]
+        image_layer = viewer.add_image(base_image, name='base_image', multiscale=True, contrast_limits=contrast_limits)
+    else:
+        image_layer = viewer.add_image(base_image, name='base_image', multiscale=False, channel_axis=channel_axis)
     labels_layer = viewer.add_labels(label_image)
     napari.run() 
     
@@ -33,6 +110,56 @@ def napari_interactive_annotation(base_image, label_image):
 
     return updated_labels
 
+def napari_select_regions(overview_image, overview_labels = None, reuse_viewer:bool = False):
+    """Draw the regions to correct on an overview of an image
+    
+    Args:
+        overview_image  : downsized image to draw the regions on
+        overview_labels : downsized labels shown on top of the image (None to show the image only)
+        reuse_viewer    : swap the layers of the shared viewer instead of creating a new one (finish with Shift-N)
+    
+    Return:
+        The vertices (rows, cols in overview pixels) of each rectangle drawn
+    """
+    
+    napari = _import_napari()
+    
+    if reuse_viewer:
+        viewer = get_annotation_viewer()
+        viewer.layers.clear()
+    else:
+        viewer = napari.Viewer()
+    viewer.add_image(overview_image, name='overview')
+    if overview_labels is not None:
+        viewer.add_labels(overview_labels, name='labels', opacity=0.5)
+    regions_layer = viewer.add_shapes(ndim=2, name='regions', shape_type='rectangle', edge_color='yellow', face_color='transparent')
+    regions_layer.mode = 'add_rectangle'
+    napari.run()
+    
+    return [np.asarray(shape) for shape in regions_layer.data]
+
+def regions_from_shapes(shapes:list, resize_factor:int, image_shape):
+    """Full resolution windows covered by shapes drawn on an overview (see napari_select_regions)
+    
+    Args:
+        shapes        : vertices (rows, cols in overview pixels) of each shape
+        resize_factor : resizing factor of the overview
+        image_shape   : shape of the full resolution image
+    
+    Return:
+        A list of (row_start, row_end, col_start, col_end), empty windows are dropped
+    """
+    regions = []
+    for shape in shapes:
+        # overview pixel i covers the rows i*resize_factor to (i+1)*resize_factor of the full image
+        row_start, col_start = np.floor(shape[:, :2].min(axis=0) + 0.5).astype(int) * resize_factor
+        row_end, col_end = (np.floor(shape[:, :2].max(axis=0) + 0.5).astype(int) + 1) * resize_factor
+        row_start, row_end = max(row_start, 0), min(row_end, image_shape[0])
+        col_start, col_end = max(col_start, 0), min(col_end, image_shape[1])
+        if (row_end > row_start and col_end > col_start):
+            regions.append((int(row_start), int(row_end), int(col_start), int(col_end)))
+    return regions
+
 def generate_object_labels(raw_image, label_img_depth:str = "8bit"):
     """Perform interactive annotation of an image
     
@@ -57,37 +184,342 @@ def generate_object_labels(raw_image, label_img_depth:str = "8bit"):
              
     return labelled_image
 
-def generate_labels_large_image(raw_image_path:str,label_img_depth:str = "8bit",resize_factor:int =10):
-    """Perform interactive annotation of a large image
+def label_shape(image_shape, axes:str):
+    """Shape of the labels of an image: the shape of the image without its channel axis (see annotate.image_io.CHANNEL_AXES)"""
+    return tuple(size for size, axis in zip(image_shape, axes) if axis not in CHANNEL_AXES)
+
+def _check_2d_image(axes:str, large_image:str):
+    """Check that an image is 2D (possibly RGB), stacks and multichannel images are only annotated at full resolution"""
+    if (axes not in ("YX", "YXS")):
+        raise Exception('Stacks and multichannel images (' + axes + ') cannot be annotated with large_image ' + large_image + ', use no')
+
+def load_annotation_session(raw_image_path:str, annotated_image_path:str = None, large_image:str = "no",
+                            resize_factor:int = 10, cache_dir:str = None, max_cache_size:int = DEFAULT_MAX_CACHE_SIZE):
+    """Read (and downsize) the images needed to annotate an image
+    
+    This does not open napari, so it can run in the background while another image is being annotated.
     
     Args:
-        raw_image_path    : path to a raw image
-        label_img_depth   : depth of the output (labelled) image 
-        resize_factor : resizing factor
+        raw_image_path       : path to a raw image
+        annotated_image_path : path to uncorrected annotations (None to start from an empty label image)
+        large_image          : is the image large? (yes- performs resizing, pyramid- annotates at full resolution, no)
+        resize_factor        : resizing factor
+        cache_dir            : directory to cache the downsized image/pyramid in (None disables the cache)
+        max_cache_size       : size limit of the cache directory in bytes
+        
+    Return:
+        A dictionary with the image to display (base_image), the labels to edit (label_image, None if there are no annotations),
+        the shape of the raw image (raw_shape), the shape of the labels to display (label_shape), the channel axis of the base image
+        (channel_axis, None if there is none), whether the base image is a pyramid (multiscale), whether it was downsized (downsized)
+        and the resizing factor (resize_factor). Downsized sessions also keep the downsized labels before any edit (original_labels)
+        and the path to the annotations (annotated_image_path) so that only the edits are upsampled (see run_correction_session)
+    """
+    
+    #Open the images (pixels are only read strip by strip while downsizing) and check their sizes before reading the pixels
+    raw_shape = read_image_shape(raw_image_path)
+    axes = read_image_axes(raw_image_path)
+    lab_img = None
+    if annotated_image_path is not None:
+        lab_img = open_image(annotated_image_path)
+        if (label_shape(raw_shape, axes) != lab_img.shape):
+            raise Exception('The raw and annotated images have different sizes')
+    if (large_image != "no"):
+        _check_2d_image(axes, large_image)
+    channel_axis = axes.find("C") if "C" in axes else None
+    
+    if(large_image == "yes"):
+        #Downsize image to make the annotation easier (napari does not handle large images gracefully!)
+        base_image = cached_display_image(raw_image_path, resize_factor, cache_dir, max_cache_size)
+        if lab_img is not None:
+            lab_img = downsize_labels(lab_img, resize_factor)
+    elif(large_image == "pyramid"):
+        #build the pyramid (napari only reads the visible part of the full resolution level)
+        base_image = cached_pyramid(raw_image_path, cache_dir, max_cache_size)
+    elif(large_image == "no" and axes in ("YX", "YXS")):
+        base_image = cv2.normalize(np.asarray(open_image(raw_image_path)), None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+    elif(large_image == "no"):
+        # stacks are shown as they are (napari sets the contrast of each channel), read once
+        base_image = np.asarray(open_image(raw_image_path))
+    else:
+        raise Exception('Invalid inpur for large_image: should be among {"yes","pyramid","no"}')
+    
+    # napari edits the labels in place, make sure they are a writable in-memory copy
+    if (lab_img is not None and large_image != "yes"):
+        lab_img = np.array(lab_img)
+    
+    display_shape = base_image[0].shape[:2] if large_image == "pyramid" else base_image.shape[:2]
+    session = {"base_image": base_image, "label_image": lab_img, "raw_shape": raw_shape,
+               "label_shape": label_shape(raw_shape, axes) if large_image == "no" else display_shape, "channel_axis": channel_axis,
+               "multiscale": large_image == "pyramid", "downsized": large_image == "yes", "resize_factor": resize_factor}
+    if (large_image == "yes" and lab_img is not None):
+        session.update(original_labels = lab_img.copy(), annotated_image_path = annotated_image_path)
+    
+    return session
 
+def load_region_overview(raw_image_path:str, label_image_path:str, resize_factor:int = 10,
+                         cache_dir:str = None, max_cache_size:int = DEFAULT_MAX_CACHE_SIZE):
+    """Read the downsized image and labels to pick the regions to correct on (see run_region_session)
+    
+    Args:
+        raw_image_path   : path to a raw image
+        label_image_path : path to the labels to correct
+        resize_factor    : resizing factor of the overview
+        cache_dir        : directory to cache the downsized image in (None disables the cache)
+        max_cache_size   : size limit of the cache directory in bytes
+        
+    Return:
+        A dictionary with the overview image (base_image) and labels (label_image), the shape of the raw image (raw_shape)
+        and the resizing factor (resize_factor)
     """
-    #Read image
-    raw_img = imread(raw_image_path)
+    raw_shape = read_image_shape(raw_image_path)
+    _check_2d_image(read_image_axes(raw_image_path), "roi")
+    lab_img = open_image(label_image_path)
+    if (raw_shape[0]!=lab_img.shape[0] or raw_shape[1]!=lab_img.shape[1]):
+        raise Exception('The raw and annotated images have different sizes')
+    
+    return {"base_image": cached_display_image(raw_image_path, resize_factor, cache_dir, max_cache_size),
+            "label_image": downsize_labels(lab_img, resize_factor), "raw_shape": raw_shape, "resize_factor": resize_factor}
 
-    #Downsize image to make the annotation easier (napari does not handle large images gracefully!)
-    image_resized = cv2.resize(raw_img, dsize=((raw_img.shape[0] // resize_factor),(raw_img.shape[1] // resize_factor)))
-    image_resized = cv2.normalize(image_resized, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+def load_region(raw_image_path:str, label_image_path:str, region):
+    """Read a window of an image and of its labels at full resolution (only the rows of the window are read from disk)
+    
+    Args:
+        raw_image_path   : path to a raw image
+        label_image_path : path to the labels
+        region           : (row_start, row_end, col_start, col_end) of the window
+        
+    Return:
+        The 8 bit window of the image and a writable copy of the window of the labels
+    """
+    row_start, row_end, col_start, col_end = region
+    raw_window = np.asarray(open_image(raw_image_path)[row_start:row_end, col_start:col_end])
+    label_window = np.array(open_image(label_image_path)[row_start:row_end, col_start:col_end])
+    
+    return cv2.normalize(raw_window, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U), label_window
 
-    #generate the labels
-    updated_labels = generate_object_labels(image_resized)
+def _paste_overlap(label_window, region, corrected_labels, corrected_region):
+    """Copy the part of a corrected window that overlaps another window into it"""
+    row_start, row_end = max(region[0], corrected_region[0]), min(region[1], corrected_region[1])
+    col_start, col_end = max(region[2], corrected_region[2]), min(region[3], corrected_region[3])
+    if (row_end > row_start and col_end > col_start):
+        label_window[row_start - region[0]:row_end - region[0], col_start - region[2]:col_end - region[2]] = \
+            corrected_labels[row_start - corrected_region[0]:row_end - corrected_region[0], col_start - corrected_region[2]:col_end - corrected_region[2]]
 
+def run_region_session(overview:dict, raw_image_path:str, label_image_path:str, reuse_viewer:bool = False):
+    """Pick regions on an overview and correct each of them at full resolution
+    
+    Draw rectangles around the regions to correct on the overview and close the window (or press Shift-N), each region is
+    then opened at full resolution in turn. Nothing outside the regions is read at full resolution.
+    
+    Args:
+        overview         : overview returned by load_region_overview
+        raw_image_path   : path to the raw image
+        label_image_path : path to the labels to correct
+        reuse_viewer     : use the shared viewer instead of creating new ones (finish each step with Shift-N)
+        
+    Return:
+        A list of (region, corrected labels of the region), see write_region_corrections
+    """
+    with profile_stage("napari"):
+        shapes = napari_select_regions(overview["base_image"], overview["label_image"], reuse_viewer = reuse_viewer)
+    regions = regions_from_shapes(shapes, overview["resize_factor"], overview["raw_shape"])
+    
+    corrections = []
+    for region in regions:
+        with profile_stage("read"):
+            base_window, label_window = load_region(raw_image_path, label_image_path, region)
+        
+        # overlapping regions start from the corrections already made
+        for corrected_region, corrected_labels in corrections:
+            _paste_overlap(label_window, region, corrected_labels, corrected_region)
+        
+        with profile_stage("napari"):
+            corrected_labels = napari_interactive_annotation(base_window, label_window, reuse_viewer = reuse_viewer)
+        corrections.append((region, corrected_labels))
+    
+    return corrections
+
+def write_region_corrections(annotated_image_path:str, output_image_path:str, corrections:list,
+                             label_img_depth:str = None, overwrite_output:bool = False):
+    """Write the corrected regions into the output labels
+    
+    The output starts as a copy of the uncorrected annotations (unless it already exists, e.g. from a previous session)
+    and only the windows of the regions are written, the labels outside them stay unchanged (see write_image_windows): in place
+    for TIFFs, tiled or compressed TIFFs only encode again the tiles the regions overlap. The output is only encoded as a whole
+    when it is converted: TIFF annotations written as sparse labels (see annotate.sparse_labels) and the other way around,
+    or annotations cast to another depth, and when it is sparse labels (which cannot be patched).
+    
+    Args:
+        annotated_image_path : path to the uncorrected annotations (TIFF or sparse labels)
+        output_image_path    : path to the corrected annotations (TIFF or sparse labels)
+        corrections          : list of (region, corrected labels of the region) from run_region_session or run_correction_session
+        label_img_depth      : depth of the output, if the annotations have another depth they are cast before the regions
+                               are written (None keeps the depth of the annotations)
+        overwrite_output     : start from a copy of the uncorrected annotations even if the output already exists
+    """
+    output_format = "sparse" if is_sparse_path(output_image_path) else "tif"
+    output_dtype = None if label_img_depth is None else label_image_dtype(0, label_img_depth)
+    if (overwrite_output or not os.path.exists(output_image_path)):
+        source_image_path = annotated_image_path
+    elif (output_dtype is not None and read_image_dtype(output_image_path) != output_dtype):
+        source_image_path = output_image_path
+    else:
+        source_image_path = None
+    
+    if (source_image_path is not None):
+        if (output_dtype is not None and read_image_dtype(source_image_path) != output_dtype):
+            write_label_image(output_image_path, cast_label_image(np.asarray(open_image(source_image_path)), label_img_depth), output_format)
+        elif (is_sparse_path(source_image_path) != is_sparse_path(output_image_path)):
+            write_label_image(output_image_path, np.asarray(open_image(source_image_path)), output_format)
+        elif (source_image_path != output_image_path):
+            shutil.copyfile(source_image_path, output_image_path)
+    
+    write_image_windows(output_image_path, corrections)
+
+def edited_tiles(original_labels, updated_labels, tile_size:int = EDIT_TILE_SIZE):
+    """Tiles of a label image in which labels were edited
+    
+    Args:
+        original_labels : labels before the edits
+        updated_labels  : labels after the edits
+        tile_size       : size of the tiles in pixels
+    
+    Return:
+        A list of (row_start, row_end, col_start, col_end) of the tiles with at least one edited pixel
+    """
+    edited = (original_labels != updated_labels)
+    if not edited.any():
+        return []
+    
+    # any edited pixel in each tile
+    row_starts, col_starts = np.arange(0, edited.shape[0], tile_size), np.arange(0, edited.shape[1], tile_size)
+    edited_tile = np.logical_or.reduceat(np.logical_or.reduceat(edited, row_starts, axis=0), col_starts, axis=1)
+    
+    return [(int(row_starts[i]), int(min(row_starts[i] + tile_size, edited.shape[0])),
+             int(col_starts[j]), int(min(col_starts[j] + tile_size, edited.shape[1]))) for i, j in zip(*np.nonzero(edited_tile))]
+
+def upsample_edited_tiles(full_labels, original_labels, updated_labels, resize_factor:int, tile_size:int = EDIT_TILE_SIZE):
+    """Merge the edits made on downsized labels into the full resolution labels
+    
+    Only the tiles with edits are read at full resolution, and in them only the pixels under an edited downsized pixel change:
+    the untouched labels keep their full resolution outlines.
+    
+    Args:
+        full_labels     : full resolution labels (e.g. memory-mapped with open_image)
+        original_labels : downsized labels before the edits (see downsize_labels)
+        updated_labels  : downsized labels after the edits
+        resize_factor   : resizing factor of the downsized labels
+        tile_size       : size of the tiles in which edits are tracked (in downsized pixels)
+    
+    Return:
+        A list of (region, corrected full resolution labels of the region), see write_region_corrections
+    """
+    corrections = []
+    for row_start, row_end, col_start, col_end in edited_tiles(original_labels, updated_labels, tile_size):
+        # the partial blocks along the edges of the downsized labels are cropped to the full resolution labels
+        region = (row_start * resize_factor, min(row_end * resize_factor, full_labels.shape[0]),
+                  col_start * resize_factor, min(col_end * resize_factor, full_labels.shape[1]))
+        window = np.array(full_labels[region[0]:region[1], region[2]:region[3]])
+        
+        # nearest neighbour upsampling of the edited pixels
+        edited = (original_labels[row_start:row_end, col_start:col_end] != updated_labels[row_start:row_end, col_start:col_end])
+        edited = np.repeat(np.repeat(edited, resize_factor, axis=0), resize_factor, axis=1)[:window.shape[0], :window.shape[1]]
+        tile_labels = np.repeat(np.repeat(updated_labels[row_start:row_end, col_start:col_end], resize_factor, axis=0), resize_factor, axis=1)
+        window[edited] = tile_labels[:window.shape[0], :window.shape[1]][edited]
+        
+        corrections.append((region, window))
+    
+    return corrections
+
+def run_correction_session(session:dict, reuse_viewer:bool = False):
+    """Interactively correct the downsized labels of a session loaded with load_annotation_session (large_image = "yes")
+    
+    Only the tiles that were edited are upsampled and merged into the full resolution labels (see upsample_edited_tiles),
+    so the cost of saving the corrections scales with the size of the edits rather than the size of the image.
+    
+    Args:
+        session      : images returned by load_annotation_session
+        reuse_viewer : use the shared viewer instead of creating a new one (finish the image with Shift-N)
+        
+    Return:
+        A list of (region, corrected full resolution labels of the region), see write_region_corrections
+    """
+    with profile_stage("napari"):
+        updated_labels = napari_interactive_annotation(session["base_image"], session["label_image"], reuse_viewer = reuse_viewer)
+    
+    with profile_stage("upsize"):
+        corrections = upsample_edited_tiles(open_image(session["annotated_image_path"]), session["original_labels"], updated_labels,
+                                            session["resize_factor"])
+    
+    return corrections
+
+def run_annotation_session(session:dict, label_img_depth:str = "8bit", reuse_viewer:bool = False):
+    """Interactively annotate/correct an image loaded with load_annotation_session
+    
+    Args:
+        session         : images returned by load_annotation_session
+        label_img_depth : depth of the output (labelled) image 
+        reuse_viewer    : use the shared viewer instead of creating a new one (finish the image with Shift-N)
+        
+    Return:
+        Labels at the full resolution of the raw image
+    """
+    
+    label_image = session["label_image"]
+    if label_image is None:
+        # add an empty image to the image 
+        label_image = np.zeros(session["label_shape"], dtype=label_image_dtype(0, label_img_depth))
+    
+    with profile_stage("napari"):
+        updated_labels = napari_interactive_annotation(session["base_image"], label_image, multiscale = session["multiscale"],
+                                                       reuse_viewer = reuse_viewer, channel_axis = session["channel_axis"])
+    
     #upsize image
-    labelled_image_upsized = cv2.resize(updated_labels, dsize=(raw_img.shape[0],raw_img.shape[1]), interpolation = cv2.INTER_NEAREST)
+    if session["downsized"]:
+        raw_shape = session["raw_shape"]
+        with profile_stage("upsize"):
+            updated_labels = upsize_labels(updated_labels, session["resize_factor"], raw_shape)
     
     # correct image depth
-    if (label_img_depth == "8bit"):
-        labelled_image_upsized = cv2.normalize(labelled_image_upsized, None, 0, np.max(updated_labels), cv2.NORM_MINMAX, cv2.CV_8U)
-    elif (label_img_depth == "16bit"):
-        labelled_image_upsized = cv2.normalize(labelled_image_upsized, None, 0, np.max(updated_labels), cv2.NORM_MINMAX, cv2.CV_16U)
-    else:
-        raise Exception('Invalid input: should be among {8bit, 16bit}')
+    with profile_stage("label_depth"):
+        updated_labels = cast_label_image(updated_labels, label_img_depth)
+    
+    return updated_labels
+
+def generate_labels_large_image(raw_image_path:str,label_img_depth:str = "8bit",resize_factor:int =10,
+                                cache_dir:str = None,max_cache_size:int = DEFAULT_MAX_CACHE_SIZE):
+    """Perform interactive annotation of a large image
+    
+    Args:
+        raw_image_path    : path to a raw image
+        label_img_depth   : depth of the output (labelled) image 
+        resize_factor : resizing factor
+        cache_dir     : directory to cache the downsized image in (None disables the cache)
+        max_cache_size : size limit of the cache directory in bytes
+
+    """
+    session = load_annotation_session(raw_image_path, large_image = "yes", resize_factor = resize_factor,
+                                      cache_dir = cache_dir, max_cache_size = max_cache_size)
+    
+    return run_annotation_session(session, label_img_depth)
+
+def generate_labels_pyramid(raw_image_path:str,label_img_depth:str = "8bit",
+                            cache_dir:str = None,max_cache_size:int = DEFAULT_MAX_CACHE_SIZE):
+    """Perform interactive annotation of a large image at full resolution using a multiscale pyramid
+    
+    Args:
+        raw_image_path    : path to a raw image
+        label_img_depth   : depth of the output (labelled) image 
+        cache_dir         : directory to cache the pyramid levels in (None disables the cache)
+        max_cache_size    : size limit of the cache directory in bytes
+    
+    Return:
+        Segmented image
+    """
+    session = load_annotation_session(raw_image_path, large_image = "pyramid",
+                                      cache_dir = cache_dir, max_cache_size = max_cache_size)
     
-    return labelled_image_upsized           
+    return run_annotation_session(session, label_img_depth)
 
 def generate_labels(raw_image_path,label_img_depth = "8bit"):
     """Perform interactive annotation of an image
@@ -99,65 +531,84 @@ def generate_labels(raw_image_path,label_img_depth = "8bit"):
     Return:
         Segmented image
     """
-    #Read image
-    raw_img = imread(raw_image_path)
-    raw_img = cv2.normalize(raw_img, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
-
-    #generate the labels
-    updated_labels = generate_object_labels(raw_img)
-
-    # correct image depth
-    if (label_img_depth == "8bit"):
-        updated_labels = cv2.normalize(updated_labels, None, 0, np.max(updated_labels), cv2.NORM_MINMAX, cv2.CV_8U)
-    elif (label_img_depth == "16bit"):
-        updated_labels = cv2.normalize(updated_labels, None, 0, np.max(updated_labels), cv2.NORM_MINMAX, cv2.CV_16U)
-    else:
-        raise Exception('Invalid input: should be among {8bit, 16bit}')
-   
-    return updated_labels
+    session = load_annotation_session(raw_image_path, large_image = "no")
+    
+    return run_annotation_session(session, label_img_depth)
 
 def correcting_annotation_large_image(raw_image_path:str, annotated_image_path:str,
-                                      label_img_depth:str = "8bit",resize_factor:int = 10):
+                                      label_img_depth:str = "8bit",resize_factor:int = 10,
+                                      cache_dir:str = None,max_cache_size:int = DEFAULT_MAX_CACHE_SIZE):
     """Correct annotation of an image
     
+    The annotations are corrected on a downsized image and only the edited tiles are upsampled (see run_correction_session),
+    the labels that were not edited keep their full resolution.
+    
     Args:
         raw_image_path    : path to a raw image
         anno_image_path   : path to uncorrected annotations
         label_img_depth   : depth of the output image 
         resize_factor     : resizing factor
+        cache_dir         : directory to cache the downsized image in (None disables the cache)
+        max_cache_size    : size limit of the cache directory in bytes
         
     Return:
         Corrected image
     """
+    session = load_annotation_session(raw_image_path, annotated_image_path, large_image = "yes", resize_factor = resize_factor,
+                                      cache_dir = cache_dir, max_cache_size = max_cache_size)
+    corrections = run_correction_session(session)
     
-    #Read images
-    raw_img = imread(raw_image_path)
-    lab_img = imread(annotated_image_path)
+    # merge the upsampled edits into the full resolution labels
+    corrected_labels = np.array(open_image(annotated_image_path))
+    for (row_start, row_end, col_start, col_end), corrected_window in corrections:
+        corrected_labels[row_start:row_end, col_start:col_end] = corrected_window
     
-    if (raw_img.shape[0]!=lab_img.shape[0] or raw_img.shape[1]!=lab_img.shape[1]):
-        raise Exception('The raw and annotated images have different sizes')
+    return cast_label_image(corrected_labels, label_img_depth)
+
+def correcting_annotation_pyramid(raw_image_path:str, annotated_image_path:str,label_img_depth:str = "8bit",
+                                  cache_dir:str = None,max_cache_size:int = DEFAULT_MAX_CACHE_SIZE):
+    """Correct annotation of a large image at full resolution using a multiscale pyramid
     
-    #Downsize image to make the annotation easier (napari does not handle large images gracefully!)
-    image_resized = cv2.resize(raw_img, dsize=((raw_img.shape[0] // resize_factor),(raw_img.shape[1] // resize_factor)))
-    image_resized = cv2.normalize(image_resized, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+    Args:
+        raw_image_path    : path to a raw image
+        anno_image_path   : path to uncorrected annotations
+        label_img_depth   : depth of the output image 
+        cache_dir         : directory to cache the pyramid levels in (None disables the cache)
+        max_cache_size    : size limit of the cache directory in bytes
+        
+    Return:
+        Corrected image
+    """
+    session = load_annotation_session(raw_image_path, annotated_image_path, large_image = "pyramid",
+                                      cache_dir = cache_dir, max_cache_size = max_cache_size)
     
-    label_resized = cv2.resize(lab_img, dsize=((lab_img.shape[0] // resize_factor),(lab_img.shape[1] // resize_factor)))
+    return run_annotation_session(session, label_img_depth)
 
-    updated_labels = napari_interactive_annotation(image_resized,label_resized)
+def correcting_annotation_regions(raw_image_path:str, annotated_image_path:str, output_image_path:str, resize_factor:int = 10,
+                                  cache_dir:str = None, max_cache_size:int = DEFAULT_MAX_CACHE_SIZE):
+    """Correct regions of a large image at full resolution and write back only their windows
     
-    #upsize image
-    labelled_image_upsized = cv2.resize(updated_labels, dsize=(raw_img.shape[0],raw_img.shape[1]), interpolation = cv2.INTER_NEAREST)
+    The regions are picked on a downsized overview, only their windows are read at full resolution and written back
+    (see run_region_session). If the output already exists the regions are corrected on top of it.
+    The labels keep the depth of the uncorrected annotations.
     
-     # correct image depth
-    if (label_img_depth == "8bit"):
-        labelled_image_upsized = cv2.normalize(labelled_image_upsized, None, 0, np.max(updated_labels), cv2.NORM_MINMAX, cv2.CV_8U)
-    elif (label_img_depth == "16bit"):
-        labelled_image_upsized = cv2.normalize(labelled_image_upsized, None, 0, np.max(updated_labels), cv2.NORM_MINMAX, cv2.CV_16U)
-    else:
-        raise Exception('Invalid input: should be among {8bit, 16bit}')
+    Args:
+        raw_image_path       : path to a raw image
+        annotated_image_path : path to uncorrected annotations
+        output_image_path    : path to the corrected annotations
+        resize_factor        : resizing factor of the overview
+        cache_dir            : directory to cache the downsized image in (None disables the cache)
+        max_cache_size       : size limit of the cache directory in bytes
+        
+    Return:
+        The corrected regions
+    """
+    label_image_path = output_image_path if os.path.exists(output_image_path) else annotated_image_path
+    overview = load_region_overview(raw_image_path, label_image_path, resize_factor, cache_dir, max_cache_size)
+    corrections = run_region_session(overview, raw_image_path, label_image_path)
+    write_region_corrections(annotated_image_path, output_image_path, corrections)
     
-
-    return labelled_image_upsized
+    return [region for region, _ in corrections]
 
 def correcting_annotation(raw_image_path:str, annotated_image_path:str,label_img_depth:str = "8bit"):
     """Correct annotation of an image
@@ -170,29 +621,6 @@ def correcting_annotation(raw_image_path:str, annotated_image_path:str,label_img
     Return:
         Corrected image
     """
+    session = load_annotation_session(raw_image_path, annotated_image_path, large_image = "no")
     
-    #Read images
-    raw_img = imread(raw_image_path)
-    lab_img = imread(annotated_image_path)
-    
-    if (raw_img.shape[0]!=lab_img.shape[0] or raw_img.shape[1]!=lab_img.shape[1]):
-        raise Exception('The raw and annotated images have different sizes')
-    
-    raw_img = cv2.normalize(raw_img, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
-    
-    #coorect annoations
-    updated_labels = napari_interactive_annotation(raw_img,lab_img)
-    
-    
-     # correct image depth
-    if (label_img_depth == "8bit"):
-        updated_labels = cv2.normalize(updated_labels, None, 0, np.max(updated_labels), cv2.NORM_MINMAX, cv2.CV_8U)
-    elif (label_img_depth == "16bit"):
-        updated_labels = cv2.normalize(updated_labels, None, 0, np.max(updated_labels), cv2.NORM_MINMAX, cv2.CV_16U)
-    else:
-        raise Exception('Invalid input: should be among {8bit, 16bit}')
-    
-
-    return updated_labels
-    
-    
\ No newline at end of file
+    return run_annotation_session(session, label_img_depth)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+from contextlib import contextmanager
+import numpy as np
+from tifffile import imwrite
+
+from annotate.tiled_segmentation import iter_tiles
+from annotate.sparse_labels import SPARSE_EXTENSION, encode_labels, encode_label_tiles, write_sparse_labels
+
+# zarr is optional, it is only needed to write OME-Zarr outputs
+try:
+    import zarr
+    import numcodecs
+except ImportError:
+    zarr = None
+
+# formats of the label images written by the batch functions:
+#   tif       - plain (single strip) TIFF, as written by imsave
+#   tiled_tif - tiled TIFF (BigTIFF for large images), compressed with zlib by default
+#   ome_zarr  - OME-Zarr directory with a multiscale pyramid of the labels
+#   sparse    - runs of the labels grouped by object (see annotate.sparse_labels), for labels covering a small part of the image
+OUTPUT_FORMATS = ("tif", "tiled_tif", "ome_zarr", "sparse")
+
+# compressions of the outputs (zstd needs imagecodecs for TIFFs)
+COMPRESSIONS = ("none", "zlib", "zstd", "lzma")
+
+# size of the tiles/chunks of the outputs when the labels are not written from a tiled segmentation
+OUTPUT_TILE_SIZE = 512
+
+# TIFFs larger than this are written as BigTIFF (same limit as tifffile)
+BIGTIFF_SIZE = 2**32 - 2**25
+
+# stop adding pyramid levels to OME-Zarr outputs once the smaller side of a level would drop below this size
+MIN_PYRAMID_SIZE = 512
+
+def output_extension(output_format:str = "tif"):
+    """File extension of the outputs written in a format (see OUTPUT_FORMATS)"""
+    if output_format not in OUTPUT_FORMATS:
+        raise Exception('Invalid input for output_format: should be among {"tif","tiled_tif","ome_zarr","sparse"}')
+    if (output_format == "sparse"):
+        return SPARSE_EXTENSION
+    return ".ome.zarr" if output_format == "ome_zarr" else ".tif"
+
+def check_output_format(output_format:str = "tif", tile_size:int = None, compression:str = None, label_ndim:int = 2):
+    """Check that labels can be written in a format before segmenting anything
+
+    Args:
+        output_format : tif, tiled_tif, ome_zarr or sparse (see OUTPUT_FORMATS)
+        tile_size     : size of the tiles of a tiled segmentation (None if the images are segmented as a whole)
+        compression   : compression of the outputs (see write_label_image)
+        label_ndim    : number of dimensions of the labels (more than 2 for label stacks)
+    """
+    output_extension(output_format)
+    compression = _default_compression(output_format, compression)
+    if (label_ndim > 2 and output_format not in ("tif", "tiled_tif")):
+        raise Exception('Label stacks can only be written as tif or tiled_tif')
+    if (output_format == "tiled_tif" and tile_size is not None and tile_size % 16 != 0):
+        raise Exception('Invalid tile size for a tiled TIFF: should be a multiple of 16')
+    if (output_format == "ome_zarr" and zarr is None):
+        raise Exception('Writing OME-Zarr outputs needs zarr (pip install zarr)')
+    if (output_format in ("tif", "tiled_tif") and compression != "none"):
+        # tifffile only finds out that a codec is missing (e.g. imagecodecs for zstd) when it writes, try it on a small tile
+        try:
+            imwrite(io.BytesIO(), np.zeros((16, 16), dtype = np.uint8), tile = (16, 16), **_tiff_compression_args(compression))
+        except Exception:
+            raise Exception('Writing ' + compression + ' compressed TIFFs needs imagecodecs (pip install imagecodecs)')
+
+@contextmanager
+def _replaced_output(output_path:str):
+    """Temporary path to write an output to, moved to the output path once it was written completely
+
+    A failed write (e.g. a missing codec or a full disk) never leaves a truncated output that a resumed run would skip.
+    """
+    directory, name = os.path.split(output_path)
+    tmp_path = os.path.join(directory, ".tmp_" + name)
+    try:
+        yield tmp_path
+        # OME-Zarr outputs are directories, which cannot be replaced while they hold files
+        if os.path.isdir(output_path):
+            shutil.rmtree(output_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _default_compression(output_format, compression):
+    """Compression of an output, tiled formats are compressed with zlib unless told otherwise"""
+    if compression is None:
+        compression = "none" if output_format == "tif" else "zlib"
+    if compression not in COMPRESSIONS:
+        raise Exception('Invalid input for compression: should be among {"none","zlib","zstd","lzma"}')
+    return compression
+
+def _tiff_compression_args(compression):
+    """tifffile arguments of a compression (horizontal differencing makes the runs of equal labels compress much better)"""
+    if compression == "none":
+        return {}
+    return {"compression": compression, "predictor": True}
+
+def _zarr_compressor(compression):
+    """numcodecs compressor of a compression"""
+    if compression == "none":
+        return None
+    if compression == "zlib":
+        return numcodecs.Zlib(level = 6)
+    if compression == "zstd":
+        return numcodecs.Zstd(level = 3)
+    return numcodecs.LZMA()
+
+def write_label_image(output_path:str, label_image, output_format:str = "tif", compression:str = None, axes:str = None):
+    """Write a label image
+
+    Args:
+        output_path   : path to the output (see output_extension)
+        label_image   : labelled image (or label stack, written as tif or tiled_tif)
+        output_format : tif, tiled_tif, ome_zarr or sparse (see OUTPUT_FORMATS)
+        compression   : none, zlib, zstd or lzma (None is zlib for tiled formats and none for tif, sparse labels are always zlib compressed)
+        axes          : axes of a label stack, e.g. ZYX (stacks written without axes are read back as QYX, or SYX for 3 planes)
+    """
+    compression = _default_compression(output_format, compression)
+    stack_args = {"metadata": {"axes": axes}} if (label_image.ndim > 2 and axes is not None) else {}
+    
+    if (output_format == "sparse"):
+        with _replaced_output(output_path) as tmp_path:
+            write_sparse_labels(tmp_path, encode_labels(label_image))
+        return
+
+    if (output_format == "tif"):
+        with _replaced_output(output_path) as tmp_path:
+            imwrite(tmp_path, label_image, **stack_args, **_tiff_compression_args(compression))
+        return
+    
+    if (label_image.ndim > 2):
+        # stacks are written as a single TIFF with one tiled page per plane
+        if (output_format != "tiled_tif"):
+            raise Exception('Label stacks can only be written as tif or tiled_tif')
+        with _replaced_output(output_path) as tmp_path:
+            imwrite(tmp_path, label_image, tile = (OUTPUT_TILE_SIZE, OUTPUT_TILE_SIZE), bigtiff = label_image.nbytes > BIGTIFF_SIZE,
+                    **stack_args, **_tiff_compression_args(compression))
+        return
+
+    tiles = ((tile, label_image[tile[0]:tile[1], tile[2]:tile[3]]) for tile in iter_tiles(label_image.shape, OUTPUT_TILE_SIZE))
+    write_label_tiles(output_path, label_image.shape, label_image.dtype, tiles, OUTPUT_TILE_SIZE, output_format, compression)
+
+def write_label_tiles(output_path:str, shape, dtype, tiles, tile_size:int, output_format:str = "tiled_tif", compression:str = None):
+    """Write a label image tile by tile, so that the whole image never has to be held in memory
+
+    Args:
+        output_path   : path to the output (see output_extension)
+        shape         : shape of the label image
+        dtype         : dtype of the label image
+        tiles         : generator of ((row_start, row_end, col_start, col_end), label tile) in raster order (see iter_tiles)
+        tile_size     : size of the tiles (a multiple of 16 for TIFFs)
+        output_format : tiled_tif, ome_zarr or sparse
+        compression   : none, zlib, zstd or lzma (None is zlib)
+    """
+    compression = _default_compression(output_format, compression)
+    if output_format not in ("tiled_tif", "ome_zarr", "sparse"):
+        raise Exception('Invalid input for output_format: should be among {"tiled_tif","ome_zarr","sparse"} to write tiles')
+    if (output_format == "tiled_tif" and tile_size % 16 != 0):
+        raise Exception('Invalid tile size for a tiled TIFF: should be a multiple of 16')
+
+    with _replaced_output(output_path) as tmp_path:
+        if (output_format == "tiled_tif"):
+            nbytes = shape[0] * shape[1] * np.dtype(dtype).itemsize
+            imwrite(tmp_path, (label_tile for _, label_tile in tiles), shape = shape, dtype = dtype, tile = (tile_size, tile_size),
+                    bigtiff = nbytes > BIGTIFF_SIZE, **_tiff_compression_args(compression))
+        elif (output_format == "ome_zarr"):
+            _write_ome_zarr_tiles(tmp_path, shape, dtype, tiles, tile_size, compression)
+        else:
+            write_sparse_labels(tmp_path, encode_label_tiles(shape, dtype, tiles))
+
+def _write_ome_zarr_tiles(output_path, shape, dtype, tiles, tile_size, compression):
+    """Write the tiles to the full resolution level of an OME-Zarr and build its pyramid levels from it"""
+    if zarr is None:
+        raise Exception('Writing OME-Zarr outputs needs zarr (pip install zarr)')
+
+    root = zarr.open_group(output_path, mode = 'w')
+    compressor = _zarr_compressor(compression)
+    level = root.create_dataset("0", shape = shape, chunks = (tile_size, tile_size), dtype = dtype, compressor = compressor)
+    for (row_start, row_end, col_start, col_end), label_tile in tiles:
+        level[row_start:row_end, col_start:col_end] = label_tile
+
+    # each level keeps every other pixel of the previous one (labels are never averaged), read back chunk by chunk
+    n_levels = 1
+    while (min(level.shape) // 2 >= MIN_PYRAMID_SIZE):
+        previous_level = level
+        level = root.create_dataset(str(n_levels), shape = ((previous_level.shape[0] + 1) // 2, (previous_level.shape[1] + 1) // 2),
+                                    chunks = (tile_size, tile_size), dtype = dtype, compressor = compressor)
+        for row_start, row_end, col_start, col_end in iter_tiles(level.shape, tile_size):
+            level[row_start:row_end, col_start:col_end] = np.asarray(previous_level[2 * row_start:2 * row_end, 2 * col_start:2 * col_end])[::2, ::2]
+        n_levels += 1
+
+    root.attrs["multiscales"] = [{"version": "0.4",
+                                  "axes": [{"name": "y", "type": "space"}, {"name": "x", "type": "space"}],
+                                  "datasets": [{"path": str(level_index),
+                                                "coordinateTransformations": [{"type": "scale", "scale": [2.0**level_index, 2.0**level_index]}]}
+                                               for level_index in range(n_levels)],
+                                  "type": "nearest"}]
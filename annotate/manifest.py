@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+import threading
+
+# name of the manifest written in the output directory of a batch
+MANIFEST_NAME = "manifest.json"
+
+# size of the blocks read when hashing a file
+_HASH_BLOCK_SIZE = 2**20
+
+# the manifest is updated from the writer thread of run_pipeline as well as the main thread
+_manifest_lock = threading.Lock()
+
+def file_hash(path:str):
+    """SHA-1 of the contents of a file (read block by block)"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_fingerprint(path:str, previous:dict = None):
+    """Size, modification time and hash of a file
+
+    The file is only hashed if its size or modification time differ from the previous fingerprint, so checking an unchanged
+    folder does not read the images again.
+
+    Args:
+        path     : path to the file
+        previous : fingerprint of the file recorded in the manifest (None if there is none)
+    Returns:
+        A dictionary with the size, mtime_ns and sha1 of the file
+    """
+    stat = os.stat(path)
+    if (previous is not None and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns):
+        return previous
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": file_hash(path)}
+
+def _normalize_params(params:dict):
+    """Parameters as they are stored in the manifest (JSON types, e.g. tuples become lists)"""
+    return json.loads(json.dumps(params))
+
+def load_manifest(path_to_output_dir:str):
+    """Read the manifest of an output directory
+
+    Args:
+        path_to_output_dir : path to the output directory
+    Returns:
+        A dictionary of the entries of the finished files keyed by output file name (empty if there is no manifest yet)
+    """
+    try:
+        with open(os.path.join(path_to_output_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        # no manifest (or a broken one): everything is processed again
+        return {}
+
+def save_manifest(path_to_output_dir:str, manifest:dict):
+    """Write the manifest of an output directory (to a temporary file first so that an interrupted write never breaks it)"""
+    manifest_path = os.path.join(path_to_output_dir, MANIFEST_NAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent = 1)
+    os.replace(tmp_path, manifest_path)
+
+def is_up_to_date(manifest:dict, output_path:str, input_paths:list, params:dict, extra_outputs:list = ()):
+    """Was the output written from the same inputs with the same parameters?
+
+    Args:
+        manifest      : manifest of the output directory (see load_manifest)
+        output_path   : path to the output file
+        input_paths   : paths to the input files the output is computed from
+        params        : parameters the output is computed with
+        extra_outputs : paths to the other files written along with the output (e.g. its measurement table)
+    Returns:
+        True if the output and its extra outputs exist, were recorded together and their inputs and parameters did not
+        change since they were written
+    """
+    entry = manifest.get(os.path.basename(output_path))
+    if (entry is None or not os.path.exists(output_path) or entry["params"] != _normalize_params(params)):
+        return False
+
+    extra_outputs = [os.path.abspath(extra_output) for extra_output in extra_outputs]
+    if (not set(extra_outputs) <= set(entry.get("extra_outputs", [])) or not all(os.path.exists(path) for path in extra_outputs)):
+        return False
+
+    if [os.path.abspath(input_path) for input_path in input_paths] != entry["inputs"]:
+        return False
+    try:
+        fingerprints = [file_fingerprint(input_path, previous) for input_path, previous in zip(input_paths, entry["input_fingerprints"])]
+    except FileNotFoundError:
+        return False
+    if ([fingerprint["sha1"] for fingerprint in fingerprints] != [previous["sha1"] for previous in entry["input_fingerprints"]]):
+        return False
+
+    # the inputs were only touched, keep their new modification time so that they are not hashed again on the next run
+    entry["input_fingerprints"] = fingerprints
+    return True
+
+def record_output(manifest:dict, path_to_output_dir:str, output_path:str, input_paths:list, params:dict, extra_outputs:list = ()):
+    """Record a finished output in the manifest and write it to the output directory
+
+    Args:
+        manifest           : manifest of the output directory (see load_manifest)
+        path_to_output_dir : path to the output directory
+        output_path        : path to the written output file
+        input_paths        : paths to the input files the output was computed from
+        params             : parameters the output was computed with
+        extra_outputs      : paths to the other files written along with the output (checked by is_up_to_date as well)
+    """
+    key = os.path.basename(output_path)
+    inputs = [os.path.abspath(input_path) for input_path in input_paths]
+
+    # only reuse the hashes of the same input files
+    previous = manifest.get(key)
+    if (previous is not None and previous["inputs"] == inputs):
+        previous_fingerprints = previous["input_fingerprints"]
+    else:
+        previous_fingerprints = [None] * len(input_paths)
+
+    entry = {"output": os.path.abspath(output_path),
+             "inputs": inputs,
+             "input_fingerprints": [file_fingerprint(input_path, fingerprint) for input_path, fingerprint in zip(input_paths, previous_fingerprints)],
+             "extra_outputs": [os.path.abspath(extra_output) for extra_output in extra_outputs],
+             "params": _normalize_params(params)}
+
+    with _manifest_lock:
+        manifest[key] = entry
+        save_manifest(path_to_output_dir, manifest)
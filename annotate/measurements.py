@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import os
+import csv
+import numpy as np
+
+# formats of the per-object measurement tables
+MEASUREMENT_FORMATS = ("csv", "parquet")
+
+# columns of the per-object measurement tables (bounding boxes are [min, max) as in skimage regionprops)
+MEASUREMENT_COLUMNS = ["label", "area", "centroid_row", "centroid_col", "bbox_min_row", "bbox_min_col", "bbox_max_row", "bbox_max_col",
+                       "mean_intensity", "max_intensity"]
+
+# columns of the per-batch summary
+SUMMARY_COLUMNS = ["image", "n_objects", "total_area", "mean_area", "median_area", "min_area", "max_area", "mean_intensity"]
+
+def check_measurement_format(measurement_format:str = "csv"):
+    """Check that measurements can be written in a format (see MEASUREMENT_FORMATS)"""
+    if measurement_format not in MEASUREMENT_FORMATS:
+        raise Exception('Invalid input for measurements: should be among {"csv","parquet"}')
+
+def measurements_path(path_to_output_dir:str, raw_image_path:str, measurement_format:str = "csv"):
+    """Path of the per-object measurement table of a raw image (<image name>_objects.csv or .parquet in the output directory)"""
+    check_measurement_format(measurement_format)
+    img_name = os.path.splitext(os.path.basename(raw_image_path))[0]
+    return path_to_output_dir + "/" + img_name + "_objects." + measurement_format
+
+def new_measurements():
+    """Empty per-object accumulators, filled tile by tile with add_tile_measurements"""
+    return {"area": np.zeros(1, dtype=np.int64),
+            "row_sum": np.zeros(1), "col_sum": np.zeros(1), "intensity_sum": np.zeros(1),
+            "max_intensity": np.full(1, -np.inf),
+            "min_row": np.full(1, np.iinfo(np.int64).max), "min_col": np.full(1, np.iinfo(np.int64).max),
+            "max_row": np.full(1, -1), "max_col": np.full(1, -1)}
+
+def _grow(measurements, n_labels):
+    """Extend the accumulators to n_labels entries (labels are not known in advance when measuring tile by tile)"""
+    size = measurements["area"].size
+    if (n_labels <= size):
+        return
+    for name, values in measurements.items():
+        fill = values[0] if name != "area" else 0
+        measurements[name] = np.concatenate([values, np.full(n_labels - size, fill, dtype=values.dtype)])
+
+def add_tile_measurements(measurements:dict, label_tile, raw_tile, row_offset:int = 0, col_offset:int = 0):
+    """Add the pixels of a tile to the per-object accumulators
+
+    Each row of the tile is split into runs of equal labels, the intensities of a run are summed (and their maximum taken)
+    with a single reduceat over the tile, and everything else is accumulated per run rather than per pixel.
+
+    Args:
+        measurements : accumulators from new_measurements
+        label_tile   : labels of the tile
+        raw_tile     : raw intensities of the tile
+        row_offset   : row of the tile in the image
+        col_offset   : column of the tile in the image
+    """
+    label_tile = np.asarray(label_tile)
+    if (label_tile.size == 0):
+        return
+    labels = label_tile.ravel()
+    intensities = np.asarray(raw_tile).ravel()
+    n_cols = label_tile.shape[1]
+
+    # a run starts at the first pixel of each row and wherever the label changes
+    run_start = np.empty(labels.size, dtype=bool)
+    run_start[0] = True
+    np.not_equal(labels[1:], labels[:-1], out=run_start[1:])
+    run_start[::n_cols] = True
+    starts = np.flatnonzero(run_start)
+    del run_start
+
+    run_sums = np.add.reduceat(intensities, starts, dtype=np.float64)
+    run_max = np.maximum.reduceat(intensities, starts).astype(np.float64)
+    run_lengths = np.diff(np.append(starts, labels.size))
+    run_labels = labels[starts]
+
+    # drop the background runs
+    foreground = (run_labels > 0)
+    if not foreground.any():
+        return
+    starts, run_sums, run_max = starts[foreground], run_sums[foreground], run_max[foreground]
+    run_lengths, run_labels = run_lengths[foreground], run_labels[foreground].astype(np.intp)
+    rows, cols = np.divmod(starts, n_cols)
+    rows += row_offset
+    cols += col_offset
+
+    n_labels = int(run_labels.max()) + 1
+    _grow(measurements, n_labels)
+
+    # sums in one bincount each, extrema with unbuffered ufunc.at
+    measurements["area"][:n_labels] += np.bincount(run_labels, weights=run_lengths, minlength=n_labels).astype(np.int64)
+    measurements["row_sum"][:n_labels] += np.bincount(run_labels, weights=rows * run_lengths, minlength=n_labels)
+    measurements["col_sum"][:n_labels] += np.bincount(run_labels, weights=run_lengths * (cols + (run_lengths - 1) / 2), minlength=n_labels)
+    measurements["intensity_sum"][:n_labels] += np.bincount(run_labels, weights=run_sums, minlength=n_labels)
+    np.maximum.at(measurements["max_intensity"], run_labels, run_max)
+    np.minimum.at(measurements["min_row"], run_labels, rows)
+    np.maximum.at(measurements["max_row"], run_labels, rows)
+    np.minimum.at(measurements["min_col"], run_labels, cols)
+    np.maximum.at(measurements["max_col"], run_labels, cols + run_lengths - 1)
+
+def measurement_table(measurements:dict):
+    """Per-object measurement table of the accumulated tiles
+
+    Returns:
+        A dictionary of columns (see MEASUREMENT_COLUMNS) with one entry per object, in label order
+    """
+    object_labels = np.flatnonzero(measurements["area"])
+    object_labels = object_labels[object_labels > 0]
+    area = measurements["area"][object_labels]
+
+    return {"label": object_labels,
+            "area": area,
+            "centroid_row": measurements["row_sum"][object_labels] / area,
+            "centroid_col": measurements["col_sum"][object_labels] / area,
+            "bbox_min_row": measurements["min_row"][object_labels],
+            "bbox_min_col": measurements["min_col"][object_labels],
+            "bbox_max_row": measurements["max_row"][object_labels] + 1,
+            "bbox_max_col": measurements["max_col"][object_labels] + 1,
+            "mean_intensity": measurements["intensity_sum"][object_labels] / area,
+            "max_intensity": measurements["max_intensity"][object_labels]}
+
+def measure_objects(label_image, raw_image, rows_per_strip:int = 1024):
+    """Measure the area, centroid, bounding box and mean/max intensity of every object of a label image
+
+    The label image is read a strip of rows at a time and every measurement is accumulated with reduceat/bincount/ufunc.at
+    (see add_tile_measurements), so there is no Python loop over the objects (gives the same values as skimage regionprops).
+
+    Args:
+        label_image    : labelled image (can be a memory-mapped array)
+        raw_image      : raw image the objects were segmented from
+        rows_per_strip : number of rows to measure at a time
+
+    Returns:
+        A dictionary of columns (see MEASUREMENT_COLUMNS) with one entry per object
+    """
+    if (label_image.shape[:2] != raw_image.shape[:2]):
+        raise Exception('The raw and label images have different sizes')
+
+    measurements = new_measurements()
+    for row_start in range(0, label_image.shape[0], rows_per_strip):
+        add_tile_measurements(measurements, label_image[row_start:row_start + rows_per_strip],
+                              raw_image[row_start:row_start + rows_per_strip], row_start, 0)
+
+    return measurement_table(measurements)
+
+def measure_tiles(tiles, raw_image, measurements:dict):
+    """Measure the label tiles of a tiled segmentation as they are written (see tiled_intensity_based_segmentation)
+
+    Args:
+        tiles        : generator of ((row_start, row_end, col_start, col_end), label tile)
+        raw_image    : raw image the objects were segmented from
+        measurements : accumulators from new_measurements
+    Returns:
+        A generator of the same tiles
+    """
+    for tile, label_tile in tiles:
+        row_start, row_end, col_start, col_end = tile
+        add_tile_measurements(measurements, label_tile, raw_image[row_start:row_end, col_start:col_end], row_start, col_start)
+        yield tile, label_tile
+
+def write_measurements(table_path:str, table:dict):
+    """Write a measurement table, one row per object (CSV, or Parquet if the path ends with .parquet, which needs pandas and pyarrow)"""
+    if table_path.endswith(".parquet"):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise Exception('Writing Parquet measurements needs pandas and pyarrow (pip install pandas pyarrow)')
+        pd.DataFrame(table, columns = MEASUREMENT_COLUMNS).to_parquet(table_path, index = False)
+        return
+
+    with open(table_path, "w", newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(MEASUREMENT_COLUMNS)
+        writer.writerows(zip(*[table[column].tolist() for column in MEASUREMENT_COLUMNS]))
+
+def read_measurements(table_path:str):
+    """Read a measurement table written by write_measurements
+
+    Returns:
+        A dictionary of columns (see MEASUREMENT_COLUMNS)
+    """
+    if table_path.endswith(".parquet"):
+        import pandas as pd
+        table = pd.read_parquet(table_path)
+        return {column: table[column].to_numpy() for column in MEASUREMENT_COLUMNS}
+
+    with open(table_path, newline = "") as f:
+        rows = list(csv.DictReader(f))
+    return {column: np.array([float(row[column]) for row in rows]) for column in MEASUREMENT_COLUMNS}
+
+def summarize_measurements(table:dict):
+    """Object count, area statistics and mean intensity (over all the object pixels) of a measurement table"""
+    area = np.asarray(table["area"], dtype=np.float64)
+    if (area.size == 0):
+        return {"n_objects": 0, "total_area": 0, "mean_area": None, "median_area": None, "min_area": None, "max_area": None,
+                "mean_intensity": None}
+
+    return {"n_objects": int(area.size), "total_area": int(area.sum()), "mean_area": float(area.mean()),
+            "median_area": float(np.median(area)), "min_area": int(area.min()), "max_area": int(area.max()),
+            "mean_intensity": float((np.asarray(table["mean_intensity"]) * area).sum() / area.sum())}
+
+def write_measurement_summary(summary_path:str, image_summaries:dict):
+    """Write the per-batch summary, one row per image
+
+    Args:
+        summary_path    : path of the CSV summary
+        image_summaries : dictionary of the summaries (see summarize_measurements) keyed by image name
+    """
+    with open(summary_path, "w", newline = "") as f:
+        writer = csv.DictWriter(f, fieldnames = SUMMARY_COLUMNS)
+        writer.writeheader()
+        for image_name, image_summary in sorted(image_summaries.items()):
+            writer.writerow(dict(image = image_name, **image_summary))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+
+# marks the end of a queue
+_END = object()
+
+def run_pipeline(items, read_item, process_item, write_item, prefetch:int = 2, max_pending_writes:int = 2):
+    """Read, process and write a list of items with reading and writing overlapped with the processing
+
+    A reader thread reads up to `prefetch` items ahead and a writer thread writes the results in the background,
+    while the items are processed one at a time in the calling thread (napari has to run in the main thread).
+    Both queues are bounded, so at most prefetch + max_pending_writes + 3 items are held in memory.
+
+    Args:
+        items              : items to process (e.g. paths to images)
+        read_item          : function(item) returning the data of an item
+        process_item       : function(item, data) returning the result for an item
+        write_item         : function(item, result) writing the result of an item
+        prefetch           : number of items to read ahead
+        max_pending_writes : number of results waiting to be written before the processing blocks
+    Returns:
+        A dictionary of the items that failed and their exception (a failing item does not stop the others). Errors that are
+        not an Exception and errors raised by the items themselves are raised once the pending results are written
+    """
+
+    if (prefetch < 1 or max_pending_writes < 1):
+        raise Exception('Invalid input: prefetch and max_pending_writes should be positive integers')
+
+    failed_items = {}
+    read_queue = queue.Queue(maxsize = prefetch)
+    write_queue = queue.Queue(maxsize = max_pending_writes)
+    stop_reading = threading.Event()
+
+    reader_errors = []
+
+    def reader():
+        try:
+            for item in items:
+                if stop_reading.is_set():
+                    break
+                try:
+                    read_queue.put((item, read_item(item), None))
+                except Exception as err:
+                    read_queue.put((item, None, err))
+        except BaseException as err:
+            # the items themselves failed (e.g. a generator), it is raised in the calling thread
+            reader_errors.append(err)
+        finally:
+            read_queue.put(_END)
+
+    def writer():
+        while True:
+            entry = write_queue.get()
+            if entry is _END:
+                break
+            item, result = entry
+            try:
+                write_item(item, result)
+            except Exception as err:
+                failed_items[item] = err
+
+    reader_thread = threading.Thread(target = reader, daemon = True)
+    writer_thread = threading.Thread(target = writer, daemon = True)
+    reader_thread.start()
+    writer_thread.start()
+
+    try:
+        while True:
+            entry = read_queue.get()
+            if entry is _END:
+                break
+            item, data, err = entry
+            if err is not None:
+                failed_items[item] = err
+                continue
+
+            try:
+                result = process_item(item, data)
+            except Exception as err:
+                failed_items[item] = err
+                continue
+            del data, entry
+
+            write_queue.put((item, result))
+            del result
+    finally:
+        # stop the reader (emptying the queue so that it is not blocked) and let the writer finish the pending writes
+        stop_reading.set()
+        while reader_thread.is_alive():
+            try:
+                read_queue.get(timeout = 0.1)
+            except queue.Empty:
+                pass
+        write_queue.put(_END)
+        writer_thread.join()
+
+    if reader_errors:
+        raise reader_errors[0]
+    return failed_items
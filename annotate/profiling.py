@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+import sys
+import csv
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager, nullcontext
+
+# resource is not available on Windows, the peak RSS is then not recorded
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# records of the active profiling session (None when profiling is off)
+_records = None
+_records_lock = threading.Lock()
+
+# stack of the running stages and the file being processed, per thread
+_local = threading.local()
+
+# shared no-op context returned by profile_stage/profile_file when profiling is off
+_NO_PROFILING = nullcontext()
+
+def _read_peak_rss():
+    """Peak resident set size of the process in bytes since the last _reset_peak_rss (None if unknown)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is not None:
+        # ru_maxrss is in kilobytes on linux and in bytes on macOS, and cannot be reset
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+    return None
+
+def _reset_peak_rss():
+    """Reset the peak resident set size of the process (only possible on linux)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def is_profiling():
+    """Is a profiling session active?"""
+    return _records is not None
+
+def start_profiling():
+    """Start recording the stages run by profile_stage"""
+    global _records
+    _records = []
+
+def stop_profiling(report_path:str = None):
+    """Stop recording and write the report
+
+    Args:
+        report_path : path of the report, written as CSV if it ends with .csv and as JSON otherwise (None does not write it)
+    Returns:
+        The list of recorded stages
+    """
+    global _records
+    records, _records = _records, None
+    if records is not None and report_path is not None:
+        write_report(records, report_path)
+    return records
+
+@contextmanager
+def profiling(report_path:str = None):
+    """Profile everything run inside the context and write the report when it ends (does nothing if report_path is None)
+
+    Args:
+        report_path : path of the report (.json or .csv)
+    """
+    if report_path is None:
+        yield
+        return
+
+    start_profiling()
+    try:
+        with profile_stage("total"):
+            yield
+    finally:
+        stop_profiling(report_path)
+
+def profile_file(file_path:str):
+    """Attribute the stages run inside the context (in the current thread) to a file
+
+    Args:
+        file_path : path of the file being processed
+    """
+    if _records is None:
+        return _NO_PROFILING
+    return _profile_file(file_path)
+
+@contextmanager
+def _profile_file(file_path):
+    previous_file = getattr(_local, "file", None)
+    _local.file = file_path
+    try:
+        yield
+    finally:
+        _local.file = previous_file
+
+def profile_stage(stage:str):
+    """Record the wall time, CPU time and peak RSS of the code run inside the context
+
+    The CPU time and the peak RSS are those of the whole process, so they include other threads running at the same time.
+
+    Args:
+        stage : name of the stage
+    """
+    if _records is None:
+        return _NO_PROFILING
+    return _profile_stage(stage)
+
+@contextmanager
+def _profile_stage(stage):
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+
+    # the peak RSS of a stage is the highest of its own peak and the peaks of the stages nested in it,
+    # keep the peak of the enclosing stage so far before resetting it
+    if stack:
+        stack[-1]["peak_rss"] = max(stack[-1]["peak_rss"], _read_peak_rss() or 0)
+    entry = {"peak_rss": 0}
+    stack.append(entry)
+    _reset_peak_rss()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+        peak_rss = max(_read_peak_rss() or 0, entry["peak_rss"])
+        stack.pop()
+        if stack:
+            stack[-1]["peak_rss"] = max(stack[-1]["peak_rss"], peak_rss)
+
+        record = {"file": getattr(_local, "file", None), "stage": stage, "wall_s": wall, "cpu_s": cpu,
+                  "peak_rss_mb": peak_rss / 1024**2}
+        with _records_lock:
+            if _records is not None:
+                _records.append(record)
+
+def profiled(stage:str):
+    """Decorator recording every call of a function as a stage (see profile_stage)
+
+    Args:
+        stage : name of the stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def run_profiled(func, *args, **kwargs):
+    """Run a function with profiling on and return its result along with the recorded stages
+
+    Used to profile work done in a worker process, the records are then added to the parent session with add_records.
+    """
+    start_profiling()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        records = stop_profiling()
+    return result, records
+
+def add_records(records:list):
+    """Add stages recorded elsewhere (e.g. in a worker process) to the active profiling session"""
+    with _records_lock:
+        if _records is not None:
+            _records.extend(records)
+
+def write_report(records:list, report_path:str):
+    """Write the recorded stages (and a per stage summary for JSON reports)
+
+    Args:
+        records     : recorded stages
+        report_path : path of the report, written as CSV if it ends with .csv and as JSON otherwise
+    """
+    if report_path.endswith(".csv"):
+        with open(report_path, "w", newline = "") as f:
+            writer = csv.DictWriter(f, fieldnames = ["file", "stage", "wall_s", "cpu_s", "peak_rss_mb"])
+            writer.writeheader()
+            writer.writerows(records)
+        return
+
+    summary = {}
+    for record in records:
+        stage_summary = summary.setdefault(record["stage"], {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": 0.0})
+        stage_summary["count"] += 1
+        stage_summary["wall_s"] += record["wall_s"]
+        stage_summary["cpu_s"] += record["cpu_s"]
+        stage_summary["peak_rss_mb"] = max(stage_summary["peak_rss_mb"], record["peak_rss_mb"])
+
+    with open(report_path, "w") as f:
+        json.dump({"summary": summary, "stages": records}, f, indent = 2)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+import warnings
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from tifffile import TiffFile
+
+from annotate.basic_image_processing_tasks import smoothing_dtype, label_image_dtype, GAUSSIAN_TRUNCATE, LABELLING_CHUNK_PIXELS
+from annotate.image_io import channel_axis, zarr
+
+# memory of a worker process before it reads an image (python, numpy, scipy, opencv...) when it cannot be measured
+DEFAULT_WORKER_MEMORY = 150 * 1024**2
+
+# bytes per pixel used to label a whole image besides the raw, smoothed and label images (the mask and the int32 components)
+LABELLING_BYTES_PER_PIXEL = 5
+
+# bytes per pixel of the temporaries of the chunks of the labelling (see LABELLING_CHUNK_PIXELS)
+CHUNK_BYTES_PER_PIXEL = 8
+
+# bytes per pixel of a tile of a tiled segmentation (the smoothed tile with its halo, its mask, the int64 tile labels and their remapping)
+TILE_BYTES_PER_PIXEL = 40
+
+# exact Li (skimage.filters.threshold_li) holds about this many copies of the smoothed pixels it is computed on
+LI_COPIES = 4
+
+# tile sizes tried for the images that do not fit in the memory budget, largest first (multiples of 16 for tiled TIFFs)
+TILE_SIZES = (8192, 4096, 2048, 1024, 512, 256)
+
+def measure_worker_memory():
+    """Memory of a worker process before it reads an image
+
+    Measured as the resident memory of the current process, which imported the whole pipeline to plan the jobs (the workers
+    import the same modules, or are forked from it). DEFAULT_WORKER_MEMORY where it cannot be read.
+
+    Returns:
+        The memory in bytes
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return DEFAULT_WORKER_MEMORY
+
+def read_image_info(image_path:str):
+    """Shape, dtype, axes and layout of a TIFF image, read from its header only (no pixels are read)
+
+    Returns:
+        A dictionary with the shape, dtype and axes of the image, and whether its pixels can be memory-mapped (uncompressed and
+        contiguous) or are tiled
+    """
+    with TiffFile(image_path) as tif:
+        series = tif.series[0]
+        page = tif.pages[0]
+        return {"shape": tuple(series.shape), "dtype": np.dtype(series.dtype), "axes": series.axes,
+                "memmappable": series.dataoffset is not None and page.compression == 1, "tiled": bool(page.is_tiled)}
+
+def build_image_index(image_paths:list):
+    """Header information of a batch of images (see read_image_info)
+
+    Returns:
+        A dictionary of the information of each image keyed by path, and a dictionary of the errors of the images whose
+        header could not be read
+    """
+    index, failed_images = {}, {}
+    for image_path in image_paths:
+        try:
+            index[image_path] = read_image_info(image_path)
+        except Exception as err:
+            failed_images[image_path] = err
+    return index, failed_images
+
+def _segmented_shape(image_info:dict):
+    """Shape of the image that is segmented (without its channel axis)"""
+    axis = channel_axis(image_info["axes"])
+    shape = image_info["shape"]
+    return shape if axis is None else shape[:axis] + shape[axis + 1:]
+
+def _threshold_memory(n_pixels:int, smooth_bytes:int, threshold_method:str = "Otsu", thresh_sample_fraction:float = None,
+                      li_histogram:bool = False):
+    """Memory used to threshold smoothed pixels besides the smoothed image (histograms are small, exact Li copies the pixels)"""
+    if (threshold_method != "Li" or li_histogram):
+        return 0
+    return int(n_pixels * (thresh_sample_fraction or 1)) * LI_COPIES * smooth_bytes
+
+def estimate_peak_memory(image_info:dict,
+                         fil_sigma:float = 1,
+                         threshold_method:str = "Otsu",
+                         thresh_sample_fraction:float = None,
+                         li_histogram:bool = False,
+                         label_img_depth:str = "8bit",
+                         tile_size:int = None,
+                         precision:str = "float32",
+                         stack_mode:str = "3d",
+                         plane_workers:int = 1,
+                         streamed_output:bool = False):
+    """Estimate the peak memory of the segmentation of an image from the arrays of each stage of the pipeline
+
+    Whole images hold the raw image, the smoothed image, the mask, the components and the labels at the same time
+    (see simple_intensity_based_segmentation). Tiled segmentations hold a few tiles and the labels, unless they are
+    streamed to the output (see tiled_intensity_based_segmentation). Exact Li thresholds read all the smoothed pixels
+    (or the subsample) in both cases. Labels that have to be promoted to a deeper dtype are not accounted for.
+
+    Args:
+        image_info             : header information of the image (see read_image_info)
+        fil_sigma              : sigma of the gaussian filter (sets the halo of the tiles)
+        threshold_method       : threshold method
+        thresh_sample_fraction : fraction of the pixels the threshold is computed from (None uses all of them)
+        li_histogram           : is Li computed from a histogram (see thresholds_from_image)?
+        label_img_depth        : label depth
+        tile_size              : size of the tiles (None segments the whole image)
+        precision              : precision of the smoothed image (float32 or float64)
+        stack_mode             : segmentation of stacks (3d or planes)
+        plane_workers          : number of planes segmented at a time in planes mode
+        streamed_output        : are the labels of a tiled segmentation written tile by tile?
+    Returns:
+        The estimated peak memory in bytes, on top of the memory of the worker process (see measure_worker_memory)
+    """
+    shape = _segmented_shape(image_info)
+    n_pixels = int(np.prod(shape))
+    raw_bytes = image_info["dtype"].itemsize
+    smooth_bytes = np.dtype(smoothing_dtype(precision)).itemsize
+    label_bytes = np.dtype(label_image_dtype(0, label_img_depth)).itemsize
+    threshold_params = dict(threshold_method = threshold_method, thresh_sample_fraction = thresh_sample_fraction, li_histogram = li_histogram)
+
+    if (len(shape) > 2 and stack_mode == "planes"):
+        # the stack, the 16 bit labels of every plane and the labels of the stack, plus the planes being segmented
+        plane_pixels = shape[-2] * shape[-1]
+        plane_memory = plane_pixels * smooth_bytes + max(plane_pixels * LABELLING_BYTES_PER_PIXEL,
+                                                         _threshold_memory(plane_pixels, smooth_bytes, **threshold_params))
+        memory = (n_pixels * (raw_bytes + 2 + label_bytes) +
+                  min(plane_workers, n_pixels // max(plane_pixels, 1)) * plane_memory)
+    elif (tile_size is None or len(shape) > 2):
+        # the threshold is computed before labelling
+        memory = (n_pixels * (raw_bytes + smooth_bytes) +
+                  max(n_pixels * (LABELLING_BYTES_PER_PIXEL + label_bytes) + min(n_pixels, LABELLING_CHUNK_PIXELS) * CHUNK_BYTES_PER_PIXEL,
+                      _threshold_memory(n_pixels, smooth_bytes, **threshold_params)))
+    else:
+        halo = int(GAUSSIAN_TRUNCATE * fil_sigma + 0.5)
+        memory = (min(tile_size + 2 * halo, shape[0]) * min(tile_size + 2 * halo, shape[1])) * TILE_BYTES_PER_PIXEL
+        # the tiles are read from disk, unless the image can only be read as a whole
+        if not (image_info["memmappable"] or zarr is not None):
+            memory += n_pixels * raw_bytes
+        if not streamed_output:
+            memory += n_pixels * label_bytes
+        # exact Li reads the smoothed image back from its temporary file
+        threshold_memory = _threshold_memory(n_pixels, smooth_bytes, **threshold_params)
+        if (threshold_memory > 0 and thresh_sample_fraction is None):
+            threshold_memory += n_pixels * smooth_bytes
+        memory += threshold_memory
+
+    return int(memory)
+
+def plan_jobs(index:dict, max_memory:int, tile_size:int = None, streamed_output:bool = False, worker_memory:int = None,
+              **segmentation_params):
+    """Estimate the peak memory of each image and pick the images to segment in tiles to stay under a memory budget
+
+    Images whose estimate is over the budget are segmented in the largest tiles that fit in it (see TILE_SIZES). Stacks
+    cannot be tiled and images that do not fit even in the smallest tiles are segmented on their own.
+
+    Args:
+        index              : header information of the images (see build_image_index)
+        max_memory         : memory budget in bytes
+        tile_size          : tile size requested by the user (None segments the images whole when they fit)
+        streamed_output    : are the labels of tiled segmentations written tile by tile (tiled output formats)?
+        worker_memory      : memory of a worker process before it reads an image in bytes (None measures it, see measure_worker_memory)
+        segmentation_params: fil_sigma, threshold_method, thresh_sample_fraction, li_histogram, label_img_depth, precision, stack_mode
+                             and plane_workers (see estimate_peak_memory)
+    Returns:
+        A list of jobs, dictionaries with the image, its tile size and its estimated peak memory (including the worker process),
+        the largest first
+    """
+    if worker_memory is None:
+        worker_memory = measure_worker_memory()
+    if (max_memory <= worker_memory):
+        raise Exception('Invalid input for max_memory: should be over the memory of a worker process (' +
+                        str(worker_memory // 1024**2) + 'MB)')
+
+    jobs = []
+    for image_path, image_info in index.items():
+        job_tile_size = tile_size
+        memory = worker_memory + estimate_peak_memory(image_info, tile_size = job_tile_size, streamed_output = streamed_output,
+                                                      **segmentation_params)
+
+        if (memory > max_memory and job_tile_size is None and len(_segmented_shape(image_info)) == 2):
+            for job_tile_size in TILE_SIZES:
+                memory = worker_memory + estimate_peak_memory(image_info, tile_size = job_tile_size, streamed_output = streamed_output,
+                                                              **segmentation_params)
+                if (memory <= max_memory):
+                    break
+        if (memory > max_memory):
+            warnings.warn("The estimated peak memory of " + image_path + " (" + str(memory // 1024**2) + "MB) is over the memory budget, "
+                          "it is segmented on its own")
+
+        jobs.append({"image": image_path, "tile_size": job_tile_size, "memory": memory})
+
+    # start the largest jobs first so that they do not end up running alone at the end of the batch
+    return sorted(jobs, key = lambda job: job["memory"], reverse = True)
+
+def run_scheduled(jobs:list, submit_job, max_memory:int, workers:int = 1):
+    """Run jobs in a process pool, starting a job only when its estimated peak memory fits in what the running jobs leave of the budget
+
+    The first job (in order, see plan_jobs) that fits is started, so smaller jobs fill the memory left by the larger ones,
+    and a job over the whole budget is started once nothing else is running.
+    Only the running jobs count against the budget, idle worker processes of the pool keep their own memory
+    (see measure_worker_memory) on top of it.
+
+    Args:
+        jobs       : list of jobs (dictionaries with at least their estimated peak memory), in the order to start them
+        submit_job : function(pool, job) submitting a job to the pool and returning its future
+        max_memory : memory budget in bytes
+        workers    : number of worker processes
+    Returns:
+        A generator of (job, future) in the order the jobs complete
+    """
+    pending = list(jobs)
+    running = {}
+    used_memory = 0
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        while (pending or running):
+            while (pending and len(running) < workers):
+                fitting = [index for index, job in enumerate(pending) if (used_memory + job["memory"] <= max_memory or not running)]
+                if not fitting:
+                    break
+                job = pending.pop(fitting[0])
+                running[submit_job(pool, job)] = job
+                used_memory += job["memory"]
+
+            done, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                used_memory -= job["memory"]
+                yield job, future
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# extension of the sparse label files
+SPARSE_EXTENSION = ".labels.npz"
+
+# number of rows encoded at a time
+ENCODING_ROWS_PER_STRIP = 1024
+
+# sparse labels are stored as the runs of equal labels along the rows of the image, grouped by object:
+#   shape, dtype  - shape and dtype of the dense label image
+#   labels        - label of each object (sorted)
+#   bboxes        - (min_row, min_col, max_row, max_col) of each object, max excluded as in skimage regionprops
+#   run_offsets   - runs of object i are run_offsets[i]:run_offsets[i + 1]
+#   run_rows, run_cols, run_lengths - row, first column and length of each run (raster order within an object)
+
+def is_sparse_path(path:str):
+    """Is the file a sparse label file (see SPARSE_EXTENSION)?"""
+    return str(path).endswith(SPARSE_EXTENSION)
+
+def tile_runs(label_tile, row_offset:int = 0, col_offset:int = 0):
+    """Runs of equal (non-zero) labels along the rows of a tile
+
+    Args:
+        label_tile : 2D labels
+        row_offset : row of the tile in the image
+        col_offset : column of the tile in the image
+    Returns:
+        The label, row, first column and length of each run
+    """
+    label_tile = np.asarray(label_tile)
+    if (label_tile.size == 0):
+        return (np.zeros(0, dtype = label_tile.dtype),) + tuple(np.zeros(0, dtype = np.int64) for _ in range(3))
+    labels = label_tile.ravel()
+    n_cols = label_tile.shape[1]
+
+    # a run starts at the first pixel of each row and wherever the label changes
+    run_start = np.empty(labels.size, dtype = bool)
+    run_start[0] = True
+    np.not_equal(labels[1:], labels[:-1], out = run_start[1:])
+    run_start[::n_cols] = True
+    starts = np.flatnonzero(run_start)
+    lengths = np.diff(np.append(starts, labels.size))
+
+    foreground = (labels[starts] > 0)
+    starts, lengths = starts[foreground], lengths[foreground]
+    rows, cols = np.divmod(starts, n_cols)
+    return labels[starts], rows + row_offset, cols + col_offset, lengths
+
+def _sparse_from_runs(shape, dtype, run_labels, run_rows, run_cols, run_lengths):
+    """Group runs by object (merging the runs split across tiles) and compute the bounding boxes"""
+    order = np.lexsort((run_cols, run_rows, run_labels))
+    run_labels, run_rows, run_cols, run_lengths = run_labels[order], run_rows[order], run_cols[order], run_lengths[order]
+
+    # runs split at a tile border continue each other on the same row
+    if (run_labels.size > 0):
+        continued = np.concatenate([[False], (run_labels[1:] == run_labels[:-1]) & (run_rows[1:] == run_rows[:-1]) &
+                                             (run_cols[1:] == run_cols[:-1] + run_lengths[:-1])])
+        if continued.any():
+            first_runs = np.flatnonzero(~continued)
+            run_lengths = np.add.reduceat(run_lengths, first_runs)
+            run_labels, run_rows, run_cols = run_labels[first_runs], run_rows[first_runs], run_cols[first_runs]
+
+    labels, run_offsets = np.unique(run_labels, return_index = True)
+    bboxes = np.zeros((labels.size, 4), dtype = np.int64)
+    if (labels.size > 0):
+        bboxes[:, 0] = run_rows[run_offsets]
+        bboxes[:, 1] = np.minimum.reduceat(run_cols, run_offsets)
+        bboxes[:, 2] = np.maximum.reduceat(run_rows, run_offsets) + 1
+        bboxes[:, 3] = np.maximum.reduceat(run_cols + run_lengths, run_offsets)
+
+    return {"shape": np.array(shape, dtype = np.int64), "dtype": np.array(np.dtype(dtype).str),
+            "labels": labels.astype(dtype), "bboxes": bboxes,
+            "run_offsets": np.append(run_offsets, run_labels.size).astype(np.int64),
+            "run_rows": run_rows.astype(np.uint32), "run_cols": run_cols.astype(np.uint32), "run_lengths": run_lengths.astype(np.uint32)}
+
+def encode_labels(label_image, rows_per_strip:int = ENCODING_ROWS_PER_STRIP):
+    """Encode a 2D label image as sparse labels, a strip of rows at a time
+
+    Args:
+        label_image    : labelled image (numpy, memory-mapped or zarr array)
+        rows_per_strip : number of rows to encode at a time
+    Returns:
+        The sparse labels (a dictionary of arrays, see write_sparse_labels)
+    """
+    if (label_image.ndim != 2):
+        raise Exception('Only 2D label images can be stored as sparse labels')
+
+    runs = [tile_runs(label_image[row_start:row_start + rows_per_strip], row_start)
+            for row_start in range(0, label_image.shape[0], rows_per_strip)]
+    if not runs:
+        runs = [tile_runs(np.zeros((0, 0), dtype = label_image.dtype))]
+    return _sparse_from_runs(label_image.shape, label_image.dtype, *(np.concatenate(run) for run in zip(*runs)))
+
+def encode_label_tiles(shape, dtype, tiles):
+    """Encode the tiles of a tiled segmentation as sparse labels (see write_label_tiles)
+
+    Args:
+        shape : shape of the label image
+        dtype : dtype of the label image
+        tiles : generator of ((row_start, row_end, col_start, col_end), label tile)
+    Returns:
+        The sparse labels
+    """
+    runs = [tile_runs(label_tile, row_start, col_start) for (row_start, _, col_start, _), label_tile in tiles]
+    if not runs:
+        runs = [tile_runs(np.zeros((0, 0), dtype = dtype))]
+    return _sparse_from_runs(shape, dtype, *(np.concatenate(run) for run in zip(*runs)))
+
+def sparse_shape(sparse:dict):
+    """Shape of the dense label image"""
+    return tuple(int(size) for size in sparse["shape"])
+
+def sparse_dtype(sparse:dict):
+    """dtype of the dense label image"""
+    return np.dtype(str(sparse["dtype"]))
+
+def _paint_runs(out, labels, rows, cols, lengths, row_offset:int = 0, col_offset:int = 0):
+    """Write runs into a dense array (one fancy assignment over all the pixels of the runs)"""
+    if (lengths.size == 0):
+        return
+    lengths = lengths.astype(np.int64)
+    run_ends = np.cumsum(lengths)
+    flat_starts = (rows.astype(np.int64) - row_offset) * out.shape[1] + (cols.astype(np.int64) - col_offset)
+    pixels = np.repeat(flat_starts - run_ends + lengths, lengths) + np.arange(run_ends[-1])
+    out.reshape(-1)[pixels] = np.repeat(labels, lengths)
+
+def decode_labels(sparse:dict, window = None):
+    """Decode sparse labels into a dense label image (or a window of it)
+
+    Args:
+        sparse : sparse labels
+        window : (row_start, row_end, col_start, col_end) to decode (None decodes the whole image)
+    Returns:
+        The dense labels
+    """
+    shape, dtype = sparse_shape(sparse), sparse_dtype(sparse)
+    if window is None:
+        window = (0, shape[0], 0, shape[1])
+    # windows are clipped to the image as when slicing a dense array
+    row_start, row_end = max(window[0], 0), max(min(window[1], shape[0]), max(window[0], 0))
+    col_start, col_end = max(window[2], 0), max(min(window[3], shape[1]), max(window[2], 0))
+    out = np.zeros((row_end - row_start, col_end - col_start), dtype = dtype)
+
+    run_labels = np.repeat(sparse["labels"], np.diff(sparse["run_offsets"]))
+    rows, cols = sparse["run_rows"].astype(np.int64), sparse["run_cols"].astype(np.int64)
+    ends = cols + sparse["run_lengths"]
+
+    # clip the runs to the window
+    inside = (rows >= row_start) & (rows < row_end) & (ends > col_start) & (cols < col_end)
+    cols, ends = np.maximum(cols[inside], col_start), np.minimum(ends[inside], col_end)
+    _paint_runs(out, run_labels[inside], rows[inside], cols, ends - cols, row_start, col_start)
+
+    return out
+
+def object_mask(sparse:dict, label:int):
+    """Mask of a single object, decoded from its own runs only
+
+    Args:
+        sparse : sparse labels
+        label  : label of the object
+    Returns:
+        The bounding box (min_row, min_col, max_row, max_col) of the object and its boolean mask within the box
+    """
+    index = np.searchsorted(sparse["labels"], label)
+    if (index == sparse["labels"].size or sparse["labels"][index] != label):
+        raise Exception('There is no object ' + str(label))
+
+    bbox = tuple(int(value) for value in sparse["bboxes"][index])
+    runs = slice(sparse["run_offsets"][index], sparse["run_offsets"][index + 1])
+    mask = np.zeros((bbox[2] - bbox[0], bbox[3] - bbox[1]), dtype = bool)
+    lengths = sparse["run_lengths"][runs]
+    _paint_runs(mask, np.ones(lengths.size, dtype = bool), sparse["run_rows"][runs], sparse["run_cols"][runs], lengths, bbox[0], bbox[1])
+
+    return bbox, mask
+
+def write_sparse_labels(path:str, sparse:dict):
+    """Write sparse labels to a compressed .labels.npz file"""
+    if not is_sparse_path(path):
+        raise Exception('Sparse label files should end with ' + SPARSE_EXTENSION)
+    # np.savez adds .npz to names that do not end with it, write through a file object so that the path is kept
+    with open(path, "wb") as f:
+        np.savez_compressed(f, **sparse)
+
+def read_sparse_labels(path:str):
+    """Read sparse labels written by write_sparse_labels
+
+    Returns:
+        The sparse labels (a dictionary of arrays)
+    """
+    with np.load(path) as sparse:
+        return {name: sparse[name] for name in sparse.files}
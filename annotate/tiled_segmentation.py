@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import tempfile
+import numpy as np
+import scipy.ndimage as ndi
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from annotate.basic_image_processing_tasks import label_image_dtype, smooth_image, smoothing_dtype, GAUSSIAN_TRUNCATE
+from annotate.histogram_thresholds import thresholds_from_image
+from annotate.profiling import profile_stage
+
+def iter_tiles(image_shape, tile_size):
+    """Iterate over the tiles of an image in raster order
+
+    Args:
+        image_shape : shape of the image
+        tile_size   : size of the (square) tiles in pixels
+    Returns:
+        A generator of (row_start, row_end, col_start, col_end) for each tile
+    """
+    for row_start in range(0, image_shape[0], tile_size):
+        for col_start in range(0, image_shape[1], tile_size):
+            yield (row_start, min(row_start + tile_size, image_shape[0]),
+                   col_start, min(col_start + tile_size, image_shape[1]))
+
+def smooth_tile(image, tile, gaussian_sigma, precision = "float32"):
+    """Gaussian filter a single tile of an image
+
+    The tile is read with a halo of 4*sigma pixels so that the result is the same as filtering the whole image
+    with smooth_image (identical in float64, up to float32 rounding at a few pixels in float32)
+
+    Args:
+        image          : image (or anything that can be sliced like an image e.g. a memory-mapped array)
+        tile           : (row_start, row_end, col_start, col_end) of the tile
+        gaussian_sigma : sigma to use for the gaussian filter
+        precision      : float32 or float64
+    Returns:
+        The smoothed tile
+    """
+    row_start, row_end, col_start, col_end = tile
+    halo = int(GAUSSIAN_TRUNCATE * gaussian_sigma + 0.5)
+
+    # read the tile along with its halo (clipped at the image borders)
+    halo_row_start, halo_col_start = max(row_start - halo, 0), max(col_start - halo, 0)
+    halo_row_end, halo_col_end = min(row_end + halo, image.shape[0]), min(col_end + halo, image.shape[1])
+    region = image[halo_row_start:halo_row_end, halo_col_start:halo_col_end]
+
+    region_smooth = smooth_image(region, gaussian_sigma, precision)
+
+    return region_smooth[row_start - halo_row_start:row_end - halo_row_start,
+                         col_start - halo_col_start:col_end - halo_col_start]
+
+def _label_tiles(image_shape, tile_size, read_mask_tile, connectivity):
+    """Label connected components tile by tile and merge the components that touch across tile borders
+
+    Args:
+        image_shape    : shape of the image
+        tile_size      : size of the tiles in pixels
+        read_mask_tile : function that returns the binary mask of a tile given its index and (row_start, row_end, col_start, col_end)
+        connectivity   : 1 for 4-connected and 2 for 8-connected components
+    Returns:
+        tile_offsets    : offset added to the labels of each tile to make them unique across the image
+        component_ids   : id of the merged component for each of these tile labels (0 is the background)
+        component_areas : area in pixels of each merged component
+        component_first : raster index of the first pixel of each merged component
+    """
+    structure = ndi.generate_binary_structure(2, connectivity)
+
+    tile_offsets = []
+    areas = [np.zeros(1, dtype=np.int64)]
+    first_pixels = [np.full(1, -1, dtype=np.int64)]
+    edges = []
+    n_labels = 0
+
+    # labels of the last row of the previous row of tiles and the last column of the previous tile (padded with background)
+    prev_bottom = np.zeros(image_shape[1] + 2, dtype=np.int64)
+    cur_bottom = np.zeros(image_shape[1] + 2, dtype=np.int64)
+
+    for tile_index, tile in enumerate(iter_tiles(image_shape, tile_size)):
+        row_start, row_end, col_start, col_end = tile
+        if (col_start == 0):
+            prev_bottom, cur_bottom = cur_bottom, prev_bottom
+            cur_bottom[:] = 0
+            left_col = np.zeros(row_end - row_start + 2, dtype=np.int64)
+
+        tile_labels, n_tile_labels = ndi.label(read_mask_tile(tile_index, tile), structure)
+        tile_labels = tile_labels.astype(np.int64)
+        tile_offsets.append(n_labels)
+
+        # area and first pixel (in raster order of the whole image) of each tile label
+        areas.append(np.bincount(tile_labels.ravel(), minlength=n_tile_labels + 1)[1:])
+        first_idx = np.unique(tile_labels.ravel(), return_index=True)[1][-n_tile_labels:] if n_tile_labels else np.zeros(0, dtype=np.int64)
+        first_row, first_col = np.divmod(first_idx, col_end - col_start)
+        first_pixels.append((row_start + first_row) * image_shape[1] + col_start + first_col)
+
+        tile_labels[tile_labels > 0] += n_labels
+        n_labels += n_tile_labels
+
+        # pair up labels that touch across the top and left borders of the tile
+        neighbours = [(tile_labels[0, :], prev_bottom[col_start + 1:col_end + 1]),
+                      (tile_labels[:, 0], left_col[1:-1])]
+        if (connectivity == 2):
+            neighbours += [(tile_labels[0, :], prev_bottom[col_start:col_end]),
+                           (tile_labels[0, :], prev_bottom[col_start + 2:col_end + 2]),
+                           (tile_labels[:, 0], left_col[:-2]),
+                           (tile_labels[:, 0], left_col[2:])]
+        for labels_a, labels_b in neighbours:
+            touching = (labels_a > 0) & (labels_b > 0)
+            if touching.any():
+                edges.append(np.stack([labels_a[touching], labels_b[touching]]))
+
+        cur_bottom[col_start + 1:col_end + 1] = tile_labels[-1, :]
+        left_col = np.zeros(row_end - row_start + 2, dtype=np.int64)
+        left_col[1:-1] = tile_labels[:, -1]
+
+    # merge the tile labels into components
+    edges = np.concatenate(edges, axis=1) if edges else np.zeros((2, 0), dtype=np.int64)
+    graph = coo_matrix((np.ones(edges.shape[1], dtype=np.int8), (edges[0], edges[1])), shape=(n_labels + 1, n_labels + 1))
+    n_components, component_ids = connected_components(graph, directed=False)
+
+    # make sure the background is component 0
+    component_ids = np.where(component_ids == component_ids[0], 0, component_ids + 1)
+    component_ids = np.unique(component_ids, return_inverse=True)[1].astype(np.int64)
+
+    areas = np.concatenate(areas)
+    first_pixels = np.concatenate(first_pixels)
+    component_areas = np.bincount(component_ids, weights=areas).astype(np.int64)
+    component_first = np.full(component_areas.size, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(component_first, component_ids, first_pixels)
+
+    return tile_offsets, component_ids, component_areas, component_first
+
+def _relabel_tile(mask, offset, label_map, connectivity):
+    """Label a tile and map its labels to the merged components (see _label_tiles)"""
+    tile_labels, n_tile_labels = ndi.label(mask, ndi.generate_binary_structure(2, connectivity))
+    tile_labels = tile_labels.astype(np.int64)
+    tile_labels[tile_labels > 0] += offset
+    return label_map[tile_labels]
+
+def tiled_intensity_based_segmentation(image, gaussian_sigma=1, thresh_method="Otsu", smallest_area_of_object=5,
+                                       label_img_depth = "8bit", tile_size = 2048, scratch_dir = None, thresh_sample_fraction = None,
+                                       precision = "float32", write_tiles = None, li_histogram = False):
+    """Perform intensity based thresholding and detect objects one tile at a time
+
+    Gives the same labels as simple_intensity_based_segmentation but only a few tiles are held in memory at any time.
+    The smoothed image is spilled to a temporary file, the threshold is computed once from a histogram of the smoothed image,
+    and connected components (and their areas) are stitched across tile borders.
+    The threshold is computed as in gen_background_mask. In float32 the smoothed tiles can differ from the whole image
+    by float32 rounding, which only changes pixels that are within rounding of the threshold.
+
+    Args:
+        image                   : image to segment (can be a memory-mapped array)
+        gaussian_sigma          : sigma to use for the gaussian filter
+        thresh_method           : threshold method
+        smallest_area_of_object : smallest area of objects in pixels
+        label_img_depth         : label depth
+        tile_size               : size of the tiles in pixels
+        scratch_dir             : directory for the temporary smoothed image (default is the system temporary directory)
+        thresh_sample_fraction  : estimate the threshold from this fraction of the pixels (None uses all of them)
+        precision               : precision of the smoothed image (float32 or float64, see smooth_image)
+        write_tiles             : function(shape, dtype, tiles) writing the labels tile by tile (e.g. write_label_tiles), tiles is a
+                                  generator of ((row_start, row_end, col_start, col_end), label tile) in raster order.
+                                  The labelled image is then never assembled in memory. None returns the labelled image.
+        li_histogram            : compute Li from a fine histogram of the smoothed image. Otherwise Li reads all the smoothed pixels
+                                  (or the subsample) into memory, as in gen_background_mask
+
+    Returns:
+        A labelled image (or what write_tiles returns)
+    """
+
+    # check the label depth before doing any work
+    label_image_dtype(0, label_img_depth)
+
+    image_shape = image.shape[:2]
+    tiles = list(iter_tiles(image_shape, tile_size))
+
+    with tempfile.TemporaryDirectory(dir = scratch_dir) as tmp_dir:
+        # apply a gaussian filter
+        image_smooth = np.memmap(tmp_dir + "/smoothed.dat", dtype=smoothing_dtype(precision), mode="w+", shape=image_shape)
+        image_min, image_max, image_sum = np.inf, -np.inf, 0.0
+        with profile_stage("gaussian"):
+            for row_start, row_end, col_start, col_end in tiles:
+                tile_smooth = smooth_tile(image, (row_start, row_end, col_start, col_end), gaussian_sigma, precision)
+                image_smooth[row_start:row_end, col_start:col_end] = tile_smooth
+                image_min = min(image_min, tile_smooth.min())
+                image_max = max(image_max, tile_smooth.max())
+                image_sum += tile_smooth.sum(dtype=np.float64)
+        image_mean = image_sum / (image_shape[0] * image_shape[1])
+
+        # compute the threshold from the histogram of the smoothed image (reusing its range and mean unless it is subsampled)
+        with profile_stage("threshold"):
+            if (thresh_sample_fraction is None):
+                thresh = thresholds_from_image(image_smooth, [thresh_method], value_range = (image_min, image_max), image_mean = image_mean,
+                                               rows_per_chunk = tile_size, li_histogram = li_histogram)[thresh_method]
+            else:
+                thresh = thresholds_from_image(image_smooth, [thresh_method], sample_fraction = thresh_sample_fraction,
+                                               rows_per_chunk = tile_size, li_histogram = li_histogram)[thresh_method]
+
+        def read_mask_tile(tile_index, tile):
+            row_start, row_end, col_start, col_end = tile
+            return image_smooth[row_start:row_end, col_start:col_end] > thresh
+
+        #remove small objects (4-connected, as in remove_small_objects)
+        with profile_stage("remove_small_objects"):
+            offsets_small, ids_small, areas_small, _ = _label_tiles(image_shape, tile_size, read_mask_tile, 1)
+        keep = areas_small >= smallest_area_of_object
+        keep[0] = False
+        keep_labels = keep[ids_small]
+
+        def read_size_filtered_tile(tile_index, tile):
+            return _relabel_tile(read_mask_tile(tile_index, tile), offsets_small[tile_index], keep_labels, 1)
+
+        #Label connected components (8-connected, numbered in raster order as in skimage.measure.label)
+        with profile_stage("label"):
+            offsets_obj, ids_obj, _, first_obj = _label_tiles(image_shape, tile_size, read_size_filtered_tile, 2)
+        label_order = np.argsort(first_obj[1:], kind="stable")
+        object_labels = np.zeros(first_obj.size, dtype=np.int64)
+        object_labels[label_order + 1] = np.arange(1, first_obj.size)
+
+        # correct image depth (as cast_label_image does in simple_intensity_based_segmentation)
+        label_dtype = label_image_dtype(first_obj.size - 1, label_img_depth)
+        object_labels = object_labels.astype(label_dtype)
+        label_map = object_labels[ids_obj]
+
+        def iter_label_tiles():
+            for tile_index, tile in enumerate(tiles):
+                bw_size_filtered = read_size_filtered_tile(tile_index, tile)
+                yield tile, _relabel_tile(bw_size_filtered, offsets_obj[tile_index], label_map, 2)
+
+        if write_tiles is not None:
+            with profile_stage("write"):
+                label_image = write_tiles(image_shape, label_dtype, iter_label_tiles())
+        else:
+            with profile_stage("label_depth"):
+                label_image = np.zeros(image_shape, dtype=label_dtype)
+                for (row_start, row_end, col_start, col_end), label_tile in iter_label_tiles():
+                    label_image[row_start:row_end, col_start:col_end] = label_tile
+
+        del image_smooth
+
+    return label_image
@@ -1,4 +1,5 @@
 import argparse
+from annotate.profiling import profiling
 from annotate.batch_processing import generate_annotation_labels_batch
 
 # Parse the input arguments
@@ -6,15 +7,27 @@ options = argparse.ArgumentParser(description = "Interactively annotate all imag
 
 options.add_argument('--datadir', help = 'directory of raw images' , default = 'data/nuc_imgs/')
 options.add_argument('--savedir', help = 'directory to store normalized images', default = 'data/nuc_user_annotated/')
-options.add_argument('--large_image', type = str, help = 'Is this a large image?(will be downsampled)', default = 'no')
+options.add_argument('--large_image', type = str, help = 'Is this a large image?(yes- will be downsampled, pyramid- annotate at full resolution on a multiscale view)', default = 'no')
 options.add_argument('--anno_depth', type = str, help = 'Depth of the annotated image', default = "8bit")
 options.add_argument('--downsize_factor', type = int, help = 'Resizing factor for large iamge', default = 10)
+options.add_argument('--cache_dir', type = str, help = 'directory to cache downsized large images in (reopening an image skips reading it)', default = None)
+options.add_argument('--cache_size', type = int, help = 'Size limit of the cache directory(in MB)', default = 2048)
+options.add_argument('--prefetch', type = int, help = 'Number of images to load in the background while annotating', default = 1)
+options.add_argument('--output_format', type = str, help = 'Format of the annotated labels(tif, or sparse- runs of each object, much smaller for labels covering a few percent of the image)', default = "tif")
+options.add_argument('--resume', type = str, help = 'Skip the images already annotated with the same parameters(yes/no)', default = "yes")
+options.add_argument('--profile', type = str, help = 'Write the time and peak memory of each stage to this report(.json or .csv)', default = None)
 
 arguments = options.parse_args()
 
 # normalize the images in the folder
-generate_annotation_labels_batch(path_to_input_dir = arguments.datadir, 
-                                 path_to_output_dir= arguments.savedir,
-                                 large_image = arguments.large_image,
-                                 anno_img_depth = arguments.anno_depth,
-                                 scale_factor = arguments.downsize_factor)
+with profiling(arguments.profile):
+    generate_annotation_labels_batch(path_to_input_dir = arguments.datadir, 
+                                     path_to_output_dir= arguments.savedir,
+                                     large_image = arguments.large_image,
+                                     anno_img_depth = arguments.anno_depth,
+                                     scale_factor = arguments.downsize_factor,
+                                     cache_dir = arguments.cache_dir,
+                                     max_cache_size = arguments.cache_size * 1024**2,
+                                     prefetch = arguments.prefetch,
+                                     resume = (arguments.resume == "yes"),
+                                     output_format = arguments.output_format)
@@ -1,4 +1,5 @@
 import argparse
+from annotate.profiling import profiling
 from annotate.batch_processing import perfrom_simple_intensity_based_segmentation
 
 # Parse the input arguments
@@ -10,13 +11,47 @@ options.add_argument('--sigma', type = int, help = 'sigma to use for the gaussia
 options.add_argument('--threshold_method', type = str, help = 'threshold method', default = "Otsu")
 options.add_argument('--smallest_obj_area', type = int, help = 'Area of the smallest object(in pixels)', default = 25)
 options.add_argument('--anno_depth', type = str, help = 'Depth of the annotated image', default = "8bit")
+options.add_argument('--tile_size', type = int, help = 'Segment large images in tiles of this size(in pixels) to limit memory use', default = None)
+options.add_argument('--prefetch', type = int, help = 'Number of images to read ahead while segmenting(0 disables the read/write pipeline)', default = 0)
+options.add_argument('--threshold_sample', type = float, help = 'Estimate the threshold from this fraction of the pixels(e.g. 0.01 for large images)', default = None)
+options.add_argument('--li_histogram', type = str, help = 'Compute Li from a fine histogram instead of the pixels(yes/no), uses less memory but can differ by a few pixels', default = "no")
+options.add_argument('--precision', type = str, help = 'Precision of the smoothed image(float32 or float64)', default = "float32")
+options.add_argument('--channel', type = int, help = 'Channel to segment in multichannel images(e.g. CZYX stacks)', default = None)
+options.add_argument('--stack_mode', type = str, help = 'Segmentation of Z-stacks(3d- the whole stack at once, planes- each plane on its own)', default = "3d")
+options.add_argument('--plane_workers', type = int, help = 'Number of planes of a stack to segment in parallel(planes mode)', default = 1)
+options.add_argument('--plane_pool', type = str, help = 'Segment the planes in threads or processes(thread/process)', default = "thread")
+options.add_argument('--output_format', type = str, help = 'Format of the label images(tif, tiled_tif- tiled and compressed, BigTIFF when large, ome_zarr- with pyramid levels, sparse- runs of each object)', default = "tif")
+options.add_argument('--compression', type = str, help = 'Compression of the label images(none, zlib, zstd or lzma), zlib by default for the tiled formats', default = None)
+options.add_argument('--measurements', type = str, help = 'Write the area, centroid, bounding box and intensity of each object to a table(csv or parquet)', default = None)
+options.add_argument('--resume', type = str, help = 'Skip the images already segmented with the same parameters(yes/no)', default = "yes")
+options.add_argument('--workers', type = int, help = 'Number of images to segment in parallel', default = 1)
+options.add_argument('--max_memory', '--max-memory', type = int, help = 'Memory budget of the batch(in MB), images that do not fit are segmented in tiles and the largest are started first. Only the running images count, with the memory of their worker, idle workers are not counted', default = None)
+options.add_argument('--worker_memory', type = int, help = 'Memory of a worker process before it reads an image(in MB), measured when not given', default = None)
+options.add_argument('--profile', type = str, help = 'Write the time and peak memory of each stage to this report(.json or .csv)', default = None)
 
 arguments = options.parse_args()
 
 # normalize the images in the folder
-perfrom_simple_intensity_based_segmentation(path_to_input_dir = arguments.datadir, 
-                                            path_to_output_dir = arguments.savedir,
-                                            fil_sigma = arguments.sigma,
-                                            threshold_method = arguments.threshold_method,
-                                            smallest_object_area = arguments.smallest_obj_area,
-                                            label_img_depth = arguments.anno_depth)
+with profiling(arguments.profile):
+    perfrom_simple_intensity_based_segmentation(path_to_input_dir = arguments.datadir, 
+                                                path_to_output_dir = arguments.savedir,
+                                                fil_sigma = arguments.sigma,
+                                                threshold_method = arguments.threshold_method,
+                                                smallest_object_area = arguments.smallest_obj_area,
+                                                label_img_depth = arguments.anno_depth,
+                                                workers = arguments.workers,
+                                                tile_size = arguments.tile_size,
+                                                prefetch = arguments.prefetch,
+                                                thresh_sample_fraction = arguments.threshold_sample,
+                                                precision = arguments.precision,
+                                                li_histogram = (arguments.li_histogram == "yes"),
+                                                stack_mode = arguments.stack_mode,
+                                                plane_workers = arguments.plane_workers,
+                                                plane_pool = arguments.plane_pool,
+                                                channel = arguments.channel,
+                                                resume = (arguments.resume == "yes"),
+                                                output_format = arguments.output_format,
+                                                compression = arguments.compression,
+                                                measurements = arguments.measurements,
+                                                max_memory = None if arguments.max_memory is None else arguments.max_memory * 1024**2,
+                                                worker_memory = None if arguments.worker_memory is None else arguments.worker_memory * 1024**2)
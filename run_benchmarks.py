@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from glob import glob
+
+import numpy as np
+import cv2
+from skimage.measure import label
+from skimage.morphology import remove_small_objects
+from tifffile import imread, imwrite
+
+import annotate.interactive_segmentation as interactive_segmentation
+from annotate.basic_image_processing_tasks import gen_background_mask, cast_label_image, smooth_image, label_size_filtered_objects
+from annotate.image_io import make_display_image
+from annotate.histogram_thresholds import THRESHOLD_METHODS, HISTOGRAM_BINS, thresholds_from_image
+
+# module imported by perform_simple_segmentation.py, and the interactive packages it should not pull in
+SEGMENTATION_MODULE = "annotate.batch_processing"
+INTERACTIVE_PACKAGES = ["napari", "qtpy", "PyQt5", "PySide2", "vispy"]
+
+def synthetic_nuclei_image(size:int, seed:int = 0, rows_per_strip:int = 2048):
+    """Generate a uint16 image of bright blobs (nuclei/ducts) on a noisy background, a strip of rows at a time
+
+    Args:
+        size           : number of rows and columns of the image
+        seed           : seed of the random generator
+        rows_per_strip : number of rows generated at a time
+    Returns:
+        The synthetic image
+    """
+    rng = np.random.default_rng(seed)
+    image = np.empty((size, size), dtype=np.uint16)
+
+    # about one blob per 40x40 pixels, with radii between 3 and 15 pixels
+    n_blobs = max(size * size // 1600, 1)
+    centers = rng.integers(0, size, size=(n_blobs, 2))
+    radii = rng.integers(3, 16, size=n_blobs)
+    order = np.argsort(centers[:, 0])
+    centers, radii = centers[order], radii[order]
+
+    for row_start in range(0, size, rows_per_strip):
+        row_end = min(row_start + rows_per_strip, size)
+        strip = rng.normal(500, 50, size=(row_end - row_start, size)).astype(np.float32)
+        first = np.searchsorted(centers[:, 0], row_start - 16)
+        last = np.searchsorted(centers[:, 0], row_end + 16)
+        for (row, col), radius in zip(centers[first:last], radii[first:last]):
+            cv2.circle(strip, (int(col), int(row - row_start)), int(radius), 3000, -1)
+        image[row_start:row_end] = np.clip(strip, 0, 65535)
+
+    return image
+
+def measure(benchmark:str, image_name:str, image_shape, func, repeat:int = 3):
+    """Time a function (best of `repeat` runs) and measure the peak memory it allocates (first run)
+
+    Args:
+        benchmark  : name of the benchmark
+        image_name : name of the benchmarked image
+        image_shape: shape of the benchmarked image
+        func       : function to benchmark (no arguments)
+        repeat     : number of runs
+    Returns:
+        A dictionary with the results and the output of the function
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = func()
+    times = [time.perf_counter() - start]
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    result = {"benchmark": benchmark, "image": image_name, "shape": list(image_shape),
+              "seconds": min(times), "peak_memory_mb": peak_memory / 1024**2}
+    print("{:45s} {:20s} {:10.4f} s {:10.1f} MB".format(benchmark, image_name, result["seconds"], result["peak_memory_mb"]))
+
+    return result, output
+
+def benchmark_import_time(module:str, budget:float, repeat:int = 3):
+    """Measure the import time of a module in a fresh interpreter (python -X importtime, best of `repeat` runs)
+    
+    Args:
+        module : module to import
+        budget : maximum import time in seconds
+        repeat : number of runs
+    Returns:
+        A dictionary with the results (over_budget is True if the import is too slow, pulls in napari/Qt or fails)
+    """
+    times = []
+    for _ in range(repeat):
+        # the package is imported from the repository, wherever the script is run from
+        try:
+            process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                                     capture_output = True, text = True, check = True,
+                                     cwd = os.path.dirname(os.path.abspath(__file__)))
+        except subprocess.CalledProcessError as err:
+            error = err.stderr.strip().splitlines()[-1] if err.stderr.strip() else repr(err)
+            print("{:45s} {:20s} failed: {}".format("import_time/" + module, "", error))
+            return {"benchmark": "import_time/" + module, "image": "", "shape": [], "budget_seconds": budget,
+                    "error": "\n".join(line for line in err.stderr.splitlines() if not line.startswith("import time:")),
+                    "over_budget": True}
+        
+        # lines are "import time: self [us] | cumulative | imported package", top level imports are not indented
+        imported, seconds = set(), 0.0
+        for line in process.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line.split("|")
+            imported.add(name.strip().split(".")[0])
+            if not name[1:].startswith(" "):
+                seconds += int(cumulative) / 1e6
+        times.append(seconds)
+    
+    interactive_imports = sorted(imported.intersection(INTERACTIVE_PACKAGES))
+    result = {"benchmark": "import_time/" + module, "image": "", "shape": [], "seconds": min(times), "peak_memory_mb": 0.0,
+              "budget_seconds": budget, "interactive_imports": interactive_imports,
+              "over_budget": min(times) > budget or len(interactive_imports) > 0}
+    print("{:45s} {:20s} {:10.4f} s (budget {} s){}".format(result["benchmark"], "", result["seconds"], budget,
+                                                           ", imports " + ", ".join(interactive_imports) if interactive_imports else ""))
+    
+    return result
+
+def check_smoothing_precision(image_name:str, image, sigma:float = 1, tolerance:float = 1):
+    """Check that the thresholds of the float32 smoothed image match the float64 ones
+    
+    Args:
+        image_name : name of the image
+        image      : image to check
+        sigma      : sigma of the gaussian filter
+        tolerance  : largest accepted difference, in histogram bins (1/256 of the intensity range)
+    Returns:
+        A dictionary with the difference of each threshold (in bins) and whether one of them is over the tolerance
+    """
+    image_smooth = smooth_image(image, sigma, "float64")
+    bin_width = max((image_smooth.max() - image_smooth.min()) / HISTOGRAM_BINS, np.finfo(np.float64).tiny)
+    thresholds_64 = thresholds_from_image(image_smooth, skip_failed = True)
+    thresholds_32 = thresholds_from_image(smooth_image(image, sigma, "float32"), skip_failed = True)
+    del image_smooth
+    
+    differences = {}
+    for threshold_method in THRESHOLD_METHODS:
+        if (thresholds_64[threshold_method] is not None and thresholds_32[threshold_method] is not None):
+            differences[threshold_method] = float(abs(thresholds_32[threshold_method] - thresholds_64[threshold_method]) / bin_width)
+        elif (thresholds_64[threshold_method] is not None or thresholds_32[threshold_method] is not None):
+            # computed at one precision only
+            differences[threshold_method] = float("inf")
+    max_difference = max(differences.values(), default = 0.0)
+    
+    result = {"benchmark": "precision/float32_thresholds", "image": image_name, "shape": list(image.shape),
+              "difference_bins": differences, "tolerance_bins": tolerance, "over_tolerance": max_difference > tolerance}
+    print("{:45s} {:20s} largest difference {:.3f} bins (tolerance {})".format(result["benchmark"], image_name, max_difference, tolerance))
+    
+    return result
+
+def benchmark_image(image_name:str, image, tmp_dir:str, sigma:float = 1, smallest_area:int = 25, repeat:int = 3,
+                    precision_tolerance:float = 1):
+    """Run all the benchmarks on one image
+
+    Args:
+        image_name    : name of the image
+        image         : image to benchmark
+        tmp_dir       : directory for the TIFF read/write benchmarks
+        sigma         : sigma of the gaussian filter
+        smallest_area : smallest area of objects in pixels
+        repeat        : number of runs of each benchmark
+        precision_tolerance : largest accepted difference between the float32 and float64 thresholds (in histogram bins)
+    Returns:
+        A list of results
+    """
+    results = []
+
+    def run(benchmark, func):
+        try:
+            result, output = measure(benchmark, image_name, image.shape, func, repeat)
+        except Exception as err:
+            # e.g. the Minimum threshold fails on images without a bimodal histogram
+            tracemalloc.stop()
+            result, output = {"benchmark": benchmark, "image": image_name, "shape": list(image.shape), "error": repr(err)}, None
+            print("{:45s} {:20s} failed: {}".format(benchmark, image_name, repr(err)))
+        results.append(result)
+        return output
+
+    # TIFF read/write
+    image_path = os.path.join(tmp_dir, image_name + ".tif")
+    run("tiff_write", lambda: imwrite(image_path, image))
+    run("tiff_read", lambda: imread(image_path))
+
+    # simple_intensity_based_segmentation, stage by stage
+    run("segmentation/gaussian_float64", lambda: smooth_image(image, sigma, "float64"))
+    image_smooth = run("segmentation/gaussian", lambda: smooth_image(image, sigma, "float32"))
+    for threshold_method in THRESHOLD_METHODS:
+        run("gen_background_mask/" + threshold_method, lambda: gen_background_mask(image_smooth, threshold_method = threshold_method))
+    run("thresholds_from_image/all", lambda: thresholds_from_image(image_smooth, skip_failed = True))
+    run("thresholds_from_image/all_1%_sample", lambda: thresholds_from_image(image_smooth, sample_fraction = 0.01, skip_failed = True))
+    bw = gen_background_mask(image_smooth, threshold_method = "Otsu")
+    del image_smooth
+    run("segmentation/label_size_filtered_objects", lambda: label_size_filtered_objects(bw, smallest_area, "16bit"))
+    # the separate passes it replaces
+    bw_size_filtered = run("segmentation/remove_small_objects", lambda: remove_small_objects(bw, smallest_area))
+    del bw
+    label_image = run("segmentation/label", lambda: label(bw_size_filtered))
+    del bw_size_filtered
+    run("segmentation/cast_label_image", lambda: cast_label_image(label_image, "16bit"))
+    del label_image
+
+    results.append(check_smoothing_precision(image_name, image, sigma, precision_tolerance))
+
+    # resize/normalize path of generate_labels_large_image, and the whole function with napari stubbed out
+    run("large_image/display_image", lambda: make_display_image(image, 10))
+    run("large_image/generate_labels_large_image", lambda: interactive_segmentation.generate_labels_large_image(image_path, resize_factor = 10))
+    os.remove(image_path)
+
+    return results
+
+# Parse the input arguments
+options = argparse.ArgumentParser(description = "Benchmark the segmentation and annotation I/O hot paths")
+
+options.add_argument('--datadir', help = 'directory of raw images to benchmark', default = 'data/nuc_imgs/')
+options.add_argument('--sizes', type = int, nargs = '*', help = 'sizes of the synthetic images to benchmark (e.g. 10000 40000)', default = [2048])
+options.add_argument('--repeat', type = int, help = 'number of runs of each benchmark', default = 3)
+options.add_argument('--output', help = 'JSON file to write the results to', default = 'benchmark_results.json')
+options.add_argument('--compare', help = 'JSON file of a previous run to compare the results with', default = None)
+options.add_argument('--import_budget', type = float, help = 'Import time budget of the segmentation script(in seconds)', default = 2.0)
+options.add_argument('--precision_tolerance', type = float, help = 'Largest accepted difference between the float32 and float64 thresholds(in histogram bins)', default = 1)
+options.add_argument('--import_only', action = 'store_true', help = 'Only check the import time of the segmentation script')
+
+arguments = options.parse_args()
+
+# run headless: the viewer returns the labels unchanged
+interactive_segmentation.napari_interactive_annotation = lambda base_image, label_image, **kwargs: label_image
+
+# the segmentation script has to start quickly on headless nodes (no napari/Qt)
+import_result = benchmark_import_time(SEGMENTATION_MODULE, arguments.import_budget, repeat = arguments.repeat)
+results = [import_result]
+
+if not arguments.import_only:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for image_path in sorted(glob(arguments.datadir + "*.tif")):
+            image_name = os.path.splitext(os.path.basename(image_path))[0]
+            results += benchmark_image(image_name, imread(image_path), tmp_dir, repeat = arguments.repeat,
+                                       precision_tolerance = arguments.precision_tolerance)
+        for size in arguments.sizes:
+            results += benchmark_image("synthetic_" + str(size), synthetic_nuclei_image(size), tmp_dir, repeat = arguments.repeat,
+                                       precision_tolerance = arguments.precision_tolerance)
+
+with open(arguments.output, "w") as f:
+    json.dump({"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+               "results": results}, f, indent = 2)
+
+# compare with a previous run (ratio > 1 means slower/more memory than before)
+if arguments.compare is not None:
+    with open(arguments.compare) as f:
+        previous = {(r["benchmark"], r["image"]): r for r in json.load(f)["results"]}
+    print("\n{:45s} {:20s} {:>10s} {:>10s}".format("benchmark", "image", "time", "memory"))
+    for r in results:
+        p = previous.get((r["benchmark"], r["image"]))
+        # only the timed benchmarks (not the checks) are compared
+        if p is not None and "seconds" in p and "seconds" in r:
+            print("{:45s} {:20s} {:10.2f} {:10.2f}".format(r["benchmark"], r["image"], r["seconds"] / max(p["seconds"], 1e-9),
+                                                          r["peak_memory_mb"] / max(p["peak_memory_mb"], 1e-9)))
+
+if import_result["over_budget"]:
+    sys.exit("The segmentation script imports too slowly, imports napari/Qt or fails to import, see " + import_result["benchmark"])
+if any(r.get("over_tolerance", False) for r in results):
+    sys.exit("The float32 thresholds differ from the float64 ones by more than the tolerance, see precision/float32_thresholds")
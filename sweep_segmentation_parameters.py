@@ -0,0 +1,39 @@
+import argparse
+from annotate.profiling import profiling
+from annotate.batch_processing import sweep_simple_intensity_based_segmentation
+
+# Parse the input arguments
+options = argparse.ArgumentParser(description = "Segment a given set of images with a grid of parameters to compare them")
+
+options.add_argument('--datadir', help = 'directory of raw images' , default = 'data/nuc_imgs/')
+options.add_argument('--savedir', help = 'directory to output the segmentations of each combination of parameters', default = 'data/nuc_sweep/')
+options.add_argument('--sigmas', type = float, nargs = '+', help = 'sigmas to use for the gaussian filter', default = [1])
+options.add_argument('--threshold_methods', type = str, nargs = '+', help = 'threshold methods', default = ["Otsu"])
+options.add_argument('--smallest_obj_areas', type = int, nargs = '+', help = 'Areas of the smallest object(in pixels)', default = [25])
+options.add_argument('--anno_depth', type = str, help = 'Depth of the annotated image', default = "8bit")
+options.add_argument('--threshold_sample', type = float, help = 'Estimate the thresholds from this fraction of the pixels(e.g. 0.01 for large images)', default = None)
+options.add_argument('--li_histogram', type = str, help = 'Compute Li from a fine histogram instead of the pixels(yes/no), uses less memory but can differ by a few pixels', default = "no")
+options.add_argument('--precision', type = str, help = 'Precision of the smoothed image(float32 or float64)', default = "float32")
+options.add_argument('--channel', type = int, help = 'Channel to segment in multichannel images(e.g. CZYX stacks)', default = None)
+options.add_argument('--output_format', type = str, help = 'Format of the label images(tif, tiled_tif, ome_zarr or sparse)', default = "tif")
+options.add_argument('--compression', type = str, help = 'Compression of the label images(none, zlib, zstd or lzma), zlib by default for the tiled formats', default = None)
+options.add_argument('--resume', type = str, help = 'Skip the images already segmented with every combination(yes/no)', default = "yes")
+options.add_argument('--profile', type = str, help = 'Write the time and peak memory of each stage to this report(.json or .csv)', default = None)
+
+arguments = options.parse_args()
+
+# segment the images in the folder with every combination of parameters
+with profiling(arguments.profile):
+    sweep_simple_intensity_based_segmentation(path_to_input_dir = arguments.datadir, 
+                                              path_to_output_dir = arguments.savedir,
+                                              fil_sigmas = arguments.sigmas,
+                                              threshold_methods = arguments.threshold_methods,
+                                              smallest_object_areas = arguments.smallest_obj_areas,
+                                              label_img_depth = arguments.anno_depth,
+                                              thresh_sample_fraction = arguments.threshold_sample,
+                                              precision = arguments.precision,
+                                              li_histogram = (arguments.li_histogram == "yes"),
+                                              channel = arguments.channel,
+                                              resume = (arguments.resume == "yes"),
+                                              output_format = arguments.output_format,
+                                              compression = arguments.compression)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+import skimage.filters as skfil
+
+from annotate.histogram_thresholds import thresholds_from_image, THRESHOLD_METHODS
+
+def bimodal_image(dtype, shape = (200, 240), seed = 0):
+    """Smooth background with brighter blobs (two clear modes so that every method, including Minimum, is defined)"""
+    rng = np.random.default_rng(seed)
+    blobs = ndi.gaussian_filter(rng.random(shape), 6) > 0.5
+    image = np.where(blobs, 0.7, 0.3) + 0.05 * rng.standard_normal(shape)
+    image = ndi.gaussian_filter(image, 1)
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        image = (image - image.min()) / (image.max() - image.min()) * (np.iinfo(dtype).max - 20) + 10
+    return image.astype(dtype)
+
+def skimage_threshold(image, threshold_method):
+    return getattr(skfil, "threshold_" + threshold_method.lower())(image)
+
+# skimage smooths the sparse 65536 bins histogram of 16 bit images for minutes before finding two maxima, Minimum is only
+# checked on 8 bit and float images
+CASES = [(dtype, threshold_method) for dtype in (np.uint8, np.uint16, np.float32, np.float64) for threshold_method in THRESHOLD_METHODS
+         if not (dtype == np.uint16 and threshold_method == "Minimum")]
+
+@pytest.mark.parametrize("dtype, threshold_method", CASES)
+def test_same_as_skimage(dtype, threshold_method):
+    image = bimodal_image(dtype)
+    threshold = thresholds_from_image(image, [threshold_method])[threshold_method]
+    assert threshold == pytest.approx(skimage_threshold(image, threshold_method), rel = 1e-6)
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.float32])
+def test_all_methods_at_once(dtype):
+    image = bimodal_image(dtype)
+    thresholds = thresholds_from_image(image, THRESHOLD_METHODS)
+    for threshold_method in THRESHOLD_METHODS:
+        assert thresholds[threshold_method] == pytest.approx(skimage_threshold(image, threshold_method), rel = 1e-6)
+
+@pytest.mark.parametrize("rows_per_chunk", [1, 7, 1000])
+def test_chunked_histogram(rows_per_chunk):
+    image = bimodal_image(np.float64)
+    thresholds = thresholds_from_image(image, ["Otsu", "Yen", "Li"], rows_per_chunk = rows_per_chunk)
+    for threshold_method, threshold in thresholds.items():
+        assert threshold == pytest.approx(skimage_threshold(image, threshold_method), rel = 1e-6)
+
+def test_li_histogram():
+    # the fine histogram only approximates Li on float images, within a few of its bins
+    image = bimodal_image(np.float32)
+    threshold = thresholds_from_image(image, ["Li"], li_histogram = True)["Li"]
+    bin_width = (image.max() - image.min()) / 65536
+    assert abs(threshold - skfil.threshold_li(image)) < 4 * bin_width
+
+def test_sampled_thresholds():
+    image = bimodal_image(np.float32, shape = (400, 400))
+    thresholds = thresholds_from_image(image, ["Otsu", "Li"], sample_fraction = 0.25)
+    for threshold_method, threshold in thresholds.items():
+        assert abs(threshold - skimage_threshold(image, threshold_method)) < 0.01 * (image.max() - image.min())
+
+def test_constant_image():
+    image = np.full((10, 10), 3.5)
+    assert thresholds_from_image(image, ["Otsu", "Mean"]) == {"Otsu": 3.5, "Mean": 3.5}
+
+def test_invalid_method():
+    with pytest.raises(Exception):
+        thresholds_from_image(bimodal_image(np.uint8), ["Median"])
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from tifffile import imwrite, imread, TiffFile
+
+from annotate.image_io import write_image_windows, open_image, block_reduce, downsize_image, block_mode, downsize_labels, upsize_labels
+from annotate.image_io import downsized_shape, make_display_image
+from annotate.interactive_segmentation import write_region_corrections, upsample_edited_tiles
+
+WINDOWS = [(10, 50, 20, 70), (0, 100, 85, 90), (95, 100, 0, 90), (30, 40, 30, 40)]
+
+def random_labels(dtype = np.uint8, seed = 0):
+    rng = np.random.default_rng(seed)
+    return (rng.integers(1, 5, (100, 90)) * (rng.random((100, 90)) < 0.3)).astype(dtype)
+
+def corrections(dtype = np.uint8, seed = 1):
+    rng = np.random.default_rng(seed)
+    return [(window, rng.integers(0, 250, (window[1] - window[0], window[3] - window[2])).astype(dtype)) for window in WINDOWS]
+
+def corrected(labels, windows):
+    labels = labels.copy()
+    for (row_start, row_end, col_start, col_end), window in windows:
+        labels[row_start:row_end, col_start:col_end] = window
+    return labels
+
+def segment_offsets(image_path):
+    with TiffFile(image_path) as tif:
+        return tif.pages[0].dataoffsets, tif.pages[0].databytecounts
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+@pytest.mark.parametrize("layout", [dict(), dict(tile = (32, 32)), dict(compression = "zlib", tile = (32, 32)),
+                                    dict(compression = "zlib", rowsperstrip = 30), dict(compression = "lzma", rowsperstrip = 7),
+                                    dict(compression = "zlib", tile = (16, 48), predictor = True), dict(compression = "zlib", bigtiff = True)])
+def test_write_windows(tmp_path, dtype, layout):
+    labels = random_labels(dtype)
+    image_path = str(tmp_path / "labels.tif")
+    imwrite(image_path, labels, **layout)
+    windows = corrections(dtype)
+    write_image_windows(image_path, windows)
+    np.testing.assert_array_equal(imread(image_path), corrected(labels, windows))
+
+def test_untouched_tiles_are_not_written(tmp_path):
+    labels = random_labels()
+    image_path = str(tmp_path / "labels.tif")
+    imwrite(image_path, labels, compression = "zlib", tile = (32, 32))
+    offsets, bytecounts = segment_offsets(image_path)
+
+    # the window only overlaps the first tile
+    window = ((2, 10, 3, 12), np.full((8, 9), 7, dtype = np.uint8))
+    write_image_windows(image_path, [window])
+    new_offsets, new_bytecounts = segment_offsets(image_path)
+    assert new_offsets[1:] == offsets[1:] and new_bytecounts[1:] == bytecounts[1:]
+    np.testing.assert_array_equal(imread(image_path), corrected(labels, [window]))
+
+def test_window_labels_have_to_fit(tmp_path):
+    image_path = str(tmp_path / "labels.tif")
+    imwrite(image_path, random_labels(), compression = "zlib", tile = (32, 32))
+    with pytest.raises(Exception):
+        write_image_windows(image_path, [((0, 2, 0, 2), np.full((2, 2), 300, dtype = np.uint16))])
+
+@pytest.mark.parametrize("output_name", ["corrected.tif", "corrected.labels.npz"])
+def test_region_corrections(tmp_path, output_name):
+    labels = random_labels()
+    annotated_path, output_path = str(tmp_path / "labels.tif"), str(tmp_path / output_name)
+    imwrite(annotated_path, labels, compression = "zlib", tile = (32, 32))
+    first, second = corrections(seed = 1)[:2], corrections(seed = 2)[2:]
+
+    write_region_corrections(annotated_path, output_path, first)
+    write_region_corrections(annotated_path, output_path, second)
+    np.testing.assert_array_equal(np.asarray(open_image(output_path)), corrected(labels, first + second))
+    # the annotations are left untouched, overwrite_output starts again from them
+    np.testing.assert_array_equal(imread(annotated_path), labels)
+    write_region_corrections(annotated_path, output_path, second, overwrite_output = True)
+    np.testing.assert_array_equal(np.asarray(open_image(output_path)), corrected(labels, second))
+
+def test_region_corrections_depth(tmp_path):
+    labels = random_labels()
+    annotated_path, output_path = str(tmp_path / "labels.tif"), str(tmp_path / "corrected.tif")
+    imwrite(annotated_path, labels, compression = "zlib", tile = (32, 32))
+    # 16 bit labels of the corrections fit once the annotations are cast
+    windows = [(WINDOWS[0], np.full((40, 50), 1000, dtype = np.uint16))]
+    write_region_corrections(annotated_path, output_path, windows, label_img_depth = "16bit")
+    output = imread(output_path)
+    assert output.dtype == np.uint16
+    np.testing.assert_array_equal(output, corrected(labels.astype(np.uint16), windows))
+
+def block_means(image, resize_factor):
+    """Mean of each block of an image, partial blocks along the edges included (one block at a time)"""
+    means = np.zeros(downsized_shape(image.shape, resize_factor))
+    for i in range(means.shape[0]):
+        for j in range(means.shape[1]):
+            means[i, j] = image[i * resize_factor:(i + 1) * resize_factor, j * resize_factor:(j + 1) * resize_factor].mean()
+    return means
+
+def block_modes(label_image, resize_factor):
+    """Most frequent label of each block of a label image, the smallest on ties (one block at a time)"""
+    modes = np.zeros(downsized_shape(label_image.shape, resize_factor), dtype = label_image.dtype)
+    for i in range(modes.shape[0]):
+        for j in range(modes.shape[1]):
+            labels, counts = np.unique(label_image[i * resize_factor:(i + 1) * resize_factor, j * resize_factor:(j + 1) * resize_factor],
+                                       return_counts = True)
+            modes[i, j] = labels[np.argmax(counts)]
+    return modes
+
+@pytest.mark.parametrize("shape", [(100, 90), (103, 97), (7, 95), (9, 9), (0, 5)])
+@pytest.mark.parametrize("resize_factor", [1, 3, 10])
+def test_downsize_edge_blocks(shape, resize_factor):
+    rng = np.random.default_rng(0)
+    image = rng.random(shape) * 100
+    np.testing.assert_allclose(block_reduce(image, resize_factor), block_means(image, resize_factor))
+    np.testing.assert_allclose(downsize_image(image, resize_factor, rows_per_strip = 20), block_means(image, resize_factor))
+
+    label_image = rng.integers(0, 4, shape).astype(np.uint16)
+    np.testing.assert_array_equal(block_mode(label_image, resize_factor), block_modes(label_image, resize_factor))
+    np.testing.assert_array_equal(downsize_labels(label_image, resize_factor, rows_per_strip = 20), block_modes(label_image, resize_factor))
+    np.testing.assert_array_equal(downsize_labels(label_image, resize_factor, method = "nearest"), label_image[::resize_factor, ::resize_factor])
+
+@pytest.mark.parametrize("shape", [(100, 90), (103, 97)])
+def test_downsize_rgb(shape):
+    # each sample of RGB images is downsized on its own
+    image = np.random.default_rng(0).integers(0, 255, shape + (3,)).astype(np.uint8)
+    expected = np.stack([block_means(image[..., sample], 10) for sample in range(3)], axis = -1)
+    np.testing.assert_allclose(block_reduce(image, 10), expected)
+    np.testing.assert_allclose(downsize_image(image, 10, rows_per_strip = 20), expected)
+    assert block_reduce(image, 10, "max").shape == expected.shape
+    assert make_display_image(image, 10).shape == expected.shape
+
+@pytest.mark.parametrize("shape", [(100, 90), (103, 97), (7, 95)])
+def test_upsize_labels(shape):
+    label_image = np.random.default_rng(0).integers(0, 4, shape).astype(np.uint8)
+    labels_resized = downsize_labels(label_image, 10)
+    labels = upsize_labels(labels_resized, 10, shape, rows_per_strip = 20)
+    assert labels.shape == shape
+    # every full resolution pixel takes the label of the block it is in
+    rows, cols = np.indices(shape)
+    np.testing.assert_array_equal(labels, labels_resized[rows // 10, cols // 10])
+    with pytest.raises(Exception):
+        upsize_labels(labels_resized[:-1], 10, shape)
+    # the samples of the raw image (e.g. RGB) are ignored
+    assert upsize_labels(labels_resized, 10, shape + (3,)).shape == shape
+
+def test_upsample_edits_in_edge_blocks():
+    full_labels = np.random.default_rng(0).integers(0, 3, (137, 151)).astype(np.uint8)
+    original_labels = downsize_labels(full_labels, 10)
+    updated_labels = original_labels.copy()
+    updated_labels[-2:, -3:] = 7
+    corrections = upsample_edited_tiles(full_labels, original_labels, updated_labels, 10, tile_size = 4)
+    corrected_labels = corrected(full_labels, corrections)
+    assert (corrected_labels[120:, 130:] == 7).all()
+    np.testing.assert_array_equal(corrected_labels[:120], full_labels[:120])
+    np.testing.assert_array_equal(corrected_labels[:, :130], full_labels[:, :130])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pytest
+from tifffile import TiffFile
+
+from annotate.image_io import open_image
+from annotate.label_output import check_output_format, output_extension, write_label_image, write_label_tiles
+from annotate.tiled_segmentation import iter_tiles
+
+def make_labels(shape = (300, 250), dtype = np.uint16, seed = 0):
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype = dtype)
+    for label in range(1, 30):
+        row, col = rng.integers(0, shape[0] - 20), rng.integers(0, shape[1] - 20)
+        labels[row:row + rng.integers(3, 20), col:col + rng.integers(3, 20)] = label
+    return labels
+
+def label_tiles(labels, tile_size):
+    return ((tile, labels[tile[0]:tile[1], tile[2]:tile[3]]) for tile in iter_tiles(labels.shape, tile_size))
+
+@pytest.mark.parametrize("compression", ["none", "zlib", "lzma"])
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.uint32])
+def test_tiled_tif_round_trip(tmp_path, compression, dtype):
+    labels = make_labels(dtype = dtype)
+    output_path = str(tmp_path / ("labels" + output_extension("tiled_tif")))
+    write_label_tiles(output_path, labels.shape, labels.dtype, label_tiles(labels, 64), 64, "tiled_tif", compression)
+
+    with TiffFile(output_path) as tif:
+        page = tif.pages[0]
+        assert page.is_tiled and (page.tilelength, page.tilewidth) == (64, 64)
+    image = open_image(output_path)
+    assert image.shape == labels.shape and image.dtype == labels.dtype
+    np.testing.assert_array_equal(np.asarray(image[:]), labels)
+    np.testing.assert_array_equal(np.asarray(image[70:190, 30:100]), labels[70:190, 30:100])
+    # no temporary file is left behind
+    assert os.listdir(tmp_path) == ["labels.tif"]
+
+def test_write_label_image_formats_agree(tmp_path):
+    labels = make_labels((700, 600))
+    for output_format in ("tif", "tiled_tif", "sparse"):
+        output_path = str(tmp_path / ("labels_" + output_format + output_extension(output_format)))
+        write_label_image(output_path, labels, output_format)
+        np.testing.assert_array_equal(np.asarray(open_image(output_path)[:]), labels)
+
+def test_ome_zarr(tmp_path):
+    zarr = pytest.importorskip("zarr")
+    labels = make_labels((1100, 1030))
+    output_path = str(tmp_path / ("labels" + output_extension("ome_zarr")))
+    write_label_tiles(output_path, labels.shape, labels.dtype, label_tiles(labels, 256), 256, "ome_zarr", "zlib")
+
+    root = zarr.open_group(output_path, mode = 'r')
+    datasets = root.attrs["multiscales"][0]["datasets"]
+    assert [dataset["path"] for dataset in datasets] == ["0", "1"]
+    np.testing.assert_array_equal(root["0"][:], labels)
+    # the pyramid keeps every other pixel, labels are never averaged
+    np.testing.assert_array_equal(root["1"][:], labels[::2, ::2])
+    assert root["0"].chunks == (256, 256)
+
+def test_check_output_format():
+    check_output_format("tif")
+    check_output_format("tiled_tif", tile_size = 512, compression = "zlib")
+    with pytest.raises(Exception, match = "output_format"):
+        check_output_format("png")
+    with pytest.raises(Exception, match = "compression"):
+        check_output_format("tiled_tif", compression = "jpeg")
+    with pytest.raises(Exception, match = "multiple of 16"):
+        check_output_format("tiled_tif", tile_size = 500)
+    with pytest.raises(Exception, match = "stacks"):
+        check_output_format("sparse", label_ndim = 3)
+
+def test_check_output_format_missing_codec():
+    try:
+        import imagecodecs
+    except ImportError:
+        imagecodecs = None
+    if imagecodecs is not None:
+        pytest.skip("imagecodecs is installed, zstd TIFFs can be written")
+    with pytest.raises(Exception, match = "imagecodecs"):
+        check_output_format("tiled_tif", tile_size = 512, compression = "zstd")
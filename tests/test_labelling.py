@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from skimage.measure import label
+from skimage.morphology import remove_small_objects
+
+from annotate.basic_image_processing_tasks import label_size_filtered_objects, face_connected_components, cast_label_image
+
+def reference_labels(bw, smallest_area_of_object, label_img_depth = "8bit"):
+    """Labels of the objects of a binary image computed with skimage"""
+    return cast_label_image(label(remove_small_objects(bw, smallest_area_of_object)), label_img_depth)
+
+def assert_same_labels(bw, smallest_area_of_object, label_img_depth = "8bit"):
+    labels = label_size_filtered_objects(bw, smallest_area_of_object, label_img_depth)
+    expected = reference_labels(bw, smallest_area_of_object, label_img_depth)
+    assert labels.dtype == expected.dtype
+    np.testing.assert_array_equal(labels, expected)
+
+@pytest.mark.parametrize("shape", [(1000,), (120, 150), (20, 30, 40)])
+@pytest.mark.parametrize("density", [0.3, 0.5, 0.7])
+@pytest.mark.parametrize("smallest_area_of_object", [1, 5, 20])
+def test_random_images(shape, density, smallest_area_of_object):
+    rng = np.random.default_rng(0)
+    bw = rng.random(shape) < density
+    assert_same_labels(bw, smallest_area_of_object, "16bit")
+
+@pytest.mark.parametrize("shape", [(0,), (0, 10), (10, 10), (4, 5, 6)])
+def test_empty_images(shape):
+    bw = np.zeros(shape, dtype = bool)
+    labels = label_size_filtered_objects(bw, 5)
+    assert labels.shape == bw.shape
+    assert labels.dtype == np.uint8
+    assert not labels.any()
+
+@pytest.mark.parametrize("smallest_area_of_object", [1, 2])
+def test_single_pixel(smallest_area_of_object):
+    bw = np.zeros((7, 9), dtype = bool)
+    bw[3, 4] = True
+    assert_same_labels(bw, smallest_area_of_object)
+
+    components, areas, diagonal_pairs = face_connected_components(bw)
+    np.testing.assert_array_equal(areas, [bw.size - 1, 1])
+    assert diagonal_pairs.shape == (2, 0)
+
+def test_objects_touching_at_a_corner():
+    # two 2x2 squares touching at a single corner: two face connected components of 4 pixels forming a single object
+    bw = np.zeros((6, 6), dtype = bool)
+    bw[1:3, 1:3] = True
+    bw[3:5, 3:5] = True
+
+    components, areas, diagonal_pairs = face_connected_components(bw)
+    np.testing.assert_array_equal(areas, [28, 4, 4])
+    assert sorted(diagonal_pairs.ravel().tolist()) == [1, 2]
+
+    # both squares are kept (areas are measured on the face connected components) and merged into one object
+    labels = label_size_filtered_objects(bw, 4)
+    assert set(np.unique(labels)) == {0, 1}
+    assert_same_labels(bw, 4)
+    # each square is under the smallest area on its own, so both are removed even though the object has 8 pixels
+    labels = label_size_filtered_objects(bw, 5)
+    assert not labels.any()
+    assert_same_labels(bw, 5)
+
+def test_objects_touching_at_a_corner_3d():
+    bw = np.zeros((4, 4, 4), dtype = bool)
+    bw[0, 0, 0] = bw[1, 1, 1] = bw[2, 2, 2] = True
+    bw[3, 0, 3] = True
+    assert_same_labels(bw, 1)
+    assert int(label_size_filtered_objects(bw, 1).max()) == 2
+
+def test_label_depth_promotion():
+    # more objects than fit in 8 bit are promoted to uint16 as with cast_label_image
+    bw = np.zeros((64, 64), dtype = bool)
+    bw[::2, ::2] = True
+    with pytest.warns(UserWarning):
+        assert_same_labels(bw, 1, "8bit")
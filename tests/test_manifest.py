@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+from tifffile import imwrite, imread
+
+from annotate.manifest import load_manifest, save_manifest, is_up_to_date, record_output, MANIFEST_NAME
+from annotate.batch_processing import perfrom_simple_intensity_based_segmentation
+
+def write_blob_image(path, seed = 0, shape = (120, 100)):
+    rng = np.random.default_rng(seed)
+    image = ndi.gaussian_filter(rng.random(shape), 3)
+    imwrite(path, ((image - image.min()) / (image.max() - image.min()) * 60000).astype(np.uint16))
+
+MARKER = np.full((2, 2), 255, dtype = np.uint8)
+
+def mark_outputs(output_dir):
+    """Overwrite the outputs with a marker, outputs that are segmented again lose it"""
+    for name in os.listdir(output_dir):
+        if name.endswith(".tif"):
+            imwrite(os.path.join(output_dir, name), MARKER)
+
+def marked_outputs(output_dir):
+    return sorted(name for name in os.listdir(output_dir)
+                  if name.endswith(".tif") and np.array_equal(imread(os.path.join(output_dir, name)), MARKER))
+
+@pytest.fixture
+def input_dir(tmp_path):
+    input_dir = tmp_path / "raw"
+    input_dir.mkdir()
+    for seed in range(3):
+        write_blob_image(str(input_dir / ("im" + str(seed) + ".tif")), seed)
+    return str(input_dir) + "/"
+
+def test_record_and_check(tmp_path):
+    input_path, output_path = str(tmp_path / "in.tif"), str(tmp_path / "out.tif")
+    write_blob_image(input_path)
+    imwrite(output_path, np.zeros((2, 2), dtype = np.uint8))
+    params = {"fil_sigma": 2, "tile_size": None, "shape": (1, 2)}
+
+    manifest = load_manifest(str(tmp_path))
+    assert manifest == {}
+    assert not is_up_to_date(manifest, output_path, [input_path], params)
+    record_output(manifest, str(tmp_path), output_path, [input_path], params)
+    assert os.path.exists(tmp_path / MANIFEST_NAME)
+
+    manifest = load_manifest(str(tmp_path))
+    assert is_up_to_date(manifest, output_path, [input_path], params)
+    assert not is_up_to_date(manifest, output_path, [input_path], dict(params, fil_sigma = 3))
+    assert not is_up_to_date(manifest, output_path, [input_path, input_path], params)
+
+    # touching the input does not change it, rewriting it does
+    os.utime(input_path, ns = (0, 0))
+    assert is_up_to_date(manifest, output_path, [input_path], params)
+    write_blob_image(input_path, seed = 1)
+    assert not is_up_to_date(manifest, output_path, [input_path], params)
+
+    # a missing output is never up to date
+    write_blob_image(input_path)
+    os.remove(output_path)
+    assert not is_up_to_date(manifest, output_path, [input_path], params)
+
+def test_broken_manifest(tmp_path):
+    (tmp_path / MANIFEST_NAME).write_text("{not json")
+    assert load_manifest(str(tmp_path)) == {}
+    save_manifest(str(tmp_path), {"a": 1})
+    assert load_manifest(str(tmp_path)) == {"a": 1}
+
+def test_segmentation_resume(input_dir, tmp_path):
+    output_dir = str(tmp_path / "labels")
+    params = dict(fil_sigma = 2, threshold_method = "Otsu", smallest_object_area = 10)
+    perfrom_simple_intensity_based_segmentation(input_dir, output_dir, **params)
+    labels = imread(os.path.join(output_dir, "im2.tif"))
+    assert sorted(name for name in os.listdir(output_dir) if name.endswith(".tif")) == ["im0.tif", "im1.tif", "im2.tif"]
+
+    # nothing changed: nothing is segmented again
+    mark_outputs(output_dir)
+    perfrom_simple_intensity_based_segmentation(input_dir, output_dir, **params)
+    assert marked_outputs(output_dir) == ["im0.tif", "im1.tif", "im2.tif"]
+
+    # a changed image and a deleted output are segmented again, the other image is skipped
+    write_blob_image(input_dir + "im1.tif", seed = 10)
+    os.remove(os.path.join(output_dir, "im2.tif"))
+    perfrom_simple_intensity_based_segmentation(input_dir, output_dir, **params)
+    assert marked_outputs(output_dir) == ["im0.tif"]
+    np.testing.assert_array_equal(imread(os.path.join(output_dir, "im2.tif")), labels)
+
+    # other parameters segment everything again, as does resume = False
+    mark_outputs(output_dir)
+    perfrom_simple_intensity_based_segmentation(input_dir, output_dir, **dict(params, fil_sigma = 3))
+    assert marked_outputs(output_dir) == []
+    mark_outputs(output_dir)
+    perfrom_simple_intensity_based_segmentation(input_dir, output_dir, **dict(params, fil_sigma = 3), resume = False)
+    assert marked_outputs(output_dir) == []
+
+def test_measurements_resume(input_dir, tmp_path):
+    output_dir = str(tmp_path / "labels")
+    params = dict(fil_sigma = 2, threshold_method = "Otsu", smallest_object_area = 10, measurements = "csv")
+    perfrom_simple_intensity_based_segmentation(input_dir, output_dir, **params)
+    table_path = os.path.join(output_dir, "im1_objects.csv")
+    table = open(table_path).read()
+    assert load_manifest(output_dir)["im1.tif"]["extra_outputs"] == [os.path.abspath(table_path)]
+
+    # a missing measurement table segments its image again
+    mark_outputs(output_dir)
+    os.remove(table_path)
+    perfrom_simple_intensity_based_segmentation(input_dir, output_dir, **params)
+    assert marked_outputs(output_dir) == ["im0.tif", "im2.tif"]
+    assert open(table_path).read() == table
+
+    # outputs recorded without their table (segmented without measurements) are segmented again
+    mark_outputs(output_dir)
+    manifest = load_manifest(output_dir)
+    manifest["im0.tif"]["extra_outputs"] = []
+    save_manifest(output_dir, manifest)
+    perfrom_simple_intensity_based_segmentation(input_dir, output_dir, **params)
+    assert marked_outputs(output_dir) == ["im1.tif", "im2.tif"]
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from skimage.measure import label, regionprops
+
+from annotate.measurements import (measure_objects, measure_tiles, new_measurements, measurement_table, write_measurements,
+                                   read_measurements, MEASUREMENT_COLUMNS)
+from annotate.tiled_segmentation import iter_tiles
+
+def labelled_image(shape = (90, 110), seed = 0):
+    """Random objects (some of them spanning several tiles) and the raw image they were segmented from"""
+    rng = np.random.default_rng(seed)
+    raw_image = rng.integers(0, 4000, shape).astype(np.uint16)
+    labels = label(rng.random(shape) < 0.55).astype(np.uint16)
+    return labels, raw_image
+
+def assert_same_tables(table, expected):
+    for column in MEASUREMENT_COLUMNS:
+        np.testing.assert_allclose(table[column], expected[column], err_msg = column)
+
+@pytest.mark.parametrize("rows_per_strip", [1, 7, 1024])
+def test_same_as_regionprops(rows_per_strip):
+    labels, raw_image = labelled_image()
+    table = measure_objects(labels, raw_image, rows_per_strip)
+    regions = regionprops(labels, intensity_image = raw_image)
+    assert len(regions) > 10
+
+    np.testing.assert_array_equal(table["label"], [region.label for region in regions])
+    np.testing.assert_array_equal(table["area"], [region.area for region in regions])
+    np.testing.assert_allclose(table["centroid_row"], [region.centroid[0] for region in regions])
+    np.testing.assert_allclose(table["centroid_col"], [region.centroid[1] for region in regions])
+    for index, column in enumerate(["bbox_min_row", "bbox_min_col", "bbox_max_row", "bbox_max_col"]):
+        np.testing.assert_array_equal(table[column], [region.bbox[index] for region in regions])
+    np.testing.assert_allclose(table["mean_intensity"], [region.intensity_mean for region in regions])
+    np.testing.assert_allclose(table["max_intensity"], [region.intensity_max for region in regions])
+
+def test_labels_that_are_not_sequential():
+    labels, raw_image = labelled_image()
+    labels[labels > 0] += 5
+    table = measure_objects(labels, raw_image)
+    np.testing.assert_array_equal(table["label"], [region.label for region in regionprops(labels)])
+
+def test_empty_labels():
+    labels, raw_image = labelled_image()
+    table = measure_objects(np.zeros_like(labels), raw_image)
+    assert all(len(table[column]) == 0 for column in MEASUREMENT_COLUMNS)
+
+def test_different_sizes():
+    labels, raw_image = labelled_image()
+    with pytest.raises(Exception):
+        measure_objects(labels, raw_image[:-1])
+
+@pytest.mark.parametrize("tile_size", [16, 32, 200])
+def test_tiles_same_as_one_pass(tile_size):
+    labels, raw_image = labelled_image()
+    measurements = new_measurements()
+    tiles = ((tile, labels[tile[0]:tile[1], tile[2]:tile[3]]) for tile in iter_tiles(labels.shape, tile_size))
+    # the tiles are passed through unchanged
+    for (row_start, row_end, col_start, col_end), label_tile in measure_tiles(tiles, raw_image, measurements):
+        np.testing.assert_array_equal(label_tile, labels[row_start:row_end, col_start:col_end])
+    assert_same_tables(measurement_table(measurements), measure_objects(labels, raw_image))
+
+def test_csv_round_trip(tmp_path):
+    labels, raw_image = labelled_image()
+    table = measure_objects(labels, raw_image)
+    table_path = str(tmp_path / "image_objects.csv")
+    write_measurements(table_path, table)
+    assert_same_tables(read_measurements(table_path), table)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import pytest
+
+from annotate.pipeline import run_pipeline
+
+ITEMS = list(range(20))
+
+def read_item(item):
+    time.sleep(0.001 * (item % 3))
+    return [item] * 3
+
+def process_item(item, data):
+    return sum(data) + item
+
+def run_sequential(items):
+    return [(item, process_item(item, read_item(item))) for item in items]
+
+@pytest.mark.parametrize("prefetch,max_pending_writes", [(1, 1), (2, 2), (4, 1)])
+def test_matches_a_sequential_run(prefetch, max_pending_writes):
+    written = []
+    failed_items = run_pipeline(ITEMS, read_item, process_item, lambda item, result: written.append((item, result)),
+                                prefetch = prefetch, max_pending_writes = max_pending_writes)
+    assert failed_items == {}
+    assert written == run_sequential(ITEMS)
+
+def test_failing_items_are_reported():
+    def failing_read(item):
+        if (item == 3):
+            raise ValueError("read")
+        return read_item(item)
+
+    def failing_process(item, data):
+        if (item == 7):
+            raise ValueError("process")
+        return process_item(item, data)
+
+    def failing_write(item, result):
+        if (item == 11):
+            raise ValueError("write")
+        written.append((item, result))
+
+    written = []
+    failed_items = run_pipeline(ITEMS, failing_read, failing_process, failing_write, prefetch = 1)
+    assert sorted(failed_items) == [3, 7, 11]
+    assert [str(failed_items[item]) for item in (3, 7, 11)] == ["read", "process", "write"]
+    assert written == [entry for entry in run_sequential(ITEMS) if entry[0] not in (3, 7, 11)]
+
+def test_items_error_is_raised():
+    def items():
+        yield from range(5)
+        raise RuntimeError("listing")
+
+    written = []
+    threads = threading.active_count()
+    with pytest.raises(RuntimeError, match = "listing"):
+        run_pipeline(items(), read_item, process_item, lambda item, result: written.append(item), prefetch = 1)
+    # the items read before the error are written and the threads are done
+    assert written == list(range(5))
+    assert threading.active_count() == threads
+
+def test_interrupt_is_raised_after_the_pending_writes():
+    def interrupted_process(item, data):
+        if (item == 5):
+            raise KeyboardInterrupt
+        return process_item(item, data)
+
+    def slow_write(item, result):
+        time.sleep(0.01)
+        written.append(item)
+
+    written = []
+    threads = threading.active_count()
+    with pytest.raises(KeyboardInterrupt):
+        run_pipeline(ITEMS, read_item, interrupted_process, slow_write, prefetch = 2, max_pending_writes = 2)
+    assert written == list(range(5))
+    assert threading.active_count() == threads
+
+def test_invalid_queue_sizes():
+    with pytest.raises(Exception, match = "prefetch"):
+        run_pipeline(ITEMS, read_item, process_item, lambda item, result: None, prefetch = 0)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from annotate.scheduler import TILE_SIZES, estimate_peak_memory, plan_jobs, run_scheduled
+
+MB = 1024**2
+WORKER_MEMORY = 100 * MB
+
+def image_info(shape, axes = "YX", dtype = np.uint16, memmappable = True):
+    return {"shape": tuple(shape), "dtype": np.dtype(dtype), "axes": axes, "memmappable": memmappable, "tiled": False}
+
+def test_peak_memory_grows_with_the_image():
+    small = estimate_peak_memory(image_info((1000, 1000)))
+    large = estimate_peak_memory(image_info((2000, 2000)))
+    assert 0 < small < large
+    assert estimate_peak_memory(image_info((2000, 2000)), tile_size = 512) < large
+    assert (estimate_peak_memory(image_info((2000, 2000)), tile_size = 512, streamed_output = True) <
+            estimate_peak_memory(image_info((2000, 2000)), tile_size = 512))
+
+def test_jobs_largest_first():
+    index = {"small.tif": image_info((500, 500)), "large.tif": image_info((3000, 3000)), "medium.tif": image_info((1500, 1500))}
+    jobs = plan_jobs(index, 4096 * MB, worker_memory = WORKER_MEMORY)
+    assert [job["image"] for job in jobs] == ["large.tif", "medium.tif", "small.tif"]
+    assert all(job["tile_size"] is None for job in jobs)
+    memories = [job["memory"] for job in jobs]
+    assert memories == sorted(memories, reverse = True)
+    assert jobs[-1]["memory"] == WORKER_MEMORY + estimate_peak_memory(index["small.tif"])
+
+def test_over_budget_jobs_are_tiled():
+    max_memory = 1024 * MB
+    index = {"slide.tif": image_info((20000, 20000)), "small.tif": image_info((500, 500))}
+    assert WORKER_MEMORY + estimate_peak_memory(index["slide.tif"]) > max_memory
+
+    jobs = {job["image"]: job for job in plan_jobs(index, max_memory, worker_memory = WORKER_MEMORY)}
+    slide = jobs["slide.tif"]
+    assert slide["tile_size"] in TILE_SIZES
+    assert slide["memory"] <= max_memory
+    assert slide["memory"] == WORKER_MEMORY + estimate_peak_memory(index["slide.tif"], tile_size = slide["tile_size"])
+    # the largest tiles that fit are used
+    larger = [size for size in TILE_SIZES if size > slide["tile_size"]]
+    assert all(WORKER_MEMORY + estimate_peak_memory(index["slide.tif"], tile_size = size) > max_memory for size in larger)
+    assert jobs["small.tif"]["tile_size"] is None
+
+@pytest.mark.parametrize("info", [image_info((60, 2000, 2000), axes = "ZYX"), image_info((100000, 100000))],
+                         ids = ["stack", "too_large_for_tiles"])
+def test_jobs_over_budget_are_reported(info):
+    index = {"huge.tif": info, "small.tif": image_info((500, 500))}
+    with pytest.warns(UserWarning, match = "huge.tif"):
+        jobs = plan_jobs(index, 1024 * MB, worker_memory = WORKER_MEMORY)
+    assert [job["image"] for job in jobs] == ["huge.tif", "small.tif"]
+    assert jobs[0]["memory"] > 1024 * MB
+
+def test_budget_over_worker_memory():
+    with pytest.raises(Exception, match = "max_memory"):
+        plan_jobs({"small.tif": image_info((500, 500))}, WORKER_MEMORY, worker_memory = WORKER_MEMORY)
+
+def test_run_scheduled_stays_under_budget():
+    max_memory = 1000
+    jobs = [{"image": str(i), "memory": memory} for i, memory in enumerate([1500, 700, 600, 400, 300, 300, 100])]
+    running = {}
+    peaks = []
+
+    def submit_job(pool, job):
+        running[job["image"]] = job["memory"]
+        peaks.append((job["image"], sum(running.values())))
+        return pool.submit(abs, -job["memory"])
+
+    completed = []
+    for job, future in run_scheduled(jobs, submit_job, max_memory, workers = 3):
+        assert future.result() == job["memory"]
+        del running[job["image"]]
+        completed.append(job["image"])
+
+    assert sorted(completed) == sorted(job["image"] for job in jobs)
+    # the job over the whole budget runs alone, the others never go over it together
+    assert peaks[0] == ("0", 1500)
+    assert all(used <= max_memory for _, used in peaks[1:])
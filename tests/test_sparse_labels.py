@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from skimage.measure import label, regionprops
+
+from annotate.sparse_labels import encode_labels, encode_label_tiles, decode_labels, object_mask, write_sparse_labels, read_sparse_labels
+from annotate.label_output import write_label_image, write_label_tiles, output_extension
+from annotate.image_io import open_image, read_image_shape, read_image_dtype
+from annotate.tiled_segmentation import iter_tiles
+
+def random_labels(shape = (97, 131), dtype = np.uint16, seed = 0):
+    """Label image of random objects, with labels that are not sequential"""
+    rng = np.random.default_rng(seed)
+    labels = label(rng.random(shape) < 0.45).astype(dtype)
+    labels[labels > 0] += 3
+    return labels
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.uint32])
+@pytest.mark.parametrize("rows_per_strip", [1, 10, 1024])
+def test_round_trip(dtype, rows_per_strip):
+    labels = random_labels(dtype = dtype) % np.iinfo(dtype).max
+    decoded = decode_labels(encode_labels(labels, rows_per_strip))
+    assert decoded.dtype == labels.dtype
+    np.testing.assert_array_equal(decoded, labels)
+
+@pytest.mark.parametrize("shape", [(0, 0), (0, 5), (5, 7)])
+def test_empty_labels(shape):
+    labels = np.zeros(shape, dtype = np.uint8)
+    np.testing.assert_array_equal(decode_labels(encode_labels(labels)), labels)
+
+def test_stacks_are_not_encoded():
+    with pytest.raises(Exception):
+        encode_labels(np.zeros((2, 5, 5), dtype = np.uint8))
+
+@pytest.mark.parametrize("window", [(10, 40, 20, 90), (0, 97, 0, 131), (90, 200, 125, 400), (-5, 3, -2, 4), (50, 50, 10, 20)])
+def test_windows(window):
+    labels = random_labels()
+    expected = labels[max(window[0], 0):window[1], max(window[2], 0):window[3]]
+    np.testing.assert_array_equal(decode_labels(encode_labels(labels), window), expected)
+
+def test_object_masks():
+    labels = random_labels()
+    sparse = encode_labels(labels)
+    for region in regionprops(labels):
+        bbox, mask = object_mask(sparse, region.label)
+        assert bbox == region.bbox
+        np.testing.assert_array_equal(mask, region.image)
+    with pytest.raises(Exception):
+        object_mask(sparse, 1)
+
+@pytest.mark.parametrize("tile_size", [16, 32, 200])
+def test_encoded_tiles(tile_size):
+    labels = random_labels()
+    tiles = ((tile, labels[tile[0]:tile[1], tile[2]:tile[3]]) for tile in iter_tiles(labels.shape, tile_size))
+    sparse = encode_label_tiles(labels.shape, labels.dtype, tiles)
+    expected = encode_labels(labels)
+    assert sparse.keys() == expected.keys()
+    for name in expected:
+        np.testing.assert_array_equal(sparse[name], expected[name])
+
+def test_file_round_trip(tmp_path):
+    labels = random_labels()
+    path = str(tmp_path / ("labels" + output_extension("sparse")))
+    write_sparse_labels(path, encode_labels(labels))
+    np.testing.assert_array_equal(decode_labels(read_sparse_labels(path)), labels)
+    with pytest.raises(Exception):
+        write_sparse_labels(str(tmp_path / "labels.npz"), encode_labels(labels))
+
+def test_sparse_output(tmp_path):
+    labels = random_labels()
+    image_path = str(tmp_path / ("image" + output_extension("sparse")))
+    write_label_image(image_path, labels, output_format = "sparse")
+    assert read_image_shape(image_path) == labels.shape
+    assert read_image_dtype(image_path) == labels.dtype
+    np.testing.assert_array_equal(open_image(image_path), labels)
+
+    tiles_path = str(tmp_path / ("tiles" + output_extension("sparse")))
+    tiles = ((tile, labels[tile[0]:tile[1], tile[2]:tile[3]]) for tile in iter_tiles(labels.shape, 32))
+    write_label_tiles(tiles_path, labels.shape, labels.dtype, tiles, 32, output_format = "sparse")
+    np.testing.assert_array_equal(open_image(tiles_path), labels)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+
+from annotate.basic_image_processing_tasks import simple_intensity_based_segmentation
+from annotate.tiled_segmentation import tiled_intensity_based_segmentation, iter_tiles
+
+def blob_image(shape = (300, 260), seed = 0):
+    """16 bit image of bright blobs of many sizes, some of them crossing the tile borders"""
+    rng = np.random.default_rng(seed)
+    image = ndi.gaussian_filter(rng.random(shape), 4)
+    image = (image - image.min()) / (image.max() - image.min())
+    return (image * 60000 + 1000).astype(np.uint16)
+
+def assembled_labels(shape, dtype, tiles):
+    """Labels written tile by tile (see write_tiles of tiled_intensity_based_segmentation)"""
+    labels = np.zeros(shape, dtype = dtype)
+    for (row_start, row_end, col_start, col_end), label_tile in tiles:
+        labels[row_start:row_end, col_start:col_end] = label_tile
+    return labels
+
+def test_iter_tiles_cover_the_image():
+    covered = np.zeros((100, 70), dtype = int)
+    for row_start, row_end, col_start, col_end in iter_tiles(covered.shape, 32):
+        covered[row_start:row_end, col_start:col_end] += 1
+    assert (covered == 1).all()
+
+@pytest.mark.parametrize("threshold_method", ["Otsu", "Li", "Triangle", "Yen"])
+@pytest.mark.parametrize("tile_size", [32, 64, 1000])
+def test_tiled_same_as_untiled(threshold_method, tile_size):
+    image = blob_image()
+    params = dict(gaussian_sigma = 2, thresh_method = threshold_method, smallest_area_of_object = 30, label_img_depth = "16bit",
+                  precision = "float64")
+    expected = simple_intensity_based_segmentation(image, **params)
+    labels = tiled_intensity_based_segmentation(image, tile_size = tile_size, **params)
+    assert expected.any()
+    assert labels.dtype == expected.dtype
+    np.testing.assert_array_equal(labels, expected)
+
+def test_tiled_float32():
+    image = blob_image(seed = 1)
+    params = dict(gaussian_sigma = 3, thresh_method = "Otsu", smallest_area_of_object = 20)
+    expected = simple_intensity_based_segmentation(image, **params)
+    labels = tiled_intensity_based_segmentation(image, tile_size = 48, **params)
+    np.testing.assert_array_equal(labels, expected)
+
+def test_tiled_written_tile_by_tile():
+    image = blob_image(seed = 2)
+    params = dict(gaussian_sigma = 2, thresh_method = "Li", smallest_area_of_object = 30, precision = "float64")
+    expected = simple_intensity_based_segmentation(image, **params)
+    labels = tiled_intensity_based_segmentation(image, tile_size = 64, write_tiles = assembled_labels, **params)
+    np.testing.assert_array_equal(labels, expected)
+
+def test_objects_spanning_several_tiles():
+    # a ring crossing sixteen tiles is a single object, the square in its middle another one
+    image = np.zeros((64, 64), dtype = np.uint8)
+    image[8:56, 8:12] = image[8:56, 52:56] = image[8:12, 8:56] = image[52:56, 8:56] = 200
+    image[28:36, 28:36] = 200
+    params = dict(gaussian_sigma = 0.5, thresh_method = "Otsu", smallest_area_of_object = 2, precision = "float64")
+    expected = simple_intensity_based_segmentation(image, **params)
+    labels = tiled_intensity_based_segmentation(image, tile_size = 16, **params)
+    np.testing.assert_array_equal(labels, expected)
+    assert labels.max() == 2